@@ -0,0 +1,692 @@
+import itertools
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+from unittest import mock
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QColor, QImage, QPainter, QPen, QLinearGradient, QRegion
+from PyQt5.QtCore import Qt, QPoint, QPointF, QRect, QSize
+
+import pencil
+from pencil import Stroke, Shape, Scene, SceneRenderer, EditCommand, SessionJournal
+
+SESSION_POINTS = 100000
+STROKE_POINTS = 200
+
+def rss_bytes():
+    """Resident set size of this process (Linux only, 0 elsewhere)"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+def synthetic_samples(count):
+    """Yields a wandering pen trace of the given length"""
+    x, y = 500, 500
+    for i in range(count):
+        x += (i * 7919) % 5 - 2
+        y += (i * 104729) % 5 - 2
+        yield x, y
+
+def measure(build):
+    """Returns Python heap and RSS growth caused by build()"""
+    tracemalloc.start()
+    rss_before = rss_bytes()
+    kept = build()
+    heap, _ = tracemalloc.get_traced_memory()
+    rss_after = rss_bytes()
+    tracemalloc.stop()
+    del kept
+    return heap, rss_after - rss_before
+
+def build_point_lists():
+    """Session stored the old way: (list[QPoint], QColor, int) tuples"""
+    lines = []
+    for i, (x, y) in enumerate(synthetic_samples(SESSION_POINTS)):
+        if i % STROKE_POINTS == 0:
+            lines.append(([], QColor("#e74c3c"), 5))
+        lines[-1][0].append(QPoint(x, y))
+    return lines
+
+def build_strokes():
+    """Session stored as Stroke records with flat coordinate buffers"""
+    lines = []
+    for i, (x, y) in enumerate(synthetic_samples(SESSION_POINTS)):
+        if i % STROKE_POINTS == 0:
+            lines.append(Stroke(QColor("#e74c3c"), 5))
+        lines[-1].append(QPoint(x, y))
+    return lines
+
+def bench_memory():
+    """Bytes per stored sample for a 100k-point session"""
+    print(f"memory: {SESSION_POINTS} samples in strokes of {STROKE_POINTS}")
+    for name, build in (("list[QPoint]", build_point_lists), ("Stroke", build_strokes)):
+        start = time.perf_counter()
+        heap, rss = measure(build)
+        elapsed = time.perf_counter() - start
+        print(f"  {name:<14} python heap {heap / SESSION_POINTS:6.1f} B/sample   "
+              f"rss {rss / SESSION_POINTS:6.1f} B/sample   build {elapsed * 1000:7.1f} ms")
+
+def random_strokes(count, points, width=1920, height=1080):
+    """Builds count strokes of the given length spread over the canvas"""
+    strokes = []
+    samples = synthetic_samples(count * points)
+    for i in range(count):
+        stroke = Stroke(QColor("#e74c3c" if i % 2 else "#f39c12"), 5)
+        if i % 4 == 0:
+            stroke.color.setAlpha(100)
+        ox, oy = (i * 97) % (width - 400), (i * 61) % (height - 400)
+        for _ in range(points):
+            x, y = next(samples)
+            stroke.append(QPoint(ox + x % 400, oy + y % 400))
+        strokes.append(stroke)
+    return strokes
+
+def paint_segments(painter, stroke):
+    """Previous renderer: one drawLine call per segment"""
+    painter.setPen(QPen(stroke.color, stroke.size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+    painter.setOpacity(stroke.color.alpha() / 255.0)
+    points = stroke.polygon()
+    for i in range(len(points) - 1):
+        painter.drawLine(points[i], points[i + 1])
+
+def paint_polyline(painter, stroke):
+    """Current renderer: the cached polygon drawn with one call"""
+    SceneRenderer(Scene()).draw_line(painter, stroke)
+
+def bench_paint(repeat=3):
+    """Paint time for 1k strokes of 200 points"""
+    strokes = random_strokes(1000, 200)
+    image = QImage(1920, 1080, QImage.Format_ARGB32_Premultiplied)
+    print("paint: 1000 strokes x 200 points into 1920x1080")
+    for name, paint in (("drawLine/segment", paint_segments), ("drawPolyline", paint_polyline)):
+        best = None
+        for _ in range(repeat):
+            image.fill(Qt.transparent)
+            painter = QPainter(image)
+            painter.setRenderHint(QPainter.Antialiasing)
+            start = time.perf_counter()
+            for stroke in strokes:
+                paint(painter, stroke)
+            painter.end()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"  {name:<17} {best * 1000:8.1f} ms")
+
+RESOLUTIONS = {
+    "1080p": QSize(1920, 1080),
+    "4K": QSize(3840, 2160),
+    "dual 4K": QSize(7680, 2160),
+}
+
+def percentiles(samples):
+    """p50/p95/p99/max of a list of seconds, in milliseconds"""
+    ordered = sorted(samples)
+    if not ordered:
+        return "no samples"
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return (f"p50 {pick(0.50):7.2f}  p95 {pick(0.95):7.2f}  "
+            f"p99 {pick(0.99):7.2f}  max {ordered[-1] * 1000:7.2f} ms")
+
+def screenshot(size):
+    """Stand-in for the captured desktop"""
+    image = QImage(size, QImage.Format_ARGB32_Premultiplied)
+    painter = QPainter(image)
+    gradient = QLinearGradient(0, 0, size.width(), size.height())
+    gradient.setColorAt(0, QColor("#2c3e50"))
+    gradient.setColorAt(1, QColor("#bdc3c7"))
+    painter.fillRect(image.rect(), gradient)
+    painter.end()
+    return image
+
+def scribble(cx, cy, count, radius=120, phase=0.0):
+    """Looping freehand trace around a centre point"""
+    return [QPoint(int(cx + radius * math.cos(phase + i * 0.05) + 30 * math.sin(i * 0.31)),
+                   int(cy + radius * math.sin(phase + i * 0.07) + 30 * math.cos(i * 0.23)))
+            for i in range(count)]
+
+class TraceReplayer:
+    """Replays synthetic input through Scene/SceneRenderer the way ScreenDrawApp does"""
+    def __init__(self, size, history_strokes=300):
+        self.size = size
+        self.scene = Scene()
+        self.renderer = SceneRenderer(self.scene)
+        self.background = screenshot(size)
+        self.frame = QImage(size, QImage.Format_ARGB32_Premultiplied)
+        self.frame_times = []
+        self.erase_times = []
+        self.settle_times = []
+        self.renderer.resize(size)
+        # Pre-existing annotations so frames are not painted over an empty canvas
+        for i in range(history_strokes):
+            stroke = Stroke(QColor("#3498db"), 5, self.scene.next_id())
+            cx = (i * 211) % (size.width() - 300) + 150
+            cy = (i * 137) % (size.height() - 300) + 150
+            for point in scribble(cx, cy, 150, phase=i):
+                stroke.extend(point, 2, 0.75)
+            stroke.finish()
+            self.scene.commit(EditCommand(added=[stroke]))
+        self.renderer.rebuild()
+
+    def paint(self, dirty, live_items=()):
+        """One frame: composite the dirty rect the way paintEvent does"""
+        start = time.perf_counter()
+        painter = QPainter(self.frame)
+        painter.setRenderHint(QPainter.Antialiasing)
+        self.renderer.paint(painter, dirty, self.background, live_items)
+        painter.end()
+        self.frame_times.append(time.perf_counter() - start)
+
+    def freehand(self, points, color, size=5):
+        """Press, move and release with a freehand tool"""
+        stroke = Stroke(color, size, self.scene.next_id())
+        stroke.extend(points[0], 0, 0)
+        for point in points[1:]:
+            changed = stroke.extend(point, 2, max(0.5, 0.15 * size))
+            if changed is not None:
+                self.paint(self.renderer.screen_rect(changed, size), [stroke])
+        stroke.finish()
+        self.scene.commit(EditCommand(added=[stroke]))
+        self.renderer.commit(stroke)
+        self.paint(self.renderer.items_rect([stroke]))
+
+    def rubber_band(self, kind, start, ends, size=5):
+        """Drags out a shape, repainting the union of old and new bands"""
+        previous = None
+        color = QColor("#9b59b6")
+        for end in ends:
+            dirty = self.renderer.segment_rect(start, end, size)
+            if previous is not None:
+                dirty = dirty.united(self.renderer.segment_rect(start, previous, size))
+            self.paint(dirty, [Shape(kind, start, end, color, size)])
+            previous = end
+        shape = Shape(kind, start, ends[-1], color, size, self.scene.next_id())
+        self.scene.commit(EditCommand(added=[shape]))
+        self.renderer.commit(shape)
+        self.paint(self.renderer.items_rect([shape]))
+
+    def zoom(self, zoom):
+        """Zoom slider step: repaint the whole screen with the stretched layer"""
+        self.scene.zoom = zoom
+        self.paint(QRect(QPoint(0, 0), self.size))
+
+    def settle(self):
+        """Slider released: re-render the layer at the new zoom and repaint"""
+        start = time.perf_counter()
+        self.renderer.rebuild()
+        self.settle_times.append(time.perf_counter() - start)
+        self.paint(QRect(QPoint(0, 0), self.size))
+
+    def erase(self, points, radius=10):
+        """Eraser drag: split strokes, re-render and repaint"""
+        for point in points:
+            start = time.perf_counter()
+            command = self.scene.erase(point, radius)
+            dirty = QRect()
+            if command.removed:
+                self.scene.record(command)
+                # Split strokes only change inside the eraser circle
+                area = QRect(point.x() - radius, point.y() - radius, 2 * radius + 1, 2 * radius + 1)
+                dirty = self.renderer.screen_rect(area, max(item.size for item in command.removed))
+                self.renderer.rebuild(dirty)
+            self.erase_times.append(time.perf_counter() - start)
+            if not dirty.isEmpty():
+                self.paint(dirty)
+
+def run_trace(name, size, trace):
+    """Runs one trace and prints frame, erase and memory figures"""
+    # tracemalloc would distort the timings, so memory is reported as RSS growth
+    rss_before = rss_bytes()
+    replayer = TraceReplayer(size)
+    trace(replayer)
+    rss = rss_bytes() - rss_before
+    points = sum(len(line) for line in replayer.scene.lines.values())
+    print(f"  {name:<12} frames {len(replayer.frame_times):5d}  {percentiles(replayer.frame_times)}")
+    if replayer.erase_times:
+        print(f"  {'':<12} erase         {percentiles(replayer.erase_times)}")
+    if replayer.settle_times:
+        print(f"  {'':<12} re-render     {percentiles(replayer.settle_times)}")
+    print(f"  {'':<12} memory  rss +{rss / 1e6:6.1f} MB  tiles {replayer.renderer.memory() / 1e6:6.1f} MB  "
+          f"{points} stored points")
+
+def trace_scribble(replayer):
+    """Freehand scribbles spread over the screen"""
+    width, height = replayer.size.width(), replayer.size.height()
+    for i in range(10):
+        replayer.freehand(scribble(width * (i % 5 + 1) // 6, height * (i // 5 + 1) // 4, 300, phase=i),
+                          QColor("#e74c3c"))
+
+def trace_highlighter(replayer):
+    """Wide translucent sweeps across the screen"""
+    width, height = replayer.size.width(), replayer.size.height()
+    color = QColor("#f1c40f")
+    color.setAlpha(100)
+    for row in range(3):
+        y = height * (row + 1) // 4
+        replayer.freehand([QPoint(x, y + (x // 7) % 5) for x in range(50, width - 50, 8)], color, 20)
+
+def trace_eraser(replayer):
+    """Eraser zig-zagging through the existing annotations"""
+    width, height = replayer.size.width(), replayer.size.height()
+    points = []
+    for row in range(3):
+        y = height * (row + 1) // 4
+        points.extend(QPoint(x, y + int(40 * math.sin(x / 60))) for x in range(0, width, 8))
+    replayer.erase(points)
+
+def trace_shapes(replayer):
+    """Rubber-banding lines, rectangles and circles"""
+    width, height = replayer.size.width(), replayer.size.height()
+    for i, kind in enumerate(["line", "rect", "circle"] * 2):
+        start = QPoint(width * (i % 3 + 1) // 5, height * (i // 3 + 1) // 4)
+        ends = [QPoint(start.x() + step * 3, start.y() + step * 2) for step in range(1, 100)]
+        replayer.rubber_band(kind, start, ends)
+
+def trace_zoom_slider(replayer):
+    """Dragging the zoom slider from 0.5x to 3.0x and back"""
+    steps = [zoom / 10 for zoom in range(5, 31)]
+    for zoom in steps + steps[::-1]:
+        replayer.zoom(zoom)
+    replayer.settle()
+
+def trace_zoomed(replayer):
+    """Freehand scribbles at 3.0x zoom"""
+    replayer.zoom(3.0)
+    replayer.settle()
+    replayer.frame_times.clear()
+    width, height = replayer.size.width() // 3, replayer.size.height() // 3
+    for i in range(4):
+        replayer.freehand(scribble(width * (i % 2 + 1) // 3, height * (i // 2 + 1) // 3, 300, 40, phase=i),
+                          QColor("#e74c3c"))
+
+TRACES = {
+    "scribble": trace_scribble,
+    "highlighter": trace_highlighter,
+    "eraser": trace_eraser,
+    "shapes": trace_shapes,
+    "zoom slider": trace_zoom_slider,
+    "zoomed 3x": trace_zoomed,
+}
+
+def bench_replay():
+    """Per-frame paint time, erase latency and memory for synthetic input traces"""
+    for label, size in RESOLUTIONS.items():
+        print(f"replay: {label} ({size.width()}x{size.height()}), 300 strokes already drawn")
+        for name, trace in TRACES.items():
+            run_trace(name, size, trace)
+
+def bench_tiles():
+    """Layer memory for local annotations on a dual-4K desktop"""
+    size = RESOLUTIONS["dual 4K"]
+    scene = Scene()
+    renderer = SceneRenderer(scene)
+    renderer.resize(size)
+    print(f"tiles: {size.width()}x{size.height()}, full-screen layer {size.width() * size.height() * 4 / 1e6:.1f} MB")
+    for count in (1, 10, 50):
+        while len(scene.lines) < count:
+            i = len(scene.lines)
+            stroke = Stroke(QColor("#e74c3c"), 5, scene.next_id())
+            for point in scribble(600 + (i % 5) * 150, 500 + (i // 5) * 60, 150, 60, phase=i):
+                stroke.append(point, 2)
+            scene.commit(EditCommand(added=[stroke]))
+            renderer.commit(stroke)
+        tiles = sum(len(cache.tiles) for cache in renderer.layers.values())
+        print(f"  {count:3d} strokes  {tiles:4d} tiles  {renderer.memory() / 1e6:6.1f} MB")
+
+def bench_journal(strokes=5000, points=200):
+    """Journal cost per event and reload time for a long session"""
+    print(f"journal: {strokes} strokes x {points} points with erases and undos")
+    lines = random_strokes(strokes, points)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "session.spj")
+        scene = Scene()
+        journal = SessionJournal.create(path, QSize(1920, 1080))
+        scene.listeners.append(journal)
+        event_times = []
+        for i, stroke in enumerate(lines):
+            stroke.id = scene.next_id()
+            start = time.perf_counter()
+            scene.commit(EditCommand(added=[stroke]))
+            if i % 10 == 9:
+                scene.commit(EditCommand(removed=[lines[i - 3]]))
+            if i % 25 == 24:
+                scene.undo()
+            event_times.append(time.perf_counter() - start)
+        journal.close()
+        size = os.path.getsize(path)
+        
+        start = time.perf_counter()
+        session = SessionJournal.load(path)
+        elapsed = time.perf_counter() - start
+        print(f"  write  {percentiles(event_times)}   file {size / 1e6:.1f} MB")
+        print(f"  reload {elapsed * 1000:8.1f} ms   {len(session.scene.lines)} strokes restored")
+
+def bench_eraser(strokes=50, points=2000):
+    """Geometric eraser cost per step across dense strokes, with and without numpy"""
+    print(f"eraser: drag across {strokes} strokes x {points} points")
+    backends = [("numpy", pencil.numpy), ("python", None)] if pencil.numpy is not None else [("python", None)]
+    for name, module in backends:
+        saved, pencil.numpy = pencil.numpy, module
+        scene = Scene()
+        for i in range(strokes):
+            stroke = Stroke(QColor("#e74c3c"), 5, scene.next_id())
+            for j in range(points):
+                stroke.append(QPoint(100 + j // 2, 100 + i * 4 + (j * 7919) % 7))
+            scene.add_items([stroke])
+        step_times = []
+        for x in range(100, 100 + points // 2, 5):
+            start = time.perf_counter()
+            scene.erase(QPoint(x, 100 + strokes * 2), 10)
+            step_times.append(time.perf_counter() - start)
+        pencil.numpy = saved
+        print(f"  {name:<7} step {percentiles(step_times)}   {len(scene.lines)} pieces left")
+
+def bench_budget(strokes=3000, budget=100000):
+    """A long session with and without baking old strokes under a point budget"""
+    size = RESOLUTIONS["1080p"]
+    print(f"budget: {strokes} strokes x {STROKE_POINTS} points at {size.width()}x{size.height()}, "
+          f"budget {budget} points")
+    for name, limit in (("unlimited", None), ("budget", budget)):
+        rss_before = rss_bytes()
+        scene = Scene(point_budget=limit)
+        renderer = SceneRenderer(scene)
+        renderer.resize(size)
+        bake_times = []
+        for i, stroke in enumerate(random_strokes(strokes, STROKE_POINTS)):
+            stroke.id = scene.next_id()
+            scene.commit(EditCommand(added=[stroke]))
+            renderer.commit(stroke)
+            start = time.perf_counter()
+            renderer.bake_over_budget()
+            bake_times.append(time.perf_counter() - start)
+        rebuild_times = []
+        erase_times = []
+        for i in range(20):
+            start = time.perf_counter()
+            renderer.rebuild(QRect(200 + i * 40, 300, 64, 64))
+            rebuild_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            scene.record(scene.erase(QPoint(300 + i * 60, 400), 10))
+            erase_times.append(time.perf_counter() - start)
+        print(f"  {name:<9} {scene.points:7d} vector points  {len(scene.baked_items):5d} baked  "
+              f"raster {scene.baked_memory() / 1e6:5.1f} MB  rss +{(rss_bytes() - rss_before) / 1e6:6.1f} MB")
+        print(f"  {'':<9} bake      {percentiles(bake_times)}")
+        print(f"  {'':<9} re-render {percentiles(rebuild_times)}")
+        print(f"  {'':<9} erase     {percentiles(erase_times)}")
+
+def bench_timeline(strokes=2000, speed=40.0, png_frames=300):
+    """Streamed replay of a long timed recording to a pipe and to PNG frames"""
+    size = RESOLUTIONS["1080p"]
+    print(f"timeline: {strokes} strokes x {STROKE_POINTS} points drawn over 1 s each, replayed at {speed}x")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "session.spj")
+        scene = Scene()
+        journal = SessionJournal.create(path, size)
+        now = [0.0]
+        journal.clock = lambda: now[0]
+        scene.listeners.append(journal)
+        for stroke in random_strokes(strokes, STROKE_POINTS):
+            stroke.id = scene.next_id()
+            stroke.times = array("f", (now[0] + i / STROKE_POINTS for i in range(STROKE_POINTS)))
+            now[0] += 1.2
+            scene.commit(EditCommand(added=[stroke]))
+        journal.close()
+        scene.reset()
+        print(f"  journal {os.path.getsize(path) / 1e6:.1f} MB")
+        
+        rss_before = rss_bytes()
+        player = pencil.TimelinePlayer(path, 30, speed)
+        writer = pencil.FramePipeWriter(open(os.devnull, "wb"))
+        start = time.perf_counter()
+        checkpoints = []
+        for frame in player.frames():
+            writer.write(frame)
+            if writer.count % 500 == 0:
+                checkpoints.append(f"{(rss_bytes() - rss_before) / 1e6:.0f}")
+        elapsed = time.perf_counter() - start
+        writer.close()
+        print(f"  pipe  {writer.count} frames in {elapsed:.1f} s  {writer.count / elapsed:6.1f} frames/s   "
+              f"rss + MB every 500 frames: {' '.join(checkpoints)}")
+        
+        writer = pencil.FrameSequenceWriter(os.path.join(directory, "frames"))
+        start = time.perf_counter()
+        for frame in itertools.islice(pencil.TimelinePlayer(path, 30, speed).frames(), png_frames):
+            writer.write(frame)
+        writer.close()
+        elapsed = time.perf_counter() - start
+        print(f"  png   {writer.count} frames in {elapsed:.1f} s  {writer.count / elapsed:6.1f} frames/s   "
+              f"{writer.in_flight} in flight")
+
+def bench_stream(strokes=300, samples_per_frame=16):
+    """Strokes streamed sample by sample to a local viewer while another viewer is stalled"""
+    size = RESOLUTIONS["1080p"]
+    print(f"stream: {strokes} strokes x {STROKE_POINTS} points, {samples_per_frame} samples per frame, "
+          f"one viewer reading and one stalled")
+    app = QApplication.instance()
+    with tempfile.TemporaryDirectory() as directory:
+        address = os.path.join(directory, "stream.sock")
+        scene = Scene()
+        publisher = pencil.StreamPublisher(address)
+        publisher.restart(size, scene)
+        viewer = pencil.StreamReceiver()
+        socket = pencil.StreamReceiver.connect(address)
+        stalled = pencil.StreamReceiver.connect(address)
+        stalled.setReadBufferSize(4096)  # Stops reading from the socket once 4 KB are waiting
+        app.processEvents()
+        
+        publish_times = []
+        latencies = []
+        received = 0
+        queued = 0  # Most bytes ever waiting in the publisher for one viewer
+        behind = 0  # Frames the stalled viewer spent on the spool
+        def frame(start):
+            nonlocal received, queued, behind
+            publisher.flush()
+            publish_times.append(time.perf_counter() - start)
+            app.processEvents()
+            while socket.waitForReadyRead(0) or socket.bytesAvailable():
+                data = bytes(socket.readAll())
+                received += len(data)
+                viewer.feed(data)
+            latencies.append(time.perf_counter() - start)
+            queued = max([queued] + [client.bytesToWrite() for client in publisher.clients])
+            behind += any(offset is not None for offset in publisher.clients.values())
+        
+        for stroke in random_strokes(strokes, STROKE_POINTS):
+            live = Stroke(stroke.color, stroke.size, scene.next_id())
+            for first in range(0, len(stroke), samples_per_frame):
+                start = time.perf_counter()
+                for i in range(first, min(first + samples_per_frame, len(stroke))):
+                    live.extend(QPointF(stroke.coords[2 * i], stroke.coords[2 * i + 1]), 2, 0.75)
+                publisher.on_stroke(live)
+                frame(start)
+            start = time.perf_counter()
+            live.finish()
+            scene.commit(EditCommand(added=[live]))
+            frame(start)
+        print(f"  publish         {percentiles(publish_times)}")
+        print(f"  to viewer       {percentiles(latencies)}")
+        samples = strokes * STROKE_POINTS
+        print(f"  {received / samples:.1f} bytes per sample  viewer matches: {len(viewer.scene.lines) == len(scene.lines)}  "
+              f"stalled viewer: {queued / 1024:.0f} KB queued at most, {behind} frames behind")
+        
+        late = pencil.StreamReceiver()
+        stalled.setReadBufferSize(0)
+        start = time.perf_counter()
+        while len(late.scene.lines if late.scene else ()) < len(scene.lines):
+            app.processEvents()
+            if stalled.waitForReadyRead(10):
+                late.feed(bytes(stalled.readAll()))
+        print(f"  stalled viewer caught up in {(time.perf_counter() - start) * 1000:.0f} ms")
+        socket.close()
+        stalled.close()
+        publisher.close()
+
+def bench_render(sessions=64, strokes=300):
+    """Batch rendering of saved sessions to PNG, in one process and on a process pool"""
+    size = RESOLUTIONS["1080p"]
+    print(f"render: {sessions} sessions of {strokes} strokes x {STROKE_POINTS} points at "
+          f"{size.width()}x{size.height()}")
+    with tempfile.TemporaryDirectory() as directory:
+        archive = os.path.join(directory, "sessions")
+        os.makedirs(archive)
+        for i in range(sessions):
+            scene = Scene()
+            journal = SessionJournal.create(os.path.join(archive, f"session-{i:04d}.spj"), size)
+            scene.listeners.append(journal)
+            for stroke in random_strokes(strokes, STROKE_POINTS):
+                stroke.id = scene.next_id()
+                scene.commit(EditCommand(added=[stroke]))
+            journal.close()
+        for jobs in sorted({1, os.cpu_count() or 1}):
+            output = os.path.join(directory, f"png-{jobs}")
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, pencil.__file__, "render", archive, "-o", output,
+                                     "--jobs", str(jobs), "--compression", "1"],
+                                    stderr=subprocess.PIPE, text=True)
+            elapsed = time.perf_counter() - start
+            print(f"  {jobs:2d} processes  {elapsed:5.1f} s  {sessions / elapsed:6.1f} sessions/s  "
+                  f"exit {result.returncode}")
+
+def bench_recapture(repeat=5, zoom=1.5):
+    """Refreshing the background when a terminal-sized area of the screen changed"""
+    print(f"recapture: 800x400 area changed, background shown at {zoom}x")
+    backends = [("numpy", pencil.numpy), ("python", None)] if pencil.numpy is not None else [("python", None)]
+    for label in ["1080p", "4K"]:
+        size = RESOLUTIONS[label]
+        old = screenshot(size)
+        new = old.copy()
+        painter = QPainter(new)
+        painter.fillRect(QRect(200, 200, 800, 400), QColor("#1e1e1e"))
+        painter.end()
+        for name, module in backends:
+            saved, pencil.numpy = pencil.numpy, module
+            diff_times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                changed = pencil.changed_tiles(old, new)
+                diff_times.append(time.perf_counter() - start)
+            pencil.numpy = saved
+            print(f"  {label:<6} {name:<7} diff {percentiles(diff_times)}   {len(changed)} tiles changed")
+        
+        # Repaint after the swap: only the changed tiles against every tile of the screen
+        scene = Scene()
+        scene.zoom = zoom
+        renderer = SceneRenderer(scene)
+        renderer.resize(size)
+        target = QImage(size, QImage.Format_ARGB32_Premultiplied)
+        for name, rects in [("tiles", changed), ("full", [QRect(QPoint(0, 0), size)])]:
+            paint_times = []
+            for _ in range(repeat):
+                painter = QPainter(target)
+                renderer.paint_background(painter, old, target.rect())
+                painter.end()
+                start = time.perf_counter()
+                region = QRegion()
+                for rect in rects:
+                    screen_rect = renderer.screen_rect(rect, 0)
+                    renderer.invalidate_background(screen_rect)
+                    region += screen_rect
+                painter = QPainter(target)
+                for rect in region.rects():
+                    renderer.paint_background(painter, new, rect)
+                painter.end()
+                paint_times.append(time.perf_counter() - start)
+            print(f"  {label:<6} repaint {name:<5} {percentiles(paint_times)}")
+
+# Launches the app the way pencil.py's __main__ does and prints the seconds
+# from the launch time passed in argv to the end of the first paint event
+STARTUP_CHILD = """
+import sys, time
+launched = float(sys.argv[1])
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QEvent, QObject
+import pencil
+
+class FirstFrame(QObject):
+    def eventFilter(self, watched, event):
+        if event.type() == QEvent.Paint and watched is window:
+            watched.removeEventFilter(self)
+            window.paintEvent(event)
+            print(time.time() - launched)
+            app.quit()
+            return True
+        return False
+
+app = QApplication(sys.argv)
+app.setStyle("Fusion")
+window = pencil.ScreenDrawApp()
+first_frame = FirstFrame()
+window.installEventFilter(first_frame)
+window.show()
+app.exec_()
+"""
+
+def bench_startup(runs=5, toggles=20):
+    """Launch-to-first-frame time of the app and the cost of a draw-mode toggle"""
+    size = RESOLUTIONS["1080p"]
+    print(f"startup: {runs} launches, {toggles} draw-mode toggles at {size.width()}x{size.height()}")
+    with tempfile.TemporaryDirectory() as home:
+        # A scratch home keeps the session-recovery prompt out of the way
+        env = dict(os.environ, HOME=home)
+        launches = []
+        for _ in range(runs):
+            result = subprocess.run([sys.executable, "-c", STARTUP_CHILD, repr(time.time())],
+                                    env=env, capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            launches.append(float(result.stdout.split()[-1]))
+        print(f"  first frame  {percentiles(launches)}")
+        
+        # HOME goes back before the scratch directory is deleted, for the benchmarks after this one
+        with mock.patch.dict(os.environ, HOME=home):
+            window = pencil.ScreenDrawApp()
+            window.resize(size)
+            window.show()
+            app = QApplication.instance()
+            app.processEvents()
+            background = screenshot(size)
+            toggle_times = []
+            restyle_times = []
+            for _ in range(toggles):
+                start = time.perf_counter()
+                window.set_draw_mode(True, background)
+                window.set_draw_mode(False)
+                app.processEvents()
+                toggle_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                window.draw_button.set_tint("#e74c3c")
+                window.draw_button.set_tint("#27ae60")
+                restyle_times.append(time.perf_counter() - start)
+            window.close()
+        print(f"  toggle       {percentiles(toggle_times)}")
+        print(f"  restyle      {percentiles(restyle_times)}")
+
+BENCHMARKS = {
+    "memory": bench_memory,
+    "paint": bench_paint,
+    "replay": bench_replay,
+    "tiles": bench_tiles,
+    "journal": bench_journal,
+    "eraser": bench_eraser,
+    "budget": bench_budget,
+    "timeline": bench_timeline,
+    "stream": bench_stream,
+    "render": bench_render,
+    "recapture": bench_recapture,
+    "startup": bench_startup,
+}
+
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
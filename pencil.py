@@ -1,159 +1,2959 @@
+import os
 import sys
+import json
+import shutil
+import argparse
+import bisect
+import threading
+import math
+import mmap
+import multiprocessing
+import struct
+import tempfile
+import time
+import functools
+import itertools
+import traceback
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import numpy
+except ImportError:  # Optional: the eraser falls back to plain Python loops
+    numpy = None
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QPushButton, QHBoxLayout, QVBoxLayout,
     QSpinBox, QLabel, QFileDialog, QSlider, QToolButton, 
-    QMessageBox, QFrame, QButtonGroup, QSizePolicy
+    QMessageBox, QFrame, QButtonGroup, QSizePolicy, QMenu
 )
 from PyQt5.QtGui import (
     QPainter, QPen, QPixmap, QColor, QIcon, QFont, QFontMetrics, 
-    QLinearGradient, QPainterPath, QBrush
+    QLinearGradient, QPainterPath, QBrush, QImage, QPolygonF, QCursor, QMouseEvent, QGuiApplication, QRegion
 )
-from PyQt5.QtCore import Qt, QPoint, QRect, QSize, QPropertyAnimation, QEasingCurve, pyqtProperty
+from PyQt5.QtCore import (
+    Qt, QEvent, QPoint, QPointF, QRect, QRectF, QSize, QPropertyAnimation, QEasingCurve, pyqtProperty,
+    QObject, QRunnable, QThreadPool, QTimer, QSemaphore, pyqtSignal
+)
+from PyQt5.QtNetwork import QHostAddress, QLocalServer, QLocalSocket, QTcpServer, QTcpSocket
+
+@functools.lru_cache(maxsize=None)
+def shade(color, amount):
+    """Returns a colour lightened (amount > 0) or darkened as a QSS rgb() value"""
+    c = QColor(color)
+    return (f"rgb({min(255, max(0, c.red() + amount))}, {min(255, max(0, c.green() + amount))}, "
+            f"{min(255, max(0, c.blue() + amount))})")
+
+@functools.lru_cache(maxsize=None)
+def panel_stylesheet(tints, swatches):
+    """Builds the one stylesheet for every panel widget
+
+    Per-widget colours are selected through the dynamic "tint" and
+    "swatch" properties, so a widget changes colour by changing the
+    property rather than by parsing a stylesheet of its own.
+    """
+    rules = ["""
+        CompactButton {
+            border: none;
+            border-radius: 25px;
+            color: white;
+            font-weight: bold;
+            margin: 5px;  /* Increased margin */
+        }
+        CompactButton:checked {
+            border: 2px solid white;
+        }
+        ColorButton {
+            border: 2px solid #34495e;
+            border-radius: 16px;
+            margin: 4px;  /* Increased margin */
+        }
+        ColorButton:hover {
+            border: 3px solid #3498db;
+        }
+        ColorButton:pressed {
+            border: 3px solid #2980b9;
+        }
+        CompactSlider::groove:horizontal {
+            background: #34495e;
+            height: 6px;
+            border-radius: 3px;
+            margin: 2px 0;
+        }
+        CompactSlider::handle:horizontal {
+            background: #3498db;
+            width: 16px;
+            height: 16px;
+            border-radius: 8px;
+            margin: -5px 0;
+        }
+        CompactSlider::handle:horizontal:hover {
+            background: #5dade2;
+        }
+        CompactPanel {
+            background: qlineargradient(x1:0, y1:0, x2:1, y2:0,
+                stop:0 rgba(44, 62, 80, 0.95), 
+                stop:1 rgba(52, 73, 94, 0.85));
+            border: 1px solid rgba(255, 255, 255, 0.1);
+            border-radius: 15px;
+            padding: 15px 8px;  /* Increased padding */
+        }
+        QFrame#separator {
+            color: rgba(255, 255, 255, 0.3);
+            margin: 8px 12px;  /* Increased margin */
+        }
+        QLabel#settingLabel {
+            color: white;
+            font: 16px 'Segoe UI Emoji';
+        }
+        QToolTip {
+            background-color: #2c3e50;
+            color: white;
+            border: 1px solid #34495e;
+            border-radius: 8px;
+            padding: 5px;
+            font: 11px 'Segoe UI';
+        }
+    """]
+    for tint in tints:
+        light, dark = shade(tint, 30), shade(tint, -30)
+        rules.append(f"""
+        CompactButton[tint="{tint}"] {{
+            background: qlineargradient(x1:0, y1:0, x2:0, y2:1, stop:0 {tint}, stop:1 {dark});
+        }}
+        CompactButton[tint="{tint}"]:hover {{
+            background: qlineargradient(x1:0, y1:0, x2:0, y2:1, stop:0 {light}, stop:1 {tint});
+        }}
+        CompactButton[tint="{tint}"]:pressed {{
+            background: {dark};
+        }}
+        CompactButton[tint="{tint}"]:checked {{
+            background: {light};
+        }}""")
+    for swatch in swatches:
+        rules.append(f"""
+        ColorButton[swatch="{swatch}"] {{
+            background-color: {swatch};
+        }}""")
+    return "".join(rules)
+
+def apply_stylesheet():
+    """Styles the panel widgets created so far through the application stylesheet"""
+    QApplication.instance().setStyleSheet(
+        panel_stylesheet(tuple(sorted(CompactButton.tints)), tuple(sorted(ColorButton.swatches))))
+
+class CompactButton(QPushButton):
+    """Compact icon button class"""
+    tints = set()  # Every base colour in use, each with rules in the panel stylesheet
+
+    def __init__(self, icon, tooltip_text, color="#3498db", parent=None):
+        super().__init__(parent)
+        self.setText(icon)
+        self.setToolTip(tooltip_text)
+        self.setFixedSize(50, 50)  # Increased button size
+        self.setFont(QFont("Segoe UI Emoji", 16))
+        self.base_color = color
+        self.tints.add(color)
+        self.setProperty("tint", color)
+        
+    def set_tint(self, color):
+        """Switches the base colour
+
+        A colour some button already uses only re-polishes this button. A
+        new one adds its rules to the application stylesheet, which makes
+        Qt re-polish every widget, so tints should come from a small set
+        created up front.
+        """
+        self.base_color = color
+        self.setProperty("tint", color)
+        if color not in self.tints:
+            self.tints.add(color)
+            apply_stylesheet()
+        else:
+            self.style().unpolish(self)
+            self.style().polish(self)
+
+class ColorButton(QToolButton):
+    """Compact button for color selection"""
+    swatches = set()  # Every colour in use, each with a rule in the panel stylesheet
+
+    def __init__(self, color, parent=None):
+        super().__init__(parent)
+        self.color = color
+        self.setFixedSize(32, 32)  # Increased color button size
+        self.setToolTip(f"Color: {color.name()}")
+        self.swatches.add(color.name())
+        self.setProperty("swatch", color.name())
+
+class CompactSlider(QSlider):
+    """Compact slider"""
+    def __init__(self, orientation, parent=None):
+        super().__init__(orientation, parent)
+        self.setFixedWidth(120)
+
+class CompactPanel(QFrame):
+    """Compact left panel"""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setFrameStyle(QFrame.NoFrame)
+        self.setFixedWidth(80)  # Increased panel width
+
+NUMPY_MIN_SEGMENTS = 32  # Below this the Python loop beats numpy's call overhead
+
+def segment_spans(coords, cx, cy, radius):
+    """Returns (segment, t0, t1) for each segment of an interleaved x, y buffer
+    that enters a circle, the segment being inside it between t0 and t1 (0-1)
+
+    A single sample is treated as a zero-length segment.
+    """
+    if len(coords) == 2:
+        coords = coords * 2
+    if numpy is not None and len(coords) >= 2 * NUMPY_MIN_SEGMENTS:
+        points = numpy.frombuffer(coords, dtype=coords.typecode).reshape(-1, 2) - (cx, cy)
+        starts = points[:-1]
+        deltas = points[1:] - starts
+        # Solves |start + t * delta| = radius for every segment at once
+        a = (deltas * deltas).sum(axis=1)
+        b = (starts * deltas).sum(axis=1)
+        c = (starts * starts).sum(axis=1) - radius * radius
+        discriminant = b * b - a * c
+        moving = a > 0
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            root = numpy.sqrt(numpy.maximum(discriminant, 0))
+            t0 = (-b - root) / a
+            t1 = (-b + root) / a
+        hit = numpy.where(moving, (discriminant > 0) & (t0 < 1) & (t1 > 0), c < 0)
+        segments = numpy.flatnonzero(hit)
+        t0 = numpy.where(moving, t0, 0.0)[segments].clip(0.0, 1.0)
+        t1 = numpy.where(moving, t1, 1.0)[segments].clip(0.0, 1.0)
+        return list(zip(segments.tolist(), t0.tolist(), t1.tolist()))
+    
+    spans = []
+    limit = radius * radius
+    for i in range(0, len(coords) - 2, 2):
+        sx, sy = coords[i] - cx, coords[i + 1] - cy
+        dx, dy = coords[i + 2] - coords[i], coords[i + 3] - coords[i + 1]
+        a = dx * dx + dy * dy
+        c = sx * sx + sy * sy - limit
+        if not a:
+            if c < 0:
+                spans.append((i // 2, 0.0, 1.0))
+            continue
+        b = sx * dx + sy * dy
+        discriminant = b * b - a * c
+        if discriminant <= 0:
+            continue
+        root = discriminant ** 0.5
+        t0, t1 = (-b - root) / a, (-b + root) / a
+        if t0 < 1 and t1 > 0:
+            spans.append((i // 2, max(0.0, t0), min(1.0, t1)))
+    return spans
+
+class Stroke:
+    """Freehand stroke with its samples in a flat x, y float buffer
+
+    Samples keep sub-pixel positions, and the stroke is drawn as a chain
+    of quadratic curves from midpoint to midpoint, each sample bending
+    its curve, so a few samples make a smooth stroke. Live input goes
+    through extend(), which fits it to the tail of the stroke only: the
+    samples since the last kept one are held back while they lie close
+    to a straight chord, and the flattened curve is only recomputed
+    from the last sample a new one can still change. Pieces cut from a
+    drawn curve are not smooth: their samples are the flattened curve
+    and are drawn as they are.
+
+    Tablet strokes also keep one pen pressure per sample; they are drawn
+    as runs of equal quantized pressure, each run at its own width.
+    Recorded strokes keep the scene-clock time of every sample as well,
+    so a session can be replayed the way it was drawn.
+    """
+    __slots__ = ("id", "layer", "order", "holes", "coords", "pressures", "times", "color", "size", "left", "top", "right",
+                 "bottom", "smooth", "tail", "flat", "params", "stable", "fitted", "current", "cache", "runs")
+    PRESSURE_LEVELS = 8  # Distinct widths a pressure stroke is drawn with
+    FLATNESS = 0.1  # Furthest the flattened curve strays from the true one, in logical pixels
+    TAIL_LIMIT = 16  # Input samples held back at most before one is kept
+
+    def __init__(self, color, size, stroke_id=None, layer=0):
+        self.id = stroke_id
+        self.layer = layer  # Id of the Layer the stroke is on
+        self.order = None  # Id of the stroke an erased piece was cut from, which keeps its place in the stack
+        self.holes = None  # Tuple of (x, y, radius) circles the eraser cut out of the stroke while it was baked
+        self.coords = array("f")
+        self.pressures = None  # array("f") of 0-1 pressures, tablet strokes only
+        self.times = None  # array("f") of scene-clock seconds per sample, recorded strokes only
+        self.color = color
+        self.size = size
+        self.left = self.top = self.right = self.bottom = 0
+        self.smooth = True  # Whether samples are joined by curves rather than straight segments
+        self.tail = None  # (x, y, pressure, time) input held back by extend(), None once finished
+        self.flat = None  # array("f") of the flattened curve, built from coords on demand
+        self.params = None  # array("f") of the sample position of every flattened point
+        self.stable = 0  # Flattened points no later sample changes
+        self.fitted = 0  # Samples whose curves those points cover
+        self.current = False  # Whether flat reaches the end of the stroke as it is now
+        self.cache = None  # QPolygonF of the flattened curve, dropped on change
+        self.runs = None  # (QPolygonF, width factor) runs built from pressures, dropped on change
+
+    def __len__(self):
+        return len(self.coords) // 2
+
+    def append(self, point, min_distance=0, pressure=None, timestamp=None):
+        """Adds a sample, growing the buffer and the bounds
+
+        Samples closer than min_distance to the previous one are dropped;
+        returns whether the sample was kept.
+        """
+        x, y = point.x(), point.y()
+        if self.coords and min_distance > 0:
+            dx, dy = x - self.coords[-2], y - self.coords[-1]
+            if dx * dx + dy * dy < min_distance * min_distance:
+                return False
+        if not self.coords:
+            self.left = self.right = x
+            self.top = self.bottom = y
+        else:
+            self.include(x, y)
+        if pressure is not None and self.pressures is None:
+            self.pressures = array("f", [1.0]) * len(self)  # Samples taken before the pen reported pressure
+        if self.pressures is not None:
+            self.pressures.append(1.0 if pressure is None else pressure)
+        if timestamp is not None and self.times is None:
+            self.times = array("f", [timestamp]) * len(self)
+        if self.times is not None:
+            self.times.append(self.times[-1] if timestamp is None else timestamp)
+        self.coords.append(x)
+        self.coords.append(y)
+        self.current = False
+        self.cache = self.runs = None
+        return True
+
+    def include(self, x, y):
+        """Grows the bounds to a point"""
+        self.left = min(self.left, x)
+        self.right = max(self.right, x)
+        self.top = min(self.top, y)
+        self.bottom = max(self.bottom, y)
+
+    def extend(self, point, min_distance, tolerance, pressure=None, timestamp=None):
+        """Adds a live input sample, fitting it to the tail of the stroke
+
+        The sample is held back while the input since the last kept
+        sample lies within tolerance of the chord to it; once the input
+        strays, or the pressure width changes, the sample before is
+        kept. Returns the logical rect whose drawing changed, or None if
+        the sample was dropped for being within min_distance.
+        """
+        x, y = point.x(), point.y()
+        if not self.coords:
+            self.append(point, 0, pressure, timestamp)
+            self.tail = []
+            return self.bounds()
+        coords, tail = self.coords, self.tail
+        end = tail[-1] if tail else (coords[-2], coords[-1])
+        dx, dy = x - end[0], y - end[1]
+        if dx * dx + dy * dy < min_distance * min_distance:
+            return None
+
+        # Only the curves around the last two kept samples and the end can change
+        xs, ys = [x, end[0]] + list(coords[-4::2]), [y, end[1]] + list(coords[-3::2])
+        tail.append((x, y, pressure, timestamp))
+        if len(tail) > 1 and not self.fits(tolerance):
+            kept = tail[-2]
+            self.append(QPointF(kept[0], kept[1]), 0, kept[2], kept[3])
+            del tail[:-1]
+        self.include(x, y)
+        self.current = False
+        self.cache = self.runs = None
+        return QRect(QPoint(math.floor(min(xs)), math.floor(min(ys))), QPoint(math.ceil(max(xs)), math.ceil(max(ys))))
+
+    def level(self, pressure):
+        """Quantized width level of a pressure, None standing for full pressure"""
+        return max(1, round((1.0 if pressure is None else pressure) * self.PRESSURE_LEVELS))
+
+    def fits(self, tolerance):
+        """Whether the held-back samples stay within tolerance of the chord to the newest one"""
+        tail = self.tail
+        if len(tail) > self.TAIL_LIMIT:
+            return False
+        ax, ay = self.coords[-2], self.coords[-1]
+        bx, by = tail[-1][0] - ax, tail[-1][1] - ay
+        length = bx * bx + by * by
+        limit = tolerance * tolerance
+        level = self.level(self.pressures[-1] if self.pressures is not None else None)
+        for x, y, pressure, _ in tail:
+            if self.level(pressure) != level:
+                return False
+            px, py = x - ax, y - ay
+            # Squared distance to the chord, past its ends to the end points
+            t = min(1.0, max(0.0, (px * bx + py * by) / length)) if length else 0.0
+            ex, ey = px - t * bx, py - t * by
+            if ex * ex + ey * ey > limit:
+                return False
+        return True
+
+    def finish(self):
+        """Keeps the last held-back sample and stops fitting input"""
+        if self.tail:
+            x, y, pressure, timestamp = self.tail[-1]
+            self.append(QPointF(x, y), 0, pressure, timestamp)
+        self.tail = None
+
+    def curve(self):
+        """Returns the drawn curve flattened: interleaved x, y and each point's sample position
+
+        Samples are joined by quadratic curves from the midpoint before
+        each sample to the midpoint after it, the sample being the
+        control point; the ends run straight to the first and last
+        sample. A curve is flattened into as few points as keep it within
+        FLATNESS, and the curves whose three samples are all kept are
+        never flattened again.
+        """
+        if self.current:
+            return self.flat, self.params
+        if not self.smooth:
+            self.flat, self.params = self.coords, array("f", range(len(self)))
+            self.current = True
+            return self.flat, self.params
+        if self.flat is None:
+            self.flat, self.params = array("f"), array("f")
+            self.stable = self.fitted = 0
+        coords, flat, params = self.coords, self.flat, self.params
+        count = len(coords) // 2
+        del flat[2 * self.stable:]
+        del params[self.stable:]
+        if count and not params:
+            flat.extend(coords[:2])
+            params.append(0.0)
+        for i in range(self.fitted + 1, count - 1):
+            self.flatten(i, coords[2 * i + 2], coords[2 * i + 3])
+        self.fitted = max(self.fitted, count - 2)
+        self.stable = len(params)
+
+        if self.tail:
+            x, y = self.tail[-1][:2]
+            if count > 1:
+                self.flatten(count - 1, x, y)
+            flat.append(x)
+            flat.append(y)
+            params.append(count - 1)
+        elif count > 1:
+            flat.extend(coords[-2:])
+            params.append(count - 1)
+        self.current = True
+        return flat, params
+
+    def flatten(self, i, next_x, next_y):
+        """Appends the flattened curve bent by sample i towards the point after it"""
+        coords = self.coords
+        cx, cy = coords[2 * i], coords[2 * i + 1]
+        if i == 1:
+            sx, sy, start = coords[0], coords[1], 0.0
+        else:
+            sx, sy, start = (coords[2 * i - 2] + cx) / 2, (coords[2 * i - 1] + cy) / 2, i - 0.5
+        ex, ey = (cx + next_x) / 2, (cy + next_y) / 2
+        # A quadratic strays at most a quarter of its second difference from its chord
+        # and n equal steps cut that by n squared
+        bend = math.hypot(sx - 2 * cx + ex, sy - 2 * cy + ey) / 4
+        steps = min(16, max(1, math.ceil(math.sqrt(bend / self.FLATNESS))))
+        flat, params = self.flat, self.params
+        for step in range(1, steps + 1):
+            t = step / steps
+            s = 1 - t
+            flat.append(s * s * sx + 2 * s * t * cx + t * t * ex)
+            flat.append(s * s * sy + 2 * s * t * cy + t * t * ey)
+            params.append(start + t * (i + 0.5 - start))
+
+    @staticmethod
+    def sample_at(values, position):
+        """A per-sample value interpolated at a fractional sample position"""
+        index = min(int(position), len(values) - 1)
+        if index + 1 == len(values):
+            return values[index]
+        return values[index] + (position - index) * (values[index + 1] - values[index])
+
+    def flattened(self):
+        """Copy of the stroke with a sample at every point of its drawn curve, to cut up"""
+        coords, params = self.curve()
+        copy = Stroke(self.color, self.size, self.id, self.layer)
+        copy.coords = array("f", coords)
+        copy.smooth = False
+        copy.holes = self.holes
+        if self.pressures is not None:
+            copy.pressures = array("f", (self.sample_at(self.pressures, u) for u in params))
+        if self.times is not None:
+            copy.times = array("f", (self.sample_at(self.times, u) for u in params))
+        copy.update_bounds()
+        return copy
+
+    def erase(self, cx, cy, radius):
+        """Cuts a circle out of the drawn curve
+
+        Returns None if the circle misses the stroke, otherwise the id-less
+        strokes left on either side of every span it covers (possibly none).
+        The pieces take their samples from the flattened curve; cut ends
+        are placed where segments cross the circle, pressures and sample
+        times interpolated.
+        """
+        spans = segment_spans(self.curve()[0], cx, cy, radius)
+        if not spans:
+            return None
+        flat = self.flattened() if self.smooth else self
+        pieces = []
+        head = None  # Crossing point the current piece starts at
+        first = 0  # First sample not yet kept or erased
+        for index, t0, t1 in spans:
+            pieces.append(flat.piece(head, first, index + 1, flat.point_at(index, t0) if t0 > 0 else None))
+            head = flat.point_at(index, t1) if t1 < 1 else None
+            first = index + 1 if t1 < 1 else index + 2
+        pieces.append(flat.piece(head, first, len(flat), None))
+        return [piece for piece in pieces if len(piece) > 1]
+
+    def point_at(self, index, t):
+        """Sample interpolated t of the way along segment index, as (x, y, pressure, time)"""
+        coords = self.coords
+        x0, y0 = coords[2 * index], coords[2 * index + 1]
+        x = x0 + t * (coords[2 * index + 2] - x0)
+        y = y0 + t * (coords[2 * index + 3] - y0)
+        pressure = timestamp = None
+        if self.pressures is not None:
+            p0 = self.pressures[index]
+            pressure = p0 + t * (self.pressures[index + 1] - p0)
+        if self.times is not None:
+            t0 = self.times[index]
+            timestamp = t0 + t * (self.times[index + 1] - t0)
+        return x, y, pressure, timestamp
+
+    def piece(self, head, first, last, tail):
+        """New stroke of samples first..last-1 between optional crossing points"""
+        piece = Stroke(self.color, self.size, layer=self.layer)
+        piece.smooth = self.smooth
+        piece.holes = self.holes
+        piece.coords = array("f", head[:2] if head else ())
+        piece.coords.extend(self.coords[2 * first:2 * last])
+        if tail:
+            piece.coords.extend(tail[:2])
+        if self.pressures is not None:
+            piece.pressures = array("f", head[2:3] if head else ())
+            piece.pressures.extend(self.pressures[first:last])
+            if tail:
+                piece.pressures.append(tail[2])
+        if self.times is not None:
+            piece.times = array("f", head[3:] if head else ())
+            piece.times.extend(self.times[first:last])
+            if tail:
+                piece.times.append(tail[3])
+        piece.update_bounds()
+        return piece
+
+    def update_bounds(self):
+        """Recomputes the bounds after the buffer was replaced wholesale"""
+        if self.coords:
+            xs, ys = self.coords[0::2], self.coords[1::2]
+            self.left, self.right = min(xs), max(xs)
+            self.top, self.bottom = min(ys), max(ys)
+        self.flat = self.params = None
+        self.current = False
+        self.cache = self.runs = None
+
+    def bounds(self):
+        """Bounding rect of the samples, which the curve never leaves"""
+        return QRect(QPoint(math.floor(self.left), math.floor(self.top)),
+                     QPoint(math.ceil(self.right), math.ceil(self.bottom)))
+
+    @staticmethod
+    def to_polygon(coords):
+        """Builds a QPolygonF from interleaved float coordinates with a single memcpy"""
+        doubles = array("d", coords)
+        polygon = QPolygonF(len(doubles) // 2)
+        if doubles:
+            data = polygon.data()
+            data.setsize(len(doubles) * doubles.itemsize)
+            memoryview(data).cast("B")[:] = memoryview(doubles).cast("B")
+        return polygon
+
+    def polygon(self):
+        """Returns the flattened curve as a cached QPolygonF"""
+        if self.cache is None:
+            self.cache = self.to_polygon(self.curve()[0])
+        return self.cache
+
+    def width_runs(self):
+        """Returns cached (QPolygonF, width factor) runs of equal quantized pressure
+
+        Pressures are interpolated along the flattened curve. Each segment
+        takes the pressure of its end point; neighbouring runs share their
+        joining point so the outline stays continuous.
+        """
+        if self.runs is None:
+            coords, params = self.curve()
+            levels = self.PRESSURE_LEVELS
+            quantized = [max(1, round(self.sample_at(self.pressures, u) * levels)) for u in params]
+            runs = []
+            first = 0
+            for i in range(1, len(quantized) + 1):
+                if i == len(quantized) or (i > 1 and quantized[i] != quantized[i - 1]):
+                    last = max(i - 1, first)
+                    runs.append((self.to_polygon(coords[2 * first:2 * last + 2]),
+                                 quantized[last] / levels))
+                    first = last
+            self.runs = runs
+        return self.runs
+
+class Shape:
+    """Straight line, rectangle or circle between two points"""
+    __slots__ = ("id", "layer", "order", "holes", "kind", "start", "end", "color", "size")
+
+    def __init__(self, kind, start, end, color, size, shape_id=None, layer=0):
+        self.id = shape_id
+        self.layer = layer  # Id of the Layer the shape is on
+        self.order = None  # Shapes are never cut, so they stack by id
+        self.holes = None  # Tuple of (x, y, radius) circles the eraser cut out of the shape while it was baked
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.color = color
+        self.size = size
+
+    def __len__(self):
+        return 2  # Points stored, as counted against the scene's budget
+
+    def bounds(self):
+        """Bounding rect of the two corner points"""
+        return QRect(self.start, self.end).normalized()
+
+    def outline(self, steps=64):
+        """The drawn outline as an interleaved x, y buffer, circles as a polygon"""
+        if self.kind == "line":
+            return array("i", (self.start.x(), self.start.y(), self.end.x(), self.end.y()))
+        rect = self.bounds()
+        left, top, right, bottom = rect.left(), rect.top(), rect.right(), rect.bottom()
+        if self.kind == "rect":
+            return array("i", (left, top, right, top, right, bottom, left, bottom, left, top))
+        cx, cy = (left + right) / 2, (top + bottom) / 2
+        rx, ry = (right - left) / 2, (bottom - top) / 2
+        outline = array("i")
+        for i in range(steps + 1):
+            angle = 2 * math.pi * i / steps
+            outline.append(round(cx + rx * math.cos(angle)))
+            outline.append(round(cy + ry * math.sin(angle)))
+        return outline
+
+class SpatialGrid:
+    """Uniform grid index of item bounding boxes for fast hit-testing"""
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.cells = {}  # (column, row) -> {id: item}
+        self.entries = {}  # id -> (item, cells, rect)
+
+    def cells_for(self, rect):
+        """Returns the grid cells overlapped by a rect"""
+        left = rect.left() // self.cell_size
+        right = rect.right() // self.cell_size
+        top = rect.top() // self.cell_size
+        bottom = rect.bottom() // self.cell_size
+        return [(column, row) for column in range(left, right + 1) for row in range(top, bottom + 1)]
+
+    def insert(self, item, rect):
+        """Registers an item under its bounding rect"""
+        key = id(item)
+        cells = self.cells_for(rect)
+        for cell in cells:
+            self.cells.setdefault(cell, {})[key] = item
+        self.entries[key] = (item, cells, QRect(rect))
+
+    def remove(self, item):
+        """Drops an item from the index"""
+        entry = self.entries.pop(id(item), None)
+        if entry is None:
+            return
+        for cell in entry[1]:
+            bucket = self.cells.get(cell)
+            if bucket is not None:
+                bucket.pop(id(item), None)
+                if not bucket:
+                    del self.cells[cell]
+
+    def query(self, rect):
+        """Returns the items whose bounding rect overlaps a rect"""
+        found = {}
+        for cell in self.cells_for(rect):
+            bucket = self.cells.get(cell)
+            if bucket:
+                found.update(bucket)
+        # Cells are coarse, so candidates are culled by their cached bounds
+        entries = self.entries
+        return [item for key, item in found.items() if entries[key][2].intersects(rect)]
+
+    def clear(self):
+        """Empties the index"""
+        self.cells.clear()
+        self.entries.clear()
+
+class EditCommand:
+    """Reversible edit: the items it added and the items it removed
+
+    Edits that change the baked raster also keep the raster tiles they
+    touch, as (before, after) images keyed by tile; None is an empty tile.
+    Eraser steps over the raster also keep the holes they cut, as
+    (item, (x, y, radius)) for every baked item a circle reaches, so the
+    cut survives in the journal, where the items are vectors.
+    """
+    __slots__ = ("added", "removed", "tiles", "holes")
+
+    def __init__(self, added=(), removed=(), tiles=None, holes=None):
+        self.added = list(added)
+        self.removed = list(removed)
+        self.tiles = tiles or {}
+        self.holes = holes or []
+
+class UndoStack:
+    """Bounded undo history with a redo branch"""
+    def __init__(self, depth=100):
+        self.undo_commands = deque(maxlen=depth)
+        self.redo_commands = []
+
+    def __bool__(self):
+        return bool(self.undo_commands)
+
+    def push(self, command):
+        """Records a new command, discarding anything that could be redone"""
+        self.undo_commands.append(command)
+        self.redo_commands.clear()
+
+    def undo(self, revert):
+        """Reverts the last command with revert(command) and returns it, or None
+
+        The command only moves to the redo branch once revert returns, so
+        a revert that raises leaves the history as it was.
+        """
+        if not self.undo_commands:
+            return None
+        command = self.undo_commands[-1]
+        revert(command)
+        self.redo_commands.append(self.undo_commands.pop())
+        return command
+
+    def redo(self, apply):
+        """Re-applies the last undone command with apply(command) and returns it, or None"""
+        if not self.redo_commands:
+            return None
+        command = self.redo_commands[-1]
+        apply(command)
+        self.undo_commands.append(self.redo_commands.pop())
+        return command
+
+    def clear(self):
+        """Forgets all history"""
+        self.undo_commands.clear()
+        self.redo_commands.clear()
+
+class Layer:
+    """A named stack level of a Scene, drawn above the layers before it
+
+    Hidden layers are not drawn and locked layers cannot be drawn on or
+    erased; neither affects undo. Items baked on the layer live in its
+    own raster.
+    """
+    __slots__ = ("id", "name", "visible", "locked", "baked")
+
+    def __init__(self, layer_id, name, visible=True, locked=False):
+        self.id = layer_id
+        self.name = name
+        self.visible = visible
+        self.locked = locked
+        self.baked = TileCache()  # Baked items of the layer, in unzoomed logical coordinates
+
+    def editable(self):
+        """Whether drawing and erasing may change the layer"""
+        return self.visible and not self.locked
+
+class Scene:
+    """Drawing model: strokes, shapes, their spatial index, history and zoom
+
+    Items are drawn in the order of their layers, bottom first, and in
+    the order they were created within a layer.
+    
+    With a point budget, the oldest items can be baked: flattened into
+    their layer's logical-space raster (drawn by SceneRenderer.bake) with
+    their vector data released. Baked items keep their id, colour and
+    bounds, and undo reaches them through the raster tiles stored on
+    commands, keyed by (layer id, tile key). Erasing the raster also
+    cuts holes into the baked items it reaches; vector items with holes,
+    as replayed from a journal, are drawn clipped around them.
+    """
+    def __init__(self, history_depth=100, point_budget=None):
+        self.lines = {}  # Stroke id -> Stroke
+        self.shapes = {}  # Shape id -> Shape
+        self.line_index = SpatialGrid()
+        self.shape_index = SpatialGrid()
+        self.history = UndoStack(history_depth)
+        self.item_ids = itertools.count(1)
+        self.zoom = 1.0
+        self.listeners = []  # Notified of commit/undo/redo, e.g. a SessionJournal
+        self.point_budget = point_budget  # Vector points kept before old items are baked, None for no limit
+        self.points = 0  # Vector points currently in the scene
+        self.layers = [Layer(0, "Layer 1")]  # Bottom to top
+        self.layer_ids = itertools.count(1)
+        self.baked_items = {}  # Id -> baked item currently in the scene
+        self.baked_index = SpatialGrid()  # Baked items under the rect their pixels can reach
+        self.baked_ids = set()  # Ids of every item ever baked; their vectors are gone
+        self.baked_changes = set()  # (layer id, tile key) of raster tiles changed since the renderer last looked
+        self.epoch = time.perf_counter()  # Start of the scene clock
+
+    def clock(self):
+        """Seconds since the scene started, the time base of recorded samples"""
+        return time.perf_counter() - self.epoch
+
+    def next_id(self):
+        """Returns a fresh stable item id"""
+        return next(self.item_ids)
+
+    def items(self):
+        """All strokes and shapes currently in the scene, baked ones included"""
+        return list(self.lines.values()) + list(self.shapes.values()) + list(self.baked_items.values())
+
+    def item(self, item_id):
+        """The stroke or shape with the given id currently in the scene"""
+        for items in (self.lines, self.shapes, self.baked_items):
+            if item_id in items:
+                return items[item_id]
+        raise KeyError(item_id)
+
+    def add_items(self, items):
+        """Puts strokes and shapes into the scene"""
+        for item in items:
+            if item.id in self.baked_ids:
+                self.baked_items[item.id] = item  # Its pixels come back with the command's tiles
+                self.baked_index.insert(item, self.reach(item))
+            elif isinstance(item, Stroke):
+                self.lines[item.id] = item
+                self.line_index.insert(item, item.bounds())
+                self.points += len(item)
+            else:
+                self.shapes[item.id] = item
+                self.shape_index.insert(item, item.bounds())
+                self.points += len(item)
+
+    def remove_items(self, items):
+        """Takes strokes and shapes out of the scene"""
+        for item in items:
+            if item.id in self.baked_ids:
+                del self.baked_items[item.id]
+                self.baked_index.remove(item)
+            elif isinstance(item, Stroke):
+                del self.lines[item.id]
+                self.line_index.remove(item)
+                self.points -= len(item)
+            else:
+                del self.shapes[item.id]
+                self.shape_index.remove(item)
+                self.points -= len(item)
+
+    @staticmethod
+    def add_holes(holes):
+        """Cuts (item, (x, y, radius)) holes into their items"""
+        for item, hole in holes:
+            item.holes = (item.holes or ()) + (hole,)
+
+    @staticmethod
+    def remove_holes(holes):
+        """Takes back holes cut by add_holes"""
+        for item, hole in reversed(holes):
+            kept = list(item.holes)
+            del kept[len(kept) - 1 - kept[::-1].index(hole)]
+            item.holes = tuple(kept) or None
+
+    def restore_tiles(self, command, state):
+        """Puts the raster tiles of a command back to their before (0) or after (1) state"""
+        for (layer_id, key), states in command.tiles.items():
+            tiles = self.layer(layer_id).baked.tiles
+            if states[state] is None:
+                tiles.pop(key, None)
+            else:
+                tiles[key] = states[state]
+            self.baked_changes.add((layer_id, key))
+
+    def commit(self, command):
+        """Applies a new command and records it for undo"""
+        self.apply(command)
+        self.record(command)
+
+    def apply(self, command):
+        """Makes the changes of a command"""
+        self.remove_items(command.removed)
+        self.add_items(command.added)
+        self.restore_tiles(command, 1)
+        self.add_holes(command.holes)
+
+    def revert(self, command):
+        """Takes back the changes of a command"""
+        self.remove_items(command.added)
+        self.add_items(command.removed)
+        self.restore_tiles(command, 0)
+        self.remove_holes(command.holes)
+
+    def record(self, command):
+        """Records a command whose changes were already applied"""
+        self.history.push(command)
+        for listener in self.listeners:
+            listener.on_commit(command)
+
+    def undo(self):
+        """Reverts the last command and returns the items it touched"""
+        command = self.history.undo(self.revert)
+        if command is None:
+            return []
+        for listener in self.listeners:
+            listener.on_undo()
+        return command.added + command.removed + [item for item, hole in command.holes]
+
+    def redo(self):
+        """Re-applies the last undone command and returns the items it touched"""
+        command = self.history.redo(self.apply)
+        if command is None:
+            return []
+        for listener in self.listeners:
+            listener.on_redo()
+        return command.added + command.removed + [item for item, hole in command.holes]
+
+    def erase(self, point, radius, layer_id=0):
+        """Erases a circle from one layer and returns the applied, unrecorded command
+
+        Strokes are split around the circle; shapes whose outline it
+        touches are removed whole. Baked items are erased from the raster
+        and get the circle as a hole.
+        """
+        area = QRect(point.x() - radius, point.y() - radius, 2 * radius + 1, 2 * radius + 1)
+        px, py = point.x(), point.y()
+        command = EditCommand()
+        for line in self.line_index.query(area):
+            if line.layer != layer_id:
+                continue
+            pieces = line.erase(px, py, radius)
+            if pieces is None:
+                continue
+            command.removed.append(line)
+            for piece in pieces:
+                piece.id = self.next_id()
+                piece.order = line.id if line.order is None else line.order
+                command.added.append(piece)
+        command.removed.extend(shape for shape in self.shape_index.query(area)
+                               if shape.layer == layer_id and segment_spans(shape.outline(), px, py, radius))
+        self.remove_items(command.removed)
+        self.add_items(command.added)
+        
+        if self.cut_baked(layer_id, px, py, radius, command.tiles):
+            hole = (px, py, radius)
+            command.holes = [(item, hole) for item in self.baked_index.query(area) if item.layer == layer_id]
+            self.add_holes(command.holes)
+        return command
+
+    def cut_baked(self, layer_id, x, y, radius, tiles):
+        """Erases a circle from one layer's raster and returns whether any tile changed
+
+        The changed tiles go into tiles as command tile states; a tile
+        already there keeps its before state, and one the command empties
+        is left alone.
+        """
+        baked = self.layer(layer_id).baked
+        area = QRectF(x - radius, y - radius, 2 * radius + 1, 2 * radius + 1).toAlignedRect()
+        changed = False
+        for key in baked.keys_for(area):
+            tile = baked.tiles.get(key)
+            if tile is None:
+                continue
+            before, after = tiles.get((layer_id, key), (tile, tile))
+            if after is None:
+                continue
+            # Painting the copy detaches it, so the tile kept for undo is untouched
+            erased = QImage(tile)
+            painter = QPainter(erased)
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.setCompositionMode(QPainter.CompositionMode_Clear)
+            painter.translate(-baked.tile_rect(key).topLeft())
+            painter.setPen(Qt.NoPen)
+            painter.setBrush(Qt.black)
+            painter.drawEllipse(QPointF(x, y), radius, radius)
+            painter.end()
+            tiles[(layer_id, key)] = (before, erased)
+            baked.tiles[key] = erased
+            self.baked_changes.add((layer_id, key))
+            changed = True
+        return changed
+
+    def over_budget(self):
+        """Oldest vector items to bake to bring the points down to 3/4 of the budget
+
+        Nothing is baked while there is a redo branch, whose tile states
+        baking would not update, nor are items with holes an undoable
+        command cut, which baking would draw into the tile states from
+        before the cut.
+        """
+        if self.point_budget is None or self.points <= self.point_budget or self.history.redo_commands:
+            return []
+        cut = {item.id for command in self.history.undo_commands for item, hole in command.holes}
+        excess = self.points - self.point_budget * 3 // 4
+        oldest = []
+        for item in sorted(itertools.chain(self.lines.values(), self.shapes.values()), key=self.stacking):
+            if excess <= 0:
+                break
+            if item.id in cut:
+                continue
+            oldest.append(item)
+            excess -= len(item)
+        return oldest
+
+    def release(self, item):
+        """Swaps an item that was just drawn into the raster for its bare record"""
+        self.remove_items([item])
+        self.baked_ids.add(item.id)
+        self.baked_items[item.id] = item
+        self.baked_index.insert(item, self.reach(item))
+        if isinstance(item, Stroke):
+            # Bounds stay valid, so the item can still be located for repaints
+            item.coords = array("f")
+            item.pressures = item.times = None
+            item.flat = item.params = None
+            item.current = False
+            item.cache = item.runs = None
+
+    def orphaned_tiles(self, removed):
+        """Raster tiles that no baked item reaches once the given ones are removed
+
+        Returned as command tile states, (tile, None), so a command taking
+        baked items out of the scene can take their pixels along too.
+        """
+        ids = {item.id for item in removed if item.id in self.baked_items}
+        keys = set()
+        for item_id in ids:
+            item = self.baked_items[item_id]
+            keys.update((item.layer, key) for key in self.layer(item.layer).baked.keys_for(self.reach(item)))
+        for item in self.baked_items.values():
+            if keys and item.id not in ids:
+                keys.difference_update((item.layer, key)
+                                       for key in self.layer(item.layer).baked.keys_for(self.reach(item)))
+        tiles = {}
+        for layer_id, key in keys:
+            tile = self.layer(layer_id).baked.tiles.get(key)
+            if tile is not None:
+                tiles[(layer_id, key)] = (tile, None)
+        return tiles
+
+    @staticmethod
+    def reach(item):
+        """Logical rect an item's pixels can cover, its pen included"""
+        return QRect(item.bounds()).adjusted(-item.size - 2, -item.size - 2, item.size + 2, item.size + 2)
+
+    def items_in(self, rect, layer_id):
+        """Strokes and shapes of one layer near a logical rect, in drawing order"""
+        items = [line for line in self.line_index.query(rect) if line.layer == layer_id]
+        items.extend(shape for shape in self.shape_index.query(rect) if shape.layer == layer_id)
+        return sorted(items, key=self.stacking)
+
+    @staticmethod
+    def stacking(item):
+        """Sort key of an item's place in the drawing order
+
+        Items stack by id, except that the pieces an eraser leaves of a
+        stroke take the stroke's place rather than going on top.
+        """
+        return (item.id if item.order is None else item.order, item.id)
+
+    def layer(self, layer_id):
+        """The layer with the given id"""
+        for layer in self.layers:
+            if layer.id == layer_id:
+                return layer
+        raise KeyError(layer_id)
+
+    def add_layer(self, name=None):
+        """Puts a new empty layer on top and returns it"""
+        layer_id = next(self.layer_ids)
+        layer = Layer(layer_id, name or f"Layer {layer_id + 1}")
+        self.layers.append(layer)
+        self.layers_changed()
+        return layer
+
+    def move_layer(self, layer_id, offset):
+        """Moves a layer up (positive offset) or down the stack; returns whether it moved"""
+        layer = self.layer(layer_id)
+        index = self.layers.index(layer)
+        position = max(0, min(len(self.layers) - 1, index + offset))
+        if position == index:
+            return False
+        self.layers.insert(position, self.layers.pop(index))
+        self.layers_changed()
+        return True
+
+    def set_layer_state(self, layer_id, visible=None, locked=None):
+        """Shows or hides, locks or unlocks a layer"""
+        layer = self.layer(layer_id)
+        if visible is not None:
+            layer.visible = visible
+        if locked is not None:
+            layer.locked = locked
+        self.layers_changed()
+
+    def update_layers(self, states):
+        """Sets the layer stack from (id, name, visible, locked) tuples, keeping existing layers' rasters"""
+        existing = {layer.id: layer for layer in self.layers}
+        layers = []
+        for layer_id, name, visible, locked in states:
+            layer = existing.get(layer_id) or Layer(layer_id, name)
+            layer.name, layer.visible, layer.locked = name, visible, locked
+            layers.append(layer)
+        self.layers = layers
+        self.layer_ids = itertools.count(max(layer.id for layer in layers) + 1)
+
+    def layers_changed(self):
+        for listener in self.listeners:
+            listener.on_layers(self.layers)
+
+    def baked_memory(self):
+        """Bytes held by the baked rasters of all layers"""
+        return sum(layer.baked.memory() for layer in self.layers)
+
+    def reset(self):
+        """Drops every item and all history"""
+        self.lines.clear()
+        self.shapes.clear()
+        self.line_index.clear()
+        self.shape_index.clear()
+        self.history.clear()
+        self.zoom = 1.0
+        self.points = 0
+        self.layers = [Layer(0, "Layer 1")]
+        self.layer_ids = itertools.count(1)
+        self.baked_items.clear()
+        self.baked_index.clear()
+        self.baked_changes.clear()
+        self.epoch = time.perf_counter()
+
+class TileCache:
+    """Fixed-size screen-space image tiles, allocated only where something is drawn"""
+    def __init__(self, tile_size=256):
+        self.tile_size = tile_size
+        self.device_pixel_ratio = 1.0  # Tiles hold tile_size * ratio device pixels a side
+        self.tiles = {}  # (column, row) -> QImage
+
+    def keys_for(self, rect):
+        """Returns the tiles overlapped by a screen rect"""
+        if rect.isEmpty():
+            return []
+        size = self.tile_size
+        return [(column, row)
+                for row in range(rect.top() // size, rect.bottom() // size + 1)
+                for column in range(rect.left() // size, rect.right() // size + 1)]
+
+    def tile_rect(self, key):
+        """Screen rect covered by a tile"""
+        return QRect(key[0] * self.tile_size, key[1] * self.tile_size, self.tile_size, self.tile_size)
+
+    def align(self, rect):
+        """Grows a screen rect outwards to whole tiles"""
+        size = self.tile_size
+        left, top = rect.left() // size * size, rect.top() // size * size
+        right, bottom = (rect.right() // size + 1) * size, (rect.bottom() // size + 1) * size
+        return QRect(left, top, right - left, bottom - top)
+
+    def pixel_rect(self, rect):
+        """Maps a screen rect to device pixels"""
+        ratio = self.device_pixel_ratio
+        return QRect(round(rect.x() * ratio), round(rect.y() * ratio),
+                     round(rect.width() * ratio), round(rect.height() * ratio))
+
+    def new_image(self, size):
+        """Allocates an empty image covering a screen size at the device pixel ratio"""
+        image = QImage(self.pixel_rect(QRect(QPoint(0, 0), size)).size(), QImage.Format_ARGB32_Premultiplied)
+        image.setDevicePixelRatio(self.device_pixel_ratio)
+        image.fill(Qt.transparent)
+        return image
+
+    def new_tile(self):
+        """Allocates an empty tile"""
+        return self.new_image(QSize(self.tile_size, self.tile_size))
+
+    def cut(self, image, origin, key):
+        """Copies one tile out of an image whose top-left is at a screen position"""
+        tile = image.copy(self.pixel_rect(self.tile_rect(key).translated(-origin.x(), -origin.y())))
+        tile.setDevicePixelRatio(self.device_pixel_ratio)
+        return tile
+
+    def draw(self, painter, rect):
+        """Draws the allocated tiles overlapping a screen rect"""
+        for key in self.keys_for(rect):
+            tile = self.tiles.get(key)
+            if tile is not None:
+                painter.drawImage(key[0] * self.tile_size, key[1] * self.tile_size, tile)
+
+    def memory(self):
+        """Bytes held by allocated tiles"""
+        return sum(tile.bytesPerLine() * tile.height() for tile in self.tiles.values())
+
+    def clear(self):
+        """Frees every tile"""
+        self.tiles.clear()
+
+class SceneRenderer:
+    """Draws a Scene into cached screen-space tiles and composites frames
+
+    Works on QImage only, so it runs without a window (e.g. under
+    QT_QPA_PLATFORM=offscreen) for exports and benchmarks. Annotation
+    tiles exist only where something is drawn, so memory follows the
+    annotated area rather than the size of the desktop.
+    
+    Every layer of the scene is cached in tiles of its own. Frames are
+    composited from those caches, so showing, hiding or reordering a
+    layer re-renders nothing, and an edit re-renders only its own layer.
+    """
+    def __init__(self, scene, max_pen_size=25, tile_size=256):
+        self.scene = scene
+        self.max_pen_size = max_pen_size
+        self.size = QSize()
+        self.tile_size = tile_size
+        self.device_pixel_ratio = 1.0
+        self.layers = {}  # Layer id -> TileCache of its committed strokes and shapes
+        self.layer_zoom = None  # Zoom the layers were rendered at
+        self.background_tiles = TileCache(tile_size)  # Background pre-scaled to the current zoom
+        self.background_key = None
+
+    def resize(self, size, device_pixel_ratio=1.0):
+        """Sets the screen size and pixel ratio and re-renders the layer to match"""
+        self.size = QSize(size)
+        if device_pixel_ratio != self.device_pixel_ratio:
+            self.release()
+            self.device_pixel_ratio = device_pixel_ratio
+            self.background_tiles.device_pixel_ratio = device_pixel_ratio
+        self.rebuild()
+
+    def release(self):
+        """Frees the cached layers and background tiles"""
+        self.layers.clear()
+        self.layer_zoom = None
+        self.background_tiles.clear()
+        self.background_key = None
+
+    def memory(self):
+        """Bytes held by cached tiles and the baked rasters"""
+        layers = sum(cache.memory() for cache in self.layers.values())
+        return layers + self.background_tiles.memory() + self.scene.baked_memory()
+
+    def is_stale(self):
+        """Whether the layers were rendered at another zoom level"""
+        return self.layer_zoom != self.scene.zoom
+
+    def cache(self, layer_id):
+        """Tile cache of one layer, created empty on first use"""
+        cache = self.layers.get(layer_id)
+        if cache is None:
+            cache = self.layers[layer_id] = TileCache(self.tile_size)
+            cache.device_pixel_ratio = self.device_pixel_ratio
+        return cache
+
+    def screen_rect(self, rect, size):
+        """Maps a logical rect to the screen and inflates it by the pen size"""
+        zoom = self.scene.zoom
+        margin = size + 2
+        return QRect(
+            int(rect.left() * zoom) - margin,
+            int(rect.top() * zoom) - margin,
+            int(rect.width() * zoom) + 2 * margin,
+            int(rect.height() * zoom) + 2 * margin
+        )
+
+    def logical_rect(self, rect):
+        """Maps a screen rect back to unzoomed drawing coordinates"""
+        zoom = self.scene.zoom
+        return QRect(
+            int(rect.left() / zoom) - 1,
+            int(rect.top() / zoom) - 1,
+            int(rect.width() / zoom) + 3,
+            int(rect.height() / zoom) + 3
+        )
+
+    def segment_rect(self, start, end, size):
+        """Screen rect touched by a segment between two logical points"""
+        return self.screen_rect(QRect(start, end).normalized(), size)
+
+    def items_rect(self, items):
+        """Screen rect covered by strokes and shapes"""
+        dirty = QRect()
+        for item in items:
+            dirty = dirty.united(self.screen_rect(item.bounds(), item.size))
+        return dirty
+
+    def baked_rect(self):
+        """Screen rect of the raster tiles the scene changed since the last call"""
+        dirty = QRect()
+        for layer_id, key in self.scene.baked_changes:
+            dirty = dirty.united(self.screen_rect(self.scene.layer(layer_id).baked.tile_rect(key), 0))
+        self.scene.baked_changes.clear()
+        return dirty
+
+    def changed_region(self, items):
+        """Screen rect and layer ids changed by a commit, undo or redo touching items"""
+        layers = {item.layer for item in items} | {layer_id for layer_id, key in self.scene.baked_changes}
+        return self.items_rect(items).united(self.baked_rect()), layers
+
+    def draw_line(self, painter, line, zoom=None):
+        """Draws a freehand stroke"""
+        zoom = zoom or self.scene.zoom
+        if line.holes:
+            painter.save()
+            self.clip_holes(painter, line)
+        pen = QPen(line.color, line.size / zoom, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+        painter.setPen(pen)
+        painter.setOpacity(line.color.alpha() / 255.0)
+        
+        # The whole stroke is outlined and filled in one pass, so translucent
+        # strokes keep a uniform alpha where segments meet or cross
+        if line.pressures is not None:
+            for points, factor in line.width_runs():
+                pen.setWidthF(line.size * factor / zoom)
+                painter.setPen(pen)
+                if len(points) == 1:
+                    painter.drawPoint(points[0])
+                else:
+                    painter.drawPolyline(points)
+        else:
+            points = line.polygon()
+            if len(points) == 1:
+                painter.drawPoint(points[0])
+            else:
+                painter.drawPolyline(points)
+        painter.setOpacity(1.0)
+        if line.holes:
+            painter.restore()
+
+    def draw_shape(self, painter, shape, zoom=None):
+        """Draws a line, rectangle or circle"""
+        zoom = zoom or self.scene.zoom
+        if shape.holes:
+            painter.save()
+            self.clip_holes(painter, shape)
+        pen = QPen(shape.color, shape.size / zoom, Qt.SolidLine, Qt.RoundCap)
+        painter.setPen(pen)
+        painter.setOpacity(1.0)
+        
+        if shape.kind == "line":
+            painter.drawLine(shape.start, shape.end)
+        elif shape.kind == "rect":
+            painter.drawRect(QRect(shape.start, shape.end))
+        elif shape.kind == "circle":
+            painter.drawEllipse(shape.bounds())
+        if shape.holes:
+            painter.restore()
+
+    @staticmethod
+    def clip_holes(painter, item):
+        """Narrows the painter's clip to the part of an item the eraser left"""
+        # One subtraction of all the holes at once, however many a long drag cut
+        holes = QPainterPath()
+        holes.setFillRule(Qt.WindingFill)
+        for x, y, radius in item.holes:
+            holes.addEllipse(QPointF(x, y), radius, radius)
+        path = QPainterPath()
+        path.addRect(QRectF(Scene.reach(item)))
+        painter.setClipPath(path.subtracted(holes), Qt.IntersectClip)
+
+    def redraw_tiles(self, rect, items, layer_id, keep=False):
+        """Renders items of one layer over whole tiles and stores the tiles they touch
+
+        Each item is drawn once into a scratch image spanning the dirty
+        tiles, which is then cut into tiles. With keep, the existing tiles
+        are kept underneath; otherwise tiles no item reaches are freed.
+        """
+        layer = self.cache(layer_id)
+        rect = layer.align(rect).intersected(layer.align(QRect(QPoint(0, 0), self.size)))
+        if rect.isEmpty():
+            return
+        keys = layer.keys_for(rect)
+        baked = self.scene.layer(layer_id).baked
+        if not items and not keep and not any(key in baked.tiles for key in baked.keys_for(self.logical_rect(rect))):
+            # Nothing left to draw here
+            for key in keys:
+                layer.tiles.pop(key, None)
+            return
+        touched = {key for key in keys if key in layer.tiles} if keep else set()
+        scratch = layer.new_image(rect.size())
+        painter = QPainter(scratch)
+        painter.translate(-rect.x(), -rect.y())
+        for key in touched:
+            layer.draw(painter, layer.tile_rect(key))
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.scale(self.scene.zoom, self.scene.zoom)
+        if not keep and baked.tiles:
+            # Baked items lie under every vector item, scaled like the background
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+            area = self.logical_rect(rect)
+            baked.draw(painter, area)
+            for key in baked.keys_for(area):
+                if key in baked.tiles:
+                    touched.update(layer.keys_for(self.screen_rect(baked.tile_rect(key), 0).intersected(rect)))
+        for item in items:
+            if isinstance(item, Stroke):
+                self.draw_line(painter, item)
+            else:
+                self.draw_shape(painter, item)
+            touched.update(layer.keys_for(self.screen_rect(item.bounds(), item.size).intersected(rect)))
+        painter.end()
+        
+        for key in keys:
+            if key in touched:
+                layer.tiles[key] = layer.cut(scratch, rect.topLeft(), key)
+            else:
+                layer.tiles.pop(key, None)
+
+    def commit(self, item):
+        """Flattens a finished stroke or shape into its layer's cache"""
+        if self.is_stale():
+            self.rebuild()
+            return
+        self.redraw_tiles(self.items_rect([item]), [item], item.layer, keep=True)
+
+    def rebuild(self, rect=None, layers=None):
+        """Re-renders the layer caches, or only the tiles under a screen rect
+
+        layers limits a partial update to the given layer ids; the other
+        layers' caches are left as they are.
+        """
+        if self.size.isEmpty():
+            return
+        if self.is_stale():
+            rect = layers = None  # A partial update needs the rest of the layers at this zoom too
+        if rect is None:
+            rect = QRect(QPoint(0, 0), self.size)
+            if layers is None:
+                self.layers.clear()
+                self.layer_zoom = self.scene.zoom
+        
+        # Skip items that cannot reach the region
+        margin = int(self.max_pen_size / self.scene.zoom) + 1
+        for layer in self.scene.layers:
+            if layers is None or layer.id in layers:
+                aligned = self.cache(layer.id).align(rect)
+                area = self.logical_rect(aligned).adjusted(-margin, -margin, margin, margin)
+                self.redraw_tiles(aligned, self.scene.items_in(area, layer.id), layer.id)
+
+    def bake(self, items):
+        """Draws items into the scene's raster and releases their vectors
+
+        Undo keeps working across the bake: every tile state stored on the
+        history in which an item exists gets it drawn in, and the command
+        that added the item gets the tile states from just before and
+        after it, so undoing that command takes the item out again.
+        Baking does not change what is on screen, so the layer caches are kept.
+        """
+        scene = self.scene
+        commands = list(scene.history.undo_commands)
+        origins = {item.id: index for index, command in enumerate(commands) for item in command.added}
+        for item in sorted(items, key=Scene.stacking):
+            baked = scene.layer(item.layer).baked
+            if not baked.tiles:
+                baked.device_pixel_ratio = self.device_pixel_ratio
+            origin = origins.get(item.id)
+            newer = commands if origin is None else commands[origin + 1:]
+            for tile_key in baked.keys_for(scene.reach(item)):
+                key = (item.layer, tile_key)  # Command tiles are keyed by layer too
+                patched = {}  # Data key of a stored tile state -> the same state with the item in
+                
+                def patch(tile):
+                    data = None if tile is None else tile.cacheKey()
+                    if data not in patched:
+                        image = baked.new_tile() if tile is None else QImage(tile)
+                        self.draw_baked(image, tile_key, item)
+                        patched[data] = image
+                    return patched[data]
+                
+                current = baked.tiles.get(tile_key)
+                if origin is not None:
+                    command = commands[origin]
+                    if key not in command.tiles:
+                        # The tile as it was when the item was added: the first
+                        # state a later command kept, or else the current one
+                        before = next((later.tiles[key][0] for later in newer if key in later.tiles), current)
+                        command.tiles[key] = (before, before)
+                    before, after = command.tiles[key]
+                    command.tiles[key] = (before, patch(after))
+                for later in newer:
+                    if key in later.tiles:
+                        before, after = later.tiles[key]
+                        later.tiles[key] = (patch(before), patch(after))
+                baked.tiles[tile_key] = patch(current)
+            scene.release(item)
+
+    def draw_baked(self, image, key, item):
+        """Draws an unzoomed item into one raster tile"""
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.translate(-self.scene.layer(item.layer).baked.tile_rect(key).topLeft())
+        if isinstance(item, Stroke):
+            self.draw_line(painter, item, 1.0)
+        else:
+            self.draw_shape(painter, item, 1.0)
+        painter.end()
+
+    def bake_over_budget(self):
+        """Bakes the oldest items once the scene holds more points than its budget"""
+        items = self.scene.over_budget()
+        if items:
+            self.bake(items)
+
+    def blit_background(self, painter, background, source):
+        """Draws a logical rect of the background at its logical position
+
+        Images and pixmaps are addressed in device pixels through their
+        pixel ratio, so HiDPI captures stay sharp and aligned; a
+        ScreenCapture draws its screens itself.
+        """
+        if isinstance(background, ScreenCapture):
+            background.draw(painter, source)
+            return
+        ratio = background.devicePixelRatio()
+        source = source.intersected(QRect(0, 0, int(background.width() / ratio), int(background.height() / ratio)))
+        if source.isEmpty():
+            return
+        pixels = QRectF(source.x() * ratio, source.y() * ratio, source.width() * ratio, source.height() * ratio)
+        if isinstance(background, QImage):
+            painter.drawImage(QRectF(source), background, pixels)
+        else:
+            painter.drawPixmap(QRectF(source), background, pixels)
+
+    def draw_background(self, painter, background, rect):
+        """Draws the part of the background behind a screen rect"""
+        painter.save()
+        painter.scale(self.scene.zoom, self.scene.zoom)
+        self.blit_background(painter, background, self.logical_rect(rect))
+        painter.restore()
+
+    def paint_background(self, painter, background, rect):
+        """Draws the background behind a screen rect from tiles scaled to the current zoom
+
+        Tiles are scaled once per zoom level, when first painted; a zoom
+        change evicts them. At 1.0x the background is drawn directly.
+        """
+        if self.scene.zoom == 1.0:
+            self.draw_background(painter, background, rect)
+            return
+        key = (background.cacheKey(), self.scene.zoom)
+        if self.background_key != key:
+            self.background_tiles.clear()
+            self.background_key = key
+        
+        tiles = self.background_tiles
+        for tile_key in tiles.keys_for(rect):
+            if tile_key not in tiles.tiles:
+                tile = tiles.new_tile()
+                tile_rect = tiles.tile_rect(tile_key)
+                tile_painter = QPainter(tile)
+                tile_painter.setRenderHint(QPainter.SmoothPixmapTransform)
+                tile_painter.translate(-tile_rect.x(), -tile_rect.y())
+                self.draw_background(tile_painter, background, tile_rect)
+                tile_painter.end()
+                tiles.tiles[tile_key] = tile
+        tiles.draw(painter, rect)
+
+    def invalidate_background(self, rect):
+        """Evicts the scaled background tiles behind a screen rect whose background changed"""
+        for key in self.background_tiles.keys_for(rect):
+            self.background_tiles.tiles.pop(key, None)
+
+    def paint(self, painter, rect, background=None, live_items=()):
+        """Composites background, cached layer and live items into one screen rect"""
+        zoom = self.scene.zoom
+        painter.setClipRect(rect)
+        
+        if background is not None:
+            self.paint_background(painter, background, rect)
+        
+        for layer in self.scene.layers:
+            if not layer.visible:
+                continue
+            # Committed strokes and shapes; layers from another zoom level
+            # are stretched as a preview until they are rebuilt
+            cache = self.layers.get(layer.id)
+            if cache is not None and not self.is_stale():
+                cache.draw(painter, rect)
+            elif cache is not None and self.layer_zoom:
+                scale = zoom / self.layer_zoom
+                painter.save()
+                painter.scale(scale, scale)
+                cache.draw(painter, QRectF(rect.x() / scale, rect.y() / scale,
+                                           rect.width() / scale, rect.height() / scale).toAlignedRect())
+                painter.restore()
+            
+            # Live stroke and shape preview, in its own layer
+            live = [item for item in live_items if item.layer == layer.id]
+            if live:
+                painter.save()
+                painter.scale(zoom, zoom)
+                for item in live:
+                    if isinstance(item, Stroke):
+                        self.draw_line(painter, item)
+                    else:
+                        self.draw_shape(painter, item)
+                painter.restore()
+
+    def render_image(self, background=None, size=None, crop=None):
+        """Renders the unzoomed scene straight from its vectors into a new image
+
+        The image defaults to the background's native pixel size (or the
+        screen size without one); strokes are scaled to match it. With a
+        logical crop rect, only that part of the screen is rendered, at
+        the same scale.
+        """
+        if size is None:
+            size = self.size if background is None or background.isNull() else background.size()
+        # Logical drawing coordinates map onto the screen size
+        logical = size if self.size.isEmpty() else self.size
+        scale_x, scale_y = size.width() / logical.width(), size.height() / logical.height()
+        area = QRect(QPoint(0, 0), logical)
+        if crop is not None:
+            area = crop.intersected(area)
+            size = QSize(max(1, round(area.width() * scale_x)), max(1, round(area.height() * scale_y)))
+        image = QImage(size, QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.scale(scale_x, scale_y)
+        painter.translate(-area.x(), -area.y())
+        if background is not None:
+            self.blit_background(painter, background, area)
+        # Skip items that cannot reach the area
+        margin = self.max_pen_size + 1
+        reach = area.adjusted(-margin, -margin, margin, margin)
+        for layer in self.scene.layers:
+            if not layer.visible:
+                continue
+            layer.baked.draw(painter, area)
+            for item in self.scene.items_in(reach, layer.id):
+                if isinstance(item, Stroke):
+                    self.draw_line(painter, item, 1.0)
+                else:
+                    self.draw_shape(painter, item, 1.0)
+        painter.end()
+        return image
+
+def changed_tiles(old, new, tile_size=256):
+    """Device-pixel rects of the tiles that differ between two same-sized ARGB32 images"""
+    width, height = new.width(), new.height()
+    stride = new.bytesPerLine()
+    if numpy is not None:
+        old_pixels = old.constBits()
+        old_pixels.setsize(old.sizeInBytes())
+        new_pixels = new.constBits()
+        new_pixels.setsize(new.sizeInBytes())
+        old_rows = numpy.frombuffer(old_pixels, dtype=numpy.uint8).reshape(height, stride)
+        new_rows = numpy.frombuffer(new_pixels, dtype=numpy.uint8).reshape(height, stride)
+    else:
+        old_rows = old.constBits().asstring(old.sizeInBytes())
+        new_rows = new.constBits().asstring(new.sizeInBytes())
+    
+    changed = []
+    for top in range(0, height, tile_size):
+        bottom = min(top + tile_size, height)
+        for left in range(0, width, tile_size):
+            right = min(left + tile_size, width)
+            if numpy is not None:
+                differs = not numpy.array_equal(old_rows[top:bottom, left * 4:right * 4],
+                                                new_rows[top:bottom, left * 4:right * 4])
+            else:
+                differs = any(old_rows[row + left * 4:row + right * 4] != new_rows[row + left * 4:row + right * 4]
+                              for row in range(top * stride, bottom * stride, stride))
+            if differs:
+                changed.append(QRect(left, top, right - left, bottom - top))
+    return changed
+
+class ScreenCapture:
+    """The desktop behind the overlay, grabbed one QScreen at a time
+
+    Each screen is grabbed separately at its native device pixel ratio,
+    and only once something needs it. Rects are logical pixels relative
+    to the overlay window, so the capture lines up with the strokes on
+    every screen.
+    """
+    def __init__(self, screens, origin):
+        self.screens = [(screen, screen.geometry().translated(-origin.x(), -origin.y())) for screen in screens]
+        self.captures = {}  # screen index -> QPixmap or QImage at native resolution
+        self.pending = set()  # Screens being grabbed or converted
+        self.grabs = 0  # Bumped on every grab, for cacheKey()
+
+    def missing(self, rect):
+        """Indexes of the screens overlapping a rect that are neither grabbed nor pending"""
+        return [index for index, (_, geometry) in enumerate(self.screens)
+                if index not in self.captures and index not in self.pending and geometry.intersects(rect)]
+
+    def grab_pixmap(self, index):
+        """Grabs one screen; must run on the GUI thread"""
+        screen, geometry = self.screens[index]
+        pixmap = screen.grabWindow(0)
+        if not pixmap.isNull() and pixmap.width() != geometry.width():
+            pixmap.setDevicePixelRatio(pixmap.width() / geometry.width())
+        return pixmap
+
+    def store(self, index, capture):
+        """Keeps the grabbed image of one screen"""
+        self.captures[index] = capture
+        self.pending.discard(index)
+        self.grabs += 1
+
+    def patch(self, index, image, rects):
+        """Copies the changed device-pixel rects of a fresh grab over a stored screen
+
+        Returns the logical rects that changed. Without rects, e.g. after
+        a resolution change, the grab replaces the screen outright.
+        """
+        self.pending.discard(index)
+        stored = self.captures[index]
+        geometry = self.screens[index][1]
+        if rects is None or not isinstance(stored, QImage):
+            self.store(index, image)
+            return [geometry]
+        ratio = stored.devicePixelRatio()
+        painter = QPainter(stored)
+        painter.scale(1 / ratio, 1 / ratio)  # Device pixels
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        for rect in rects:
+            painter.drawImage(rect, image, rect)
+        painter.end()
+        return [QRectF(rect.x() / ratio, rect.y() / ratio, rect.width() / ratio, rect.height() / ratio)
+                .translated(geometry.topLeft()).toAlignedRect() for rect in rects]
+
+    def grab(self, rect):
+        """Grabs the screens overlapping a rect synchronously; True if any were missing"""
+        indexes = self.missing(rect)
+        for index in indexes:
+            self.store(index, self.grab_pixmap(index))
+        return bool(indexes)
+
+    def rect(self):
+        """Logical rect covered by all screens"""
+        bounds = QRect()
+        for _, geometry in self.screens:
+            bounds = bounds.united(geometry)
+        return bounds
+
+    def device_pixel_ratio(self):
+        """Highest pixel ratio among the grabbed screens"""
+        return max((pixmap.devicePixelRatio() for pixmap in self.captures.values()), default=1.0)
+
+    def size(self):
+        """Native pixel size of the whole capture"""
+        return self.rect().size() * self.device_pixel_ratio()
+
+    def isNull(self):
+        return not self.captures
+
+    def cacheKey(self):
+        """Changes whenever another screen is grabbed"""
+        return (id(self), self.grabs)
+
+    def draw(self, painter, source):
+        """Draws the grabbed screens within a logical source rect"""
+        for index, pixmap in self.captures.items():
+            geometry = self.screens[index][1]
+            part = geometry.intersected(source)
+            if part.isEmpty() or pixmap.isNull():
+                continue
+            ratio = pixmap.devicePixelRatio()
+            pixels = QRectF((part.x() - geometry.x()) * ratio, (part.y() - geometry.y()) * ratio,
+                            part.width() * ratio, part.height() * ratio)
+            if isinstance(pixmap, QImage):
+                painter.drawImage(QRectF(part), pixmap, pixels)
+            else:
+                painter.drawPixmap(QRectF(part), pixmap, pixels)
+
+    def toImage(self):
+        """Composes the grabbed screens into one image at the highest pixel ratio"""
+        image = QImage(self.size(), QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        ratio = self.device_pixel_ratio()
+        painter.scale(ratio, ratio)
+        painter.translate(-self.rect().x(), -self.rect().y())
+        self.draw(painter, self.rect())
+        painter.end()
+        return image
+
+class CaptureSignals(QObject):
+    """Completion notification of a CaptureTask"""
+    finished = pyqtSignal(int, QImage)
+
+class CaptureTask(QRunnable):
+    """Converts a screen grab to a paint-optimized QImage on a thread pool"""
+    def __init__(self, index, image):
+        super().__init__()
+        self.index = index
+        self.image = image
+        self.signals = CaptureSignals()
+
+    def run(self):
+        """Converts the grab to the format the renderer blends fastest"""
+        image = self.image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        self.signals.finished.emit(self.index, image)
+
+class RecaptureTask(CaptureTask):
+    """Converts a fresh grab of a screen captured before and finds the tiles that changed"""
+    def __init__(self, index, image, previous, tile_size=256):
+        super().__init__(index, image)
+        self.previous = previous
+        self.tile_size = tile_size
+        self.changed = None  # Device-pixel rects that differ, None if the screen size changed
+
+    def run(self):
+        """Converts the grab and compares it with the previous one"""
+        image = self.image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        previous = self.previous.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        if previous.size() == image.size():
+            self.changed = changed_tiles(previous, image, self.tile_size)
+        self.previous = None
+        self.signals.finished.emit(self.index, image)
+
+class ExportSignals(QObject):
+    """Progress and completion notifications of an ExportTask"""
+    progress = pyqtSignal(str, int)
+    finished = pyqtSignal(str)
+    failed = pyqtSignal(str, str)
+
+def save_png(image, file_name, compression=-1):
+    """Writes an image as PNG at a zlib level 0-9 (-1 for Qt's default), raising OSError on failure"""
+    # Qt's PNG writer derives its zlib level from the quality setting
+    quality = -1 if compression < 0 else 100 - min(compression, 9) * 11
+    if not image.save(file_name, "PNG", quality):
+        raise OSError("could not write the file")
+
+class ExportTask(QRunnable):
+    """Encodes a rendered image to PNG on a thread pool"""
+    def __init__(self, image, file_name, compression=-1):
+        super().__init__()
+        self.image = image
+        self.file_name = file_name
+        self.compression = compression  # zlib level 0-9, -1 for Qt's default
+        self.started = time.perf_counter()
+        self.signals = ExportSignals()
+
+    def run(self):
+        """Encodes and writes the image"""
+        try:
+            self.signals.progress.emit(self.file_name, 0)
+            save_png(self.image, self.file_name, self.compression)
+            self.signals.progress.emit(self.file_name, 100)
+            self.signals.finished.emit(self.file_name)
+        except Exception as e:
+            self.signals.failed.emit(self.file_name, str(e))
+
+class SessionJournal:
+    """Append-only binary log of a drawing session
+
+    Layout: a header (magic, version, screen size), the background as a
+    file reference or embedded PNG, then length-prefixed records. Stroke
+    and shape records define items; edit records list the item ids a
+    command added and removed; undo and redo records replay history.
+    With a clock, each edit, undo and redo is preceded by a time record,
+    and strokes are followed by the times of their samples. Layer records
+    snapshot the layer stack whenever it changes; items on any layer but
+    the first are followed by a placement record. Eraser steps that cut
+    into the baked raster are written as cut records ahead of their
+    command's edit record, naming the items the hole goes into.
+    """
+    MAGIC = b"SPNJ"
+    VERSION = 3  # 2 added float32 stroke records, 3 eraser holes; older files still load
+    HEADER = struct.Struct("<4sHII")  # magic, version, width, height
+    BACKGROUND = struct.Struct("<BI")  # background kind, data length
+    RECORD = struct.Struct("<IB")  # payload length, record type
+    STROKE = struct.Struct("<IIHI")  # id, rgba, pen size, point count
+    SHAPE = struct.Struct("<IBiiiiIH")  # id, kind, x1, y1, x2, y2, rgba, pen size
+    COUNT = struct.Struct("<I")
+    TIME = struct.Struct("<d")  # Scene-clock seconds
+    LAYER = struct.Struct("<IBH")  # id, flags, name length, followed by the UTF-8 name
+    PLACE = struct.Struct("<II")  # item id, layer id
+    ORDER = struct.Struct("<II")  # item id, id of the stroke it was cut from
+    HOLE = struct.Struct("<fff")  # x, y, radius of a circle the eraser cut out of baked items
+    LAYER_VISIBLE, LAYER_LOCKED = 1, 2
+
+    NO_BACKGROUND, BACKGROUND_REFERENCE, BACKGROUND_EMBEDDED = 0, 1, 2
+    STROKE_RECORD, SHAPE_RECORD, EDIT_RECORD, UNDO_RECORD, REDO_RECORD, CLOSE_RECORD = 1, 2, 3, 4, 5, 6
+    PRESSURE_RECORD = 7  # Stroke id and float32 pressures, right after a tablet stroke's record
+    TIME_RECORD = 8  # When the next edit, undo or redo happened
+    TIMES_RECORD = 9  # Stroke id and float32 sample times, right after a recorded stroke's record
+    LAYERS_RECORD = 10  # Layer count and the layers, bottom first
+    PLACE_RECORD = 11  # Item id and layer id, right after the record of an item not on layer 0
+    FLOAT_STROKE_RECORD = 15  # A stroke record with float32 samples; stroke records hold int32 ones
+    FLAT_STROKE_RECORD = 16  # A float32 stroke record of a piece drawn through its samples as they are
+    STROKE_RECORDS = {STROKE_RECORD, FLOAT_STROKE_RECORD, FLAT_STROKE_RECORD}
+    ORDER_RECORD = 17  # Item id and stacking id, right after the record of a piece an eraser cut from a stroke
+    HOLES_RECORD = 18  # Item id and its holes, right after the record of a piece cut from a stroke with holes
+    CUT_RECORD = 19  # A hole and the ids of the baked items it was cut into, before the edit record it belongs to
+    DEFINITION_RECORDS = STROKE_RECORDS | {SHAPE_RECORD, PRESSURE_RECORD, TIMES_RECORD, PLACE_RECORD, ORDER_RECORD,
+                                           HOLES_RECORD}
+    SHAPE_KINDS = ["line", "rect", "circle"]
+
+    def __init__(self, path, file, written=()):
+        self.path = path
+        self.file = file
+        self.written = set(written)  # Ids of items already defined in the file
+        self.edits = 0  # Edits, undos and redos written since the file was opened
+        self.pending = False  # Records buffered since the last flush
+        self.clock = None  # Scene.clock stamping the records, None for no time records
+
+    @classmethod
+    def create(cls, path, size, background_reference=None, background_data=None):
+        """Starts a new journal file"""
+        file = open(path, "wb", buffering=64 * 1024)
+        file.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, size.width(), size.height()))
+        if background_data is not None:
+            file.write(cls.BACKGROUND.pack(cls.BACKGROUND_EMBEDDED, len(background_data)))
+            file.write(background_data)
+        elif background_reference is not None:
+            reference = os.path.basename(background_reference).encode("utf-8")
+            file.write(cls.BACKGROUND.pack(cls.BACKGROUND_REFERENCE, len(reference)))
+            file.write(reference)
+        else:
+            file.write(cls.BACKGROUND.pack(cls.NO_BACKGROUND, 0))
+        return cls(path, file)
+
+    @classmethod
+    def resume(cls, path, session):
+        """Reopens a loaded journal for appending after its last complete record"""
+        file = open(path, "r+b", buffering=64 * 1024)
+        file.truncate(session.end)
+        # Records appended from now on may be newer than the file's version
+        file.seek(len(cls.MAGIC))
+        file.write(struct.pack("<H", cls.VERSION))
+        file.seek(session.end)
+        return cls(path, file, session.scene.lines.keys() | session.scene.shapes.keys())
+
+    def write_record(self, kind, payload=b""):
+        """Buffers one length-prefixed record"""
+        self.file.write(self.RECORD.pack(len(payload), kind))
+        if payload:
+            self.file.write(payload)
+        self.pending = True
+
+    def write_item(self, item):
+        """Buffers the definition of a stroke or shape"""
+        if isinstance(item, Stroke):
+            header = self.STROKE.pack(item.id, item.color.rgba(), item.size, len(item))
+            kind = self.FLOAT_STROKE_RECORD if item.smooth else self.FLAT_STROKE_RECORD
+            self.write_record(kind, header + item.coords.tobytes())
+            if item.pressures is not None:
+                self.write_record(self.PRESSURE_RECORD, self.COUNT.pack(item.id) + item.pressures.tobytes())
+            if item.times is not None:
+                self.write_record(self.TIMES_RECORD, self.COUNT.pack(item.id) + item.times.tobytes())
+        else:
+            self.write_record(self.SHAPE_RECORD, self.SHAPE.pack(
+                item.id, self.SHAPE_KINDS.index(item.kind),
+                item.start.x(), item.start.y(), item.end.x(), item.end.y(),
+                item.color.rgba(), item.size))
+        if item.layer:
+            self.write_record(self.PLACE_RECORD, self.PLACE.pack(item.id, item.layer))
+        if item.order is not None:
+            self.write_record(self.ORDER_RECORD, self.ORDER.pack(item.id, item.order))
+        if item.holes:
+            self.write_record(self.HOLES_RECORD, self.COUNT.pack(item.id)
+                              + b"".join(self.HOLE.pack(*hole) for hole in item.holes))
+        self.written.add(item.id)
+
+    def write_time(self):
+        """Buffers the current time of the clock, if there is one"""
+        if self.clock is not None:
+            self.write_record(self.TIME_RECORD, self.TIME.pack(self.clock()))
+
+    def on_commit(self, command):
+        """Records a new command, defining any items seen for the first time"""
+        self.write_time()
+        for item in command.added:
+            if item.id not in self.written:
+                self.write_item(item)
+        cuts = {}  # Hole -> ids of the items it was cut into
+        for item, hole in command.holes:
+            cuts.setdefault(hole, []).append(item.id)
+        for hole, ids in cuts.items():
+            self.write_record(self.CUT_RECORD, self.HOLE.pack(*hole) + struct.pack(f"<{len(ids)}I", *ids))
+        ids = [item.id for item in command.added] + [item.id for item in command.removed]
+        payload = struct.pack(f"<II{len(ids)}I", len(command.added), len(command.removed), *ids)
+        self.write_record(self.EDIT_RECORD, payload)
+        self.edits += 1
+
+    def on_undo(self):
+        self.write_time()
+        self.write_record(self.UNDO_RECORD)
+        self.edits += 1
+
+    def on_redo(self):
+        self.write_time()
+        self.write_record(self.REDO_RECORD)
+        self.edits += 1
+
+    def on_layers(self, layers):
+        """Records the layer stack as it is now"""
+        payload = [self.COUNT.pack(len(layers))]
+        for layer in layers:
+            name = layer.name.encode("utf-8")
+            flags = (self.LAYER_VISIBLE if layer.visible else 0) | (self.LAYER_LOCKED if layer.locked else 0)
+            payload.append(self.LAYER.pack(layer.id, flags, len(name)) + name)
+        self.write_record(self.LAYERS_RECORD, b"".join(payload))
+
+    def flush(self):
+        """Pushes buffered records to disk"""
+        if self.pending:
+            self.file.flush()
+            self.pending = False
+
+    def close(self):
+        """Marks the session as cleanly finished and closes the file"""
+        self.write_record(self.CLOSE_RECORD)
+        self.file.close()
+
+    @classmethod
+    def is_closed(cls, path):
+        """Whether a journal ends with a close record (False after a crash)"""
+        try:
+            with open(path, "rb") as file:
+                file.seek(-cls.RECORD.size, os.SEEK_END)
+                return file.read() == cls.RECORD.pack(0, cls.CLOSE_RECORD)
+        except OSError:
+            return False
+
+    @classmethod
+    def has_edits(cls, path):
+        """Whether a journal records any edit; files that cannot be read count as having some"""
+        try:
+            with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if cls.HEADER.unpack_from(data, 0)[0] != cls.MAGIC:
+                    return True
+                # The background is skipped rather than decoded
+                length = cls.BACKGROUND.unpack_from(data, cls.HEADER.size)[1]
+                offset = cls.HEADER.size + cls.BACKGROUND.size + length
+                return any(record == cls.EDIT_RECORD for record, _, _ in cls.records(data, offset))
+        except (OSError, ValueError, struct.error):
+            return True
+
+    @classmethod
+    def prune(cls, directory, keep=None):
+        """Deletes finished sessions without edits, then all but the newest keep, with their backgrounds
+
+        Sessions are named by the time they started, so the newest sort
+        last. Background PNGs whose journal is gone are deleted as well.
+        """
+        names = sorted(os.listdir(directory))
+        journals = [name for name in names if name.endswith(".spj")]
+        doomed = [name for name in journals
+                  if cls.is_closed(os.path.join(directory, name))
+                  and not cls.has_edits(os.path.join(directory, name))]
+        kept = [name for name in journals if name not in doomed]
+        if keep is not None and len(kept) > keep:
+            doomed.extend(kept[:len(kept) - keep])
+        doomed = {name[:-4] for name in doomed}
+        journals = {name[:-4] for name in journals}
+        for name in names:
+            stem, extension = os.path.splitext(name)
+            orphaned = extension == ".png" and stem not in journals
+            if orphaned or (extension in (".spj", ".png") and stem in doomed):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+    @classmethod
+    def read_header(cls, data, path):
+        """Parses the header and background; returns (size, background, offset of the first record)"""
+        magic, version, width, height = cls.HEADER.unpack_from(data, 0)
+        if magic != cls.MAGIC or version > cls.VERSION:
+            raise ValueError(f"{path} is not a supported session file")
+        offset = cls.HEADER.size
+        kind, length = cls.BACKGROUND.unpack_from(data, offset)
+        offset += cls.BACKGROUND.size
+        background = None
+        if kind == cls.BACKGROUND_EMBEDDED:
+            background = QImage.fromData(data[offset:offset + length], "PNG")
+        elif kind == cls.BACKGROUND_REFERENCE:
+            background = QImage(cls.background_path(data, path))
+        return QSize(width, height), background, offset + length
+
+    @classmethod
+    def background_path(cls, data, path):
+        """Path of the PNG the background refers to, or None if it is embedded or there is none"""
+        kind, length = cls.BACKGROUND.unpack_from(data, cls.HEADER.size)
+        if kind != cls.BACKGROUND_REFERENCE:
+            return None
+        start = cls.HEADER.size + cls.BACKGROUND.size
+        return os.path.join(os.path.dirname(path), data[start:start + length].decode("utf-8"))
+
+    @classmethod
+    def records(cls, data, offset):
+        """Yields (record type, payload offset, payload length) up to a torn write at the end"""
+        size = len(data)
+        while offset + cls.RECORD.size <= size:
+            length, record = cls.RECORD.unpack_from(data, offset)
+            start = offset + cls.RECORD.size
+            if start + length > size:
+                return  # Torn write at the end of a crashed session
+            yield record, start, length
+            offset = start + length
+
+    @classmethod
+    def read_definition(cls, record, data, start, length, items):
+        """Adds the item a stroke or shape record defines to items, or the samples that follow one"""
+        if record in cls.STROKE_RECORDS:
+            item_id, rgba, pen_size, count = cls.STROKE.unpack_from(data, start)
+            item = Stroke(QColor.fromRgba(rgba), pen_size, item_id)
+            coords_start = start + cls.STROKE.size
+            coords = data[coords_start:coords_start + count * 8]
+            if record == cls.STROKE_RECORD:
+                samples = array("i")  # Journals from before sub-pixel samples, drawn as the polylines they were
+                samples.frombytes(coords)
+                item.coords = array("f", samples)
+            else:
+                item.coords.frombytes(coords)
+            item.smooth = record == cls.FLOAT_STROKE_RECORD
+            item.update_bounds()
+            items[item_id] = item
+        elif record == cls.SHAPE_RECORD:
+            item_id, kind, x1, y1, x2, y2, rgba, pen_size = cls.SHAPE.unpack_from(data, start)
+            items[item_id] = Shape(cls.SHAPE_KINDS[kind], QPoint(x1, y1), QPoint(x2, y2),
+                                   QColor.fromRgba(rgba), pen_size, item_id)
+        elif record == cls.PLACE_RECORD:
+            item_id, layer_id = cls.PLACE.unpack_from(data, start)
+            items[item_id].layer = layer_id
+        elif record == cls.ORDER_RECORD:
+            item_id, order = cls.ORDER.unpack_from(data, start)
+            items[item_id].order = order
+        elif record == cls.HOLES_RECORD:
+            count = (length - cls.COUNT.size) // cls.HOLE.size
+            items[cls.COUNT.unpack_from(data, start)[0]].holes = tuple(
+                cls.HOLE.unpack_from(data, start + cls.COUNT.size + i * cls.HOLE.size) for i in range(count))
+        else:
+            samples = array("f")
+            samples.frombytes(data[start + cls.COUNT.size:start + length])
+            item = items[cls.COUNT.unpack_from(data, start)[0]]
+            if record == cls.PRESSURE_RECORD:
+                item.pressures = samples
+            else:
+                item.times = samples
 
-class CompactButton(QPushButton):
-    """Compact icon button class"""
-    def __init__(self, icon, tooltip_text, color="#3498db", parent=None):
-        super().__init__(parent)
-        self.setText(icon)
-        self.setToolTip(tooltip_text)
-        self.base_color = color
-        self.setFixedSize(50, 50)  # Increased button size
-        self.setFont(QFont("Segoe UI Emoji", 16))
-        self.setup_style()
-        
-    def setup_style(self):
-        """Sets up button style"""
-        style = f"""
-            CompactButton {{
-                background: qlineargradient(x1:0, y1:0, x2:0, y2:1,
-                    stop:0 {self.base_color}, stop:1 {self.darken_color(self.base_color)});
-                border: none;
-                border-radius: 25px;
-                color: white;
-                font-weight: bold;
-                margin: 5px;  /* Increased margin */
-            }}
-            CompactButton:hover {{
-                background: qlineargradient(x1:0, y1:0, x2:0, y2:1,
-                    stop:0 {self.lighten_color(self.base_color)}, 
-                    stop:1 {self.base_color});
-                transform: scale(1.1);
-            }}
-            CompactButton:pressed {{
-                background: {self.darken_color(self.base_color)};
-                transform: scale(0.95);
-            }}
-            CompactButton:checked {{
-                background: {self.lighten_color(self.base_color)};
-                border: 2px solid white;
-            }}
-            QToolTip {{
-                background-color: #2c3e50;
-                color: white;
-                border: 1px solid #34495e;
-                border-radius: 8px;
-                padding: 5px;
-                font: 11px 'Segoe UI';
-            }}
+    @classmethod
+    def read_layers(cls, data, start):
+        """(id, name, visible, locked) of every layer in a layers record, bottom first"""
+        count, = cls.COUNT.unpack_from(data, start)
+        offset = start + cls.COUNT.size
+        layers = []
+        for _ in range(count):
+            layer_id, flags, length = cls.LAYER.unpack_from(data, offset)
+            offset += cls.LAYER.size
+            name = bytes(data[offset:offset + length]).decode("utf-8")
+            offset += length
+            layers.append((layer_id, name, bool(flags & cls.LAYER_VISIBLE), bool(flags & cls.LAYER_LOCKED)))
+        return layers
+
+    @staticmethod
+    def read_edit(data, start):
+        """Ids an edit record's command added and removed"""
+        added, removed = struct.unpack_from("<II", data, start)
+        ids = struct.unpack_from(f"<{added + removed}I", data, start + 8)
+        return ids[:added], ids[added:]
+
+    @classmethod
+    def read_cut(cls, data, start, length):
+        """The hole a cut record cuts and the ids of the items it goes into"""
+        hole = cls.HOLE.unpack_from(data, start)
+        count = (length - cls.HOLE.size) // 4
+        return hole, struct.unpack_from(f"<{count}I", data, start + cls.HOLE.size)
+
+    @classmethod
+    def load(cls, path, history_depth=100):
+        """Memory-maps a journal and replays it into a Scene, undo history included
+
+        Raises ValueError for a file that refers to items it never defined
+        or otherwise does not replay.
         """
-        self.setStyleSheet(style)
-    
-    def darken_color(self, color):
-        """Darkens the color"""
-        c = QColor(color)
-        return f"rgb({max(0, c.red()-30)}, {max(0, c.green()-30)}, {max(0, c.blue()-30)})"
-    
-    def lighten_color(self, color):
-        """Lightens the color"""
-        c = QColor(color)
-        return f"rgb({min(255, c.red()+30)}, {min(255, c.green()+30)}, {min(255, c.blue()+30)})"
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size, background, offset = cls.read_header(data, path)
+            try:
+                session = cls.replay(data, offset, size, background, history_depth)
+            except (KeyError, IndexError) as e:
+                raise ValueError(f"{path} is corrupt") from e
+            session.background_path = cls.background_path(data, path)
+            return session
 
-class ColorButton(QToolButton):
-    """Compact button for color selection"""
-    def __init__(self, color, parent=None):
-        super().__init__(parent)
-        self.color = color
-        self.setFixedSize(32, 32)  # Increased color button size
-        self.setToolTip(f"Color: {color.name()}")
-        self.setup_style()
-        
-    def setup_style(self):
-        color_str = f"rgb({self.color.red()}, {self.color.green()}, {self.color.blue()})"
-        style = f"""
-            ColorButton {{
-                background-color: {color_str};
-                border: 2px solid #34495e;
-                border-radius: 16px;
-                margin: 4px;  /* Increased margin */
-            }}
-            ColorButton:hover {{
-                border: 3px solid #3498db;
-                transform: scale(1.15);
-            }}
-            ColorButton:pressed {{
-                border: 3px solid #2980b9;
-            }}
-            QToolTip {{
-                background-color: #2c3e50;
-                color: white;
-                border: 1px solid #34495e;
-                border-radius: 8px;
-                padding: 5px;
-                font: 11px 'Segoe UI';
-            }}
+    @classmethod
+    def replay(cls, data, offset, size, background, history_depth):
+        """Replays the records after the header into a Scene"""
+        first = offset
+        scene = Scene(history_depth)
+        items = {}
+        cuts = []  # (hole, ids) of the next edit
+        closed = False
+        end = offset
+        stamp = None
+        for record, start, length in cls.records(data, offset):
+            if record in cls.DEFINITION_RECORDS:
+                cls.read_definition(record, data, start, length, items)
+            elif record == cls.CUT_RECORD:
+                cuts.append(cls.read_cut(data, start, length))
+            elif record == cls.TIME_RECORD:
+                stamp = cls.TIME.unpack_from(data, start)[0]
+            elif record == cls.LAYERS_RECORD:
+                scene.update_layers(cls.read_layers(data, start))
+            elif record == cls.EDIT_RECORD:
+                added, removed = cls.read_edit(data, start)
+                holes = [(scene.item(i), hole) for hole, ids in cuts for i in ids]
+                cuts = []
+                scene.commit(EditCommand([items[i] for i in added], [items[i] for i in removed], holes=holes))
+            elif record == cls.UNDO_RECORD:
+                scene.undo()
+            elif record == cls.REDO_RECORD:
+                scene.redo()
+            elif record == cls.CLOSE_RECORD:
+                closed = True
+                break
+            end = start + length
+
+        if items:
+            scene.item_ids = itertools.count(max(items) + 1)
+        if stamp is not None:
+            scene.epoch -= stamp  # The clock carries on from the last recorded event
+        return LoadedSession(scene, background, size, first, end, closed)
+
+class LoadedSession:
+    """Result of SessionJournal.load"""
+    __slots__ = ("scene", "background", "background_path", "size", "start", "end", "closed")
+
+    def __init__(self, scene, background, size, start, end, closed):
+        self.scene = scene
+        self.background = background
+        self.background_path = None  # PNG the background was loaded from, None if it was embedded or absent
+        self.size = size
+        self.start = start  # Offset of the first record
+        self.end = end  # Offset just past the last complete record
+        self.closed = closed
+
+class HeadlessCanvas:
+    """A scene rendered into a QImage without a window, kept up to date edit by edit
+
+    Edits re-render only the region they changed, and the oldest items
+    are baked once the scene goes over its point budget.
+    """
+    def __init__(self, history_depth=100, point_budget=100000):
+        self.history_depth = history_depth
+        self.point_budget = point_budget
+        self.scene = None
+        self.renderer = None
+        self.background = None
+        self.canvas = None  # Current frame
+
+    def start(self, size, background=None):
+        """Starts over with an empty scene on a blank canvas"""
+        self.scene = Scene(self.history_depth, self.point_budget)
+        self.renderer = SceneRenderer(self.scene)
+        self.renderer.resize(size)
+        self.background = None
+        if background is not None and not background.isNull():
+            self.background = background.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+            self.background.setDevicePixelRatio(background.width() / size.width())
+        if self.canvas is None or self.canvas.size() != size:
+            self.canvas = QImage(size, QImage.Format_ARGB32_Premultiplied)
+        self.repaint(self.canvas.rect())
+
+    def draw_piece(self, piece):
+        """Paints part of a growing stroke onto the canvas"""
+        painter = QPainter(self.canvas)
+        painter.setRenderHint(QPainter.Antialiasing)
+        self.renderer.draw_line(painter, piece, 1.0)
+        painter.end()
+
+    def edit(self, added, removed, holes=()):
+        """Applies an edit record, baking the oldest items once over the point budget
+
+        holes are (item, (x, y, radius)) from the cut records before it;
+        items already baked here have the circle erased from the raster.
         """
-        self.setStyleSheet(style)
+        tiles = self.scene.orphaned_tiles(removed)
+        for layer_id, (x, y, radius) in {(item.layer, hole) for item, hole in holes
+                                         if item.id in self.scene.baked_items}:
+            self.scene.cut_baked(layer_id, x, y, radius, tiles)
+        self.scene.commit(EditCommand(added, removed, tiles, list(holes)))
+        dirty, layers = self.renderer.changed_region(added + removed + [item for item, hole in holes])
+        if removed or holes:
+            self.refresh(dirty, layers)
+        else:
+            for item in added:
+                self.renderer.commit(item)
+            self.repaint(dirty)
+        self.renderer.bake_over_budget()
 
-class CompactSlider(QSlider):
-    """Compact slider"""
-    def __init__(self, orientation, parent=None):
-        super().__init__(orientation, parent)
-        self.setFixedWidth(120)
-        self.setup_style()
-    
-    def setup_style(self):
-        style = """
-            QSlider::groove:horizontal {
-                background: #34495e;
-                height: 6px;
-                border-radius: 3px;
-                margin: 2px 0;
-            }
-            QSlider::handle:horizontal {
-                background: #3498db;
-                width: 16px;
-                height: 16px;
-                border-radius: 8px;
-                margin: -5px 0;
-            }
-            QSlider::handle:horizontal:hover {
-                background: #5dade2;
-                transform: scale(1.2);
-            }
+    def undo(self):
+        self.refresh(*self.renderer.changed_region(self.scene.undo()))
+
+    def redo(self):
+        self.refresh(*self.renderer.changed_region(self.scene.redo()))
+
+    def update_layers(self, layers):
+        """Applies a layers record; layers only change how the caches are composited"""
+        self.scene.update_layers(layers)
+        self.repaint(self.canvas.rect())
+
+    def refresh(self, dirty, layers):
+        """Re-renders some layers under a rect and puts them on the canvas"""
+        if not dirty.isEmpty():
+            self.renderer.rebuild(dirty, layers)
+            self.repaint(dirty)
+
+    def repaint(self, rect, live_items=()):
+        """Composites background, layers and uncommitted items into a rect of the canvas"""
+        painter = QPainter(self.canvas)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.fillRect(rect, Qt.transparent)
+        painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        self.renderer.paint(painter, rect, self.background, live_items)
+        painter.end()
+
+class TimelinePlayer(HeadlessCanvas):
+    """Replays a session journal the way it was drawn, frame by frame
+
+    Records are streamed from the memory-mapped journal. Strokes grow
+    sample by sample on their recorded times and each frame only paints
+    the segments added since the last one; other edits, undo and redo
+    re-render just the region they changed. Pauses are cut to max_idle
+    seconds. The scene is kept under a point budget and the journal is
+    never read into memory, so memory stays flat however long the
+    recording is.
+    """
+    def __init__(self, path, fps=30, speed=1.0, max_idle=1.0, point_budget=100000):
+        super().__init__(point_budget=point_budget)
+        self.path = path
+        self.step = speed / fps  # Recording seconds per frame
+        self.max_idle = max_idle
+        self.clock = None  # Recording time of the next frame
+
+    def frames(self):
+        """Yields the canvas once per frame
+
+        The same QImage is yielded every time and painted over afterwards;
+        its cacheKey() only changes when a frame differs from the last.
         """
-        self.setStyleSheet(style)
+        with open(self.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size, background, offset = SessionJournal.read_header(data, self.path)
+            self.start(size, background)
+            self.clock = None
+            
+            items = {}  # Items defined but not yet added by an edit
+            cuts = []  # (hole, ids) of the next edit
+            stamp = None
+            for record, start, length in SessionJournal.records(data, offset):
+                if record in SessionJournal.DEFINITION_RECORDS:
+                    SessionJournal.read_definition(record, data, start, length, items)
+                    continue
+                if record == SessionJournal.CUT_RECORD:
+                    cuts.append(SessionJournal.read_cut(data, start, length))
+                    continue
+                if record == SessionJournal.TIME_RECORD:
+                    stamp = SessionJournal.TIME.unpack_from(data, start)[0]
+                    continue
+                if record == SessionJournal.LAYERS_RECORD:
+                    self.update_layers(SessionJournal.read_layers(data, start))
+                    continue
+                if record == SessionJournal.CLOSE_RECORD:
+                    break
+                if record not in (SessionJournal.EDIT_RECORD, SessionJournal.UNDO_RECORD, SessionJournal.REDO_RECORD):
+                    continue
+                # Journals without time records get one frame per event
+                when = stamp if stamp is not None else (self.clock or 0.0) + self.step
+                stamp = None
+                if record == SessionJournal.EDIT_RECORD:
+                    added, removed = SessionJournal.read_edit(data, start)
+                    added = [items.pop(i) if i in items else self.scene.item(i) for i in added]
+                    removed = [self.scene.item(i) for i in removed]
+                    holes = [(self.scene.item(i), hole) for hole, ids in cuts for i in ids]
+                    cuts = []
+                    if not removed:
+                        for item in added:
+                            if isinstance(item, Stroke) and item.times is not None:
+                                yield from self.grow(item)
+                    yield from self.advance(when)
+                    self.edit(added, removed, holes)
+                else:
+                    yield from self.advance(when)
+                    if record == SessionJournal.UNDO_RECORD:
+                        self.undo()
+                    else:
+                        self.redo()
+            yield self.canvas
 
-class CompactPanel(QFrame):
-    """Compact left panel"""
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.setFrameStyle(QFrame.NoFrame)
-        self.setFixedWidth(80)  # Increased panel width
-        self.setup_style()
-        
-    def setup_style(self):
-        """Sets up panel style"""
-        style = """
-            CompactPanel {
-                background: qlineargradient(x1:0, y1:0, x2:1, y2:0,
-                    stop:0 rgba(44, 62, 80, 0.95), 
-                    stop:1 rgba(52, 73, 94, 0.85));
-                border: 1px solid rgba(255, 255, 255, 0.1);
-                border-radius: 15px;
-                padding: 15px 8px;  /* Increased padding */
-            }
+    def advance(self, until):
+        """Yields the frames shown before the recording reaches a time"""
+        if self.clock is None:
+            self.clock = until
+        if until - self.clock > self.max_idle:
+            self.clock = until - self.max_idle
+        while self.clock < until:
+            yield self.canvas
+            self.clock += self.step
+
+    def grow(self, stroke):
+        """Draws a stroke onto the canvas at the pace it was drawn, yielding frames on the way
+
+        Each frame extends the stroke from where the last one ended to its
+        position at the frame's time, interpolated along the flattened
+        curve, so strokes fitted to few samples still grow smoothly.
+        Strokes on hidden layers grow without being drawn.
+        """
+        layers = self.scene.layers
+        index = next(i for i, layer in enumerate(layers) if layer.id == stroke.layer)
+        visible = layers[index].visible
+        on_top = not any(layer.visible for layer in layers[index + 1:])
+        stroke = stroke.flattened()
+        times = stroke.times
+        yield from self.advance(times[0])
+        head = None  # Where the drawn part ends, None before anything is drawn
+        drawn = 0  # Samples on the canvas
+        while True:
+            due = bisect.bisect_right(times, self.clock)
+            if due >= len(times):
+                break
+            if times[due] - self.clock > self.max_idle:
+                self.clock = times[due] - self.max_idle
+                continue
+            span = times[due] - times[due - 1]
+            tip = stroke.point_at(due - 1, (self.clock - times[due - 1]) / span if span > 0 else 0.0)
+            if visible:
+                self.draw_grown(stroke, head, drawn, due, tip, on_top)
+            head, drawn = tip, due
+            yield self.canvas
+            self.clock += self.step
+        if visible:
+            self.draw_grown(stroke, head, drawn, len(stroke), None, on_top)
+
+    def draw_grown(self, stroke, head, drawn, due, tip, on_top):
+        """Paints the stretch a stroke grew by since the last frame, at its place in the layer stack
+
+        On the top visible layer the stretch is painted straight over the
+        canvas. Below that, its region is composited again with the stroke
+        so far as a live item of its layer, so the layers above cover it.
+        """
+        piece = stroke.piece(head, drawn, due, tip)
+        if on_top:
+            self.draw_piece(piece)
+        else:
+            self.repaint(self.renderer.items_rect([piece]), [stroke.piece(None, 0, due, tip)])
+
+class FrameSequenceWriter:
+    """Writes frames as numbered PNGs, encoded on the thread pool
+
+    At most in_flight frames are queued or encoding at once, so a fast
+    player waits for the encoders instead of piling up copies. A frame
+    equal to the previous one is not encoded again but copied from its
+    file once that is written.
+    """
+    def __init__(self, directory, compression=1, in_flight=None):
+        self.pattern = os.path.join(directory, "frame-%06d.png")
+        self.compression = compression
+        self.pool = QThreadPool.globalInstance()
+        self.in_flight = in_flight or self.pool.maxThreadCount() * 2
+        self.slots = QSemaphore(self.in_flight)
+        self.lock = threading.Lock()
+        self.tasks = {}  # File name -> ExportTask still encoding
+        self.done = []  # Finished tasks, released from the player's thread
+        self.copies = {}  # File name -> names of repeated frames to copy once it is written
+        self.errors = []
+        self.count = 0
+        self.last = None  # (cacheKey, file name) of the last frame
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, frame):
+        """Queues one frame"""
+        file_name = self.pattern % self.count
+        self.count += 1
+        with self.lock:
+            self.done.clear()
+        if self.last is not None and self.last[0] == frame.cacheKey():
+            with self.lock:
+                if self.last[1] in self.copies:
+                    self.copies[self.last[1]].append(file_name)
+                    return
+            self.copy(self.last[1], [file_name])
+            return
+        self.last = (frame.cacheKey(), file_name)
+        self.slots.acquire()
+        task = ExportTask(frame.copy(), file_name, self.compression)
+        task.setAutoDelete(False)
+        # Handled on the worker thread: the player keeps the GUI thread busy
+        task.signals.finished.connect(self.on_finished, Qt.DirectConnection)
+        task.signals.failed.connect(self.on_failed, Qt.DirectConnection)
+        with self.lock:
+            self.tasks[file_name] = task
+            self.copies[file_name] = []
+        self.pool.start(task)
+
+    def on_finished(self, file_name):
+        with self.lock:
+            self.done.append(self.tasks.pop(file_name))
+            copies = self.copies.pop(file_name)
+        self.copy(file_name, copies)
+        self.slots.release()
+
+    def on_failed(self, file_name, error):
+        with self.lock:
+            self.done.append(self.tasks.pop(file_name))
+            self.copies.pop(file_name)
+            self.errors.append(f"{file_name}: {error}")
+        self.slots.release()
+
+    def copy(self, source, file_names):
+        """Writes repeated frames as copies of an encoded one"""
+        for file_name in file_names:
+            try:
+                shutil.copyfile(source, file_name)
+            except OSError as e:
+                with self.lock:
+                    self.errors.append(f"{file_name}: {e}")
+
+    def close(self):
+        """Waits for the frames still encoding"""
+        self.slots.acquire(self.in_flight)
+        self.slots.release(self.in_flight)
+
+class FramePipeWriter:
+    """Streams frames as raw 32-bit pixels (BGRA in memory on little-endian machines) to a binary file
+
+    Suits piping into an encoder, e.g. ffmpeg -f rawvideo -pix_fmt bgra.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.errors = []
+        self.count = 0
+
+    def write(self, frame):
+        """Writes one frame"""
+        self.file.write(frame.constBits().asstring(frame.sizeInBytes()))
+        self.count += 1
+
+    def close(self):
+        self.file.flush()
+
+def tcp_address(address):
+    """(host, port) of a host:port address, None for a local socket name or path"""
+    host, _, port = address.rpartition(":")
+    return (host, int(port)) if host and port.isdigit() else None
+
+class StreamPublisher(SessionJournal):
+    """Streams the scene and the stroke being drawn to viewers on local sockets
+
+    Viewers connect over TCP (host:port) or a local socket (any other
+    address: a Unix socket path, or a pipe name on Windows). The stream is
+    a session journal without a background, plus live records for the
+    stroke in progress and a reset record, followed by a new header,
+    whenever a new session starts. Records are batched and sent once per
+    frame. Committed records are also spooled to a temporary file: a
+    viewer that connects late, or falls max_backlog bytes behind, is fed
+    from the spool a chunk at a time as its socket drains, and skips live
+    records until it has caught up. A slow viewer thus costs neither
+    memory nor drawing latency. Live records carry the samples a stroke
+    keeps as its input is fitted, so a viewer's stroke ends at the last
+    kept sample rather than at the pen until the stroke is committed.
+    """
+    LIVE_STROKE_RECORD = 12  # A stroke was started
+    LIVE_SAMPLES_RECORD = 13  # Samples added to the stroke in progress
+    RESET_RECORD = 14  # A new session starts; its header follows
+    LIVE_STROKE = struct.Struct("<IIHIB")  # id, rgba, pen size, layer id, has pressures
+    # id, sample count, first x, first y; then int16 x, y steps and, with pressures, one byte per sample
+    LIVE_SAMPLES = struct.Struct("<IHii")
+    LIVE_SCALE = 8  # Live sample positions and steps are in 1/8 pixels
+    CHUNK = 64 * 1024  # Spooled bytes handed to a catching-up viewer at a time
+
+    def __init__(self, address, interval=1 / 60, max_backlog=256 * 1024):
+        super().__init__(address, tempfile.TemporaryFile())
+        self.max_backlog = max_backlog
+        self.scene = None
+        self.size = QSize()
+        self.batch = bytearray()  # Records since the last frame, for the viewers that keep up
+        self.spool_end = 0  # Spool offset the viewers that keep up have received
+        self.clients = {}  # Socket -> spool offset still to send, None once it keeps up
+        self.live = None  # Stroke in progress
+        self.live_sent = 0  # Samples of it batched so far
+        self.live_flushed = 0  # Samples of it sent with a batch
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(max(1, int(interval * 1000)))
+        self.timer.timeout.connect(self.flush)
+        self.server = self.listen(address)
+
+    def listen(self, address):
+        tcp = tcp_address(address)
+        if tcp is not None:
+            server = QTcpServer()
+            host = QHostAddress(QHostAddress.LocalHost) if tcp[0] == "localhost" else QHostAddress(tcp[0])
+            listening = server.listen(host, tcp[1])
+        else:
+            server = QLocalServer()
+            QLocalServer.removeServer(address)  # Left behind by a crash
+            listening = server.listen(address)
+        if not listening:
+            raise OSError(f"cannot listen on {address}: {server.errorString()}")
+        server.newConnection.connect(self.accept)
+        return server
+
+    def header(self):
+        return (self.HEADER.pack(self.MAGIC, self.VERSION, self.size.width(), self.size.height())
+                + self.BACKGROUND.pack(self.NO_BACKGROUND, 0))
+
+    def restart(self, size, scene, source=None):
+        """Starts the viewers over on a scene
+
+        source is (journal path, first record offset, end offset) when the
+        scene was restored from a journal, whose history is streamed as is.
         """
-        self.setStyleSheet(style)
+        self.flush()
+        if self.scene is not None and self in self.scene.listeners:
+            self.scene.listeners.remove(self)
+        self.scene = scene
+        scene.listeners.append(self)
+        self.size = size
+        self.live = None
+        self.file.seek(0)
+        self.file.truncate()
+        self.written = set(scene.lines.keys() | scene.shapes.keys())
+        if source is not None:
+            path, start, end = source
+            with open(path, "rb") as journal:
+                journal.seek(start)
+                while start < end:
+                    data = journal.read(min(end - start, 1024 * 1024))
+                    if not data:
+                        break
+                    self.file.write(data)
+                    start += len(data)
+        self.on_layers(scene.layers)
+        self.batch.clear()
+        self.spool_end = self.file.tell()
+        for client in list(self.clients):
+            client.write(self.RECORD.pack(0, self.RESET_RECORD) + self.header())
+            self.clients[client] = 0
+            self.feed(client)
+
+    def write_record(self, kind, payload=b""):
+        """Spools one record and batches it for the viewers"""
+        super().write_record(kind, payload)
+        self.batch += self.RECORD.pack(len(payload), kind)
+        self.batch += payload
+        self.schedule()
+
+    def on_commit(self, command):
+        super().on_commit(command)
+        if self.live is not None and any(item.id == self.live.id for item in command.added):
+            self.live = None  # The stroke's own record ends it
+
+    def on_stroke(self, stroke):
+        """Batches the samples a stroke in progress gained since the last call"""
+        if stroke is not self.live:
+            self.live = stroke
+            self.live_sent = self.live_flushed = 0
+        if len(stroke) > self.live_sent:
+            self.batch += self.live_records(self.live_sent, len(stroke))
+            self.live_sent = len(stroke)
+            self.schedule()
+
+    def live_records(self, first, last):
+        """Records of samples first..last-1 of the stroke in progress, starting it if first is 0"""
+        stroke = self.live
+        records = bytearray()
+        if first == 0:
+            payload = self.LIVE_STROKE.pack(stroke.id, stroke.color.rgba(), stroke.size, stroke.layer,
+                                            stroke.pressures is not None)
+            records += self.RECORD.pack(len(payload), self.LIVE_STROKE_RECORD) + payload
+        # Steps are taken between rounded positions, so rounding errors do not add up
+        positions = [round(value * self.LIVE_SCALE) for value in stroke.coords[2 * first:2 * last]]
+        offset = first
+        while first < last:
+            end = first + 1
+            steps = array("h")
+            while end < last and end - first < 0xFFFF:
+                i = 2 * (end - offset)
+                dx, dy = positions[i] - positions[i - 2], positions[i + 1] - positions[i - 1]
+                if not (-0x8000 <= dx < 0x8000 and -0x8000 <= dy < 0x8000):
+                    break  # A jump too long for a step starts a new record
+                steps.append(dx)
+                steps.append(dy)
+                end += 1
+            i = 2 * (first - offset)
+            payload = self.LIVE_SAMPLES.pack(stroke.id, end - first, positions[i], positions[i + 1])
+            payload += steps.tobytes()
+            if stroke.pressures is not None:
+                payload += bytes(min(255, max(0, round(p * 255))) for p in stroke.pressures[first:end])
+            records += self.RECORD.pack(len(payload), self.LIVE_SAMPLES_RECORD) + payload
+            first = end
+        return records
+
+    def schedule(self):
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def accept(self):
+        """Starts new viewers on the header and the spooled session"""
+        self.flush()  # Anything batched is already spooled for them
+        while self.server.hasPendingConnections():
+            client = self.server.nextPendingConnection()
+            client.disconnected.connect(lambda client=client: self.drop(client))
+            client.bytesWritten.connect(lambda count, client=client: self.feed(client))
+            client.write(self.header())
+            self.clients[client] = 0
+            self.feed(client)
+
+    def drop(self, client):
+        self.clients.pop(client, None)
+        client.deleteLater()
+
+    def flush(self):
+        """Sends the batch to the viewers that keep up and moves the others along the spool"""
+        self.timer.stop()
+        batch, self.batch = bytes(self.batch), bytearray()
+        end = self.file.tell()
+        for client, offset in list(self.clients.items()):
+            if offset is not None:
+                continue
+            if client.bytesToWrite() + len(batch) > self.max_backlog:
+                self.clients[client] = self.spool_end  # Too far behind, back to the spool
+            elif batch:
+                client.write(batch)
+        self.spool_end = end
+        self.live_flushed = self.live_sent if self.live is not None else 0
+        for client in list(self.clients):
+            self.feed(client)
+
+    def feed(self, client):
+        """Hands a viewer that is behind the next spooled records, as far as its socket has drained"""
+        offset = self.clients.get(client)
+        while offset is not None and client.bytesToWrite() < self.CHUNK:
+            if offset < self.spool_end:
+                data = self.read_spool(offset)
+                client.write(data)
+                offset += len(data)
+            else:
+                offset = None  # Caught up; batches go to it from now on
+                if self.live is not None and self.live_flushed:
+                    client.write(self.live_records(0, self.live_flushed))
+            self.clients[client] = offset
+
+    def read_spool(self, offset):
+        """Whole spooled records from offset on, about a chunk of them"""
+        position = self.file.tell()
+        self.file.seek(offset)
+        data = self.file.read(max(min(self.spool_end - offset, self.CHUNK), self.RECORD.size))
+        last = 0
+        for record, start, length in self.records(data, 0):
+            last = start + length
+        if not last:  # A single record longer than a chunk
+            length, _ = self.RECORD.unpack_from(data, 0)
+            data += self.file.read(self.RECORD.size + length - len(data))
+            last = len(data)
+        self.file.seek(position)
+        return data[:last]
+
+    def close(self):
+        """Disconnects the viewers and stops listening"""
+        self.flush()
+        for client in list(self.clients):
+            client.close()
+        self.server.close()
+        self.file.close()
+        if self.scene is not None and self in self.scene.listeners:
+            self.scene.listeners.remove(self)
+
+class StreamReceiver(HeadlessCanvas):
+    """Rebuilds a streamed session on a canvas from its bytes, as they arrive
+
+    feed() takes any slice of the stream: complete records are applied
+    at once and the rest is kept for the next call, so the canvas always
+    shows the session up to the last whole record, the stroke in progress
+    included.
+    """
+    def __init__(self, history_depth=100, point_budget=100000):
+        super().__init__(history_depth, point_budget)
+        self.buffer = bytearray()
+        self.started = False  # Whether the header of the current session was read
+        self.items = {}  # Items defined but not yet added by an edit
+        self.cuts = []  # (hole, ids) of the next edit
+        self.live = None  # Stroke being drawn on the other end
+
+    @staticmethod
+    def connect(address, timeout=3000):
+        """Opens a socket to a publishing session, waiting up to timeout ms"""
+        tcp = tcp_address(address)
+        if tcp is not None:
+            socket = QTcpSocket()
+            socket.connectToHost(*tcp)
+        else:
+            socket = QLocalSocket()
+            socket.connectToServer(address)
+        if not socket.waitForConnected(timeout):
+            raise OSError(f"cannot connect to {address}: {socket.errorString()}")
+        return socket
+
+    def feed(self, data):
+        """Applies the complete records in data and keeps the rest for the next call"""
+        self.buffer += data
+        while True:
+            offset = 0
+            if not self.started:
+                if len(self.buffer) < SessionJournal.HEADER.size + SessionJournal.BACKGROUND.size:
+                    return
+                size, _, offset = SessionJournal.read_header(self.buffer, "")
+                self.start(size)
+                self.items.clear()
+                self.cuts.clear()
+                self.live = None
+                self.started = True
+            for record, start, length in SessionJournal.records(self.buffer, offset):
+                offset = start + length
+                self.apply(record, start, length)
+                if not self.started:
+                    break  # Reset: a new header follows
+            del self.buffer[:offset]
+            if self.started:
+                return
+
+    def apply(self, record, start, length):
+        data = self.buffer
+        if record in SessionJournal.DEFINITION_RECORDS:
+            SessionJournal.read_definition(record, data, start, length, self.items)
+        elif record == SessionJournal.CUT_RECORD:
+            self.cuts.append(SessionJournal.read_cut(data, start, length))
+        elif record == SessionJournal.LAYERS_RECORD:
+            self.update_layers(SessionJournal.read_layers(data, start))
+        elif record == SessionJournal.EDIT_RECORD:
+            added, removed = SessionJournal.read_edit(data, start)
+            ended = None
+            if self.live is not None and self.live.id in added:
+                ended = self.renderer.items_rect([self.live])
+                self.live = None
+            holes = [(self.scene.item(i), hole) for hole, ids in self.cuts for i in ids]
+            self.cuts.clear()
+            self.edit([self.items.pop(i) if i in self.items else self.scene.item(i) for i in added],
+                      [self.scene.item(i) for i in removed], holes)
+            if ended is not None:
+                self.repaint(ended)  # Swaps the live samples for the finished stroke
+        elif record == SessionJournal.UNDO_RECORD:
+            self.undo()
+        elif record == SessionJournal.REDO_RECORD:
+            self.redo()
+        elif record == StreamPublisher.LIVE_STROKE_RECORD:
+            self.start_live(data, start)
+        elif record == StreamPublisher.LIVE_SAMPLES_RECORD:
+            self.extend_live(data, start)
+        elif record == StreamPublisher.RESET_RECORD:
+            self.started = False
+
+    def start_live(self, data, start):
+        item_id, rgba, pen_size, layer_id, pressures = StreamPublisher.LIVE_STROKE.unpack_from(data, start)
+        if self.live is not None:
+            # Started over after falling behind: the samples come again from the first
+            rect = self.renderer.items_rect([self.live])
+            self.live = None
+            self.repaint(rect)
+        self.live = Stroke(QColor.fromRgba(rgba), pen_size, item_id, layer_id)
+        if pressures:
+            self.live.pressures = array("f")
+
+    def extend_live(self, data, start):
+        item_id, count, x, y = StreamPublisher.LIVE_SAMPLES.unpack_from(data, start)
+        live = self.live
+        if live is None or live.id != item_id:
+            return  # Joined in the middle of a stroke
+        offset = start + StreamPublisher.LIVE_SAMPLES.size
+        steps_end = offset + 4 * (count - 1)
+        steps = array("h")
+        steps.frombytes(data[offset:steps_end])
+        pressures = data[steps_end:steps_end + count] if live.pressures is not None else None
+        first = len(live)
+        scale = StreamPublisher.LIVE_SCALE
+        for i in range(count):
+            if i:
+                x += steps[2 * i - 2]
+                y += steps[2 * i - 1]
+            live.append(QPointF(x / scale, y / scale), 0, pressures[i] / 255 if pressures is not None else None)
+        # New samples bend the curve back to the midpoint before the last sample there was
+        changed = live.piece(None, max(first - 2, 0), len(live), None)
+        self.repaint(self.renderer.items_rect([changed]))
+
+    def repaint(self, rect, live_items=()):
+        # The stroke in progress is drawn in its own layer, under the layers above it
+        if self.live is not None and len(self.live):
+            live_items = [*live_items, self.live]
+        super().repaint(rect, live_items)
+
+class Profiler:
+    """Rolling frame and input timings for the performance HUD
+
+    Hooks check enabled first, so a disabled profiler costs one
+    attribute lookup per call. Timings are kept per name as (end,
+    duration) pairs for percentiles and rates, and as trace events for
+    a JSON dump in Chrome's trace format.
+    """
+    def __init__(self, window=300, trace_length=100000):
+        self.enabled = False
+        self.window = window
+        self.samples = {}  # name -> deque of (end, duration) in seconds
+        self.trace = deque(maxlen=trace_length)  # (name, start, end)
+        self.errors = {}  # name -> count
+        self.reported = set()  # Errors whose traceback was already printed
+        self.origin = time.perf_counter()
+
+    def record(self, name, start, end):
+        """Adds one timed span"""
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=self.window)
+        samples.append((end, end - start))
+        self.trace.append((name, start, end))
+
+    def error(self, name, error):
+        """Counts an exception, printing its traceback the first time it is seen"""
+        self.errors[name] = self.errors.get(name, 0) + 1
+        key = (name, type(error), str(error))
+        if key not in self.reported:
+            self.reported.add(key)
+            traceback.print_exception(type(error), error, error.__traceback__)
+
+    def percentiles(self, name):
+        """p50/p95/p99 of the recent durations of a span, in milliseconds"""
+        durations = sorted(duration for _, duration in self.samples.get(name, ()))
+        if not durations:
+            return None
+        pick = lambda q: durations[min(len(durations) - 1, int(q * len(durations)))] * 1000
+        return pick(0.50), pick(0.95), pick(0.99)
+
+    def rate(self, name, period=1.0):
+        """Spans of a name that ended within the last period, per second"""
+        since = time.perf_counter() - period
+        return sum(1 for end, _ in self.samples.get(name, ()) if end > since) / period
+
+    def dump(self, path, counters=None):
+        """Writes the trace as Chrome trace-event JSON (chrome://tracing, Perfetto)"""
+        events = [{"name": name, "ph": "X", "pid": 0, "tid": 0,
+                   "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6}
+                  for name, start, end in self.trace]
+        summary = {name: self.percentiles(name) for name in self.samples}
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "otherData": {
+                "percentiles_ms": summary, "errors": self.errors, "counters": counters or {}
+            }}, file)
+
+def profiled(name):
+    """Times a ScreenDrawApp method under a name while its profiler is enabled"""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            profiler = self.profiler
+            if not profiler.enabled:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                profiler.record(name, start, time.perf_counter())
+        return wrapper
+    return decorate
 
 class ScreenDrawApp(QMainWindow):
     def __init__(self):
@@ -164,12 +2964,16 @@ class ScreenDrawApp(QMainWindow):
         self.setup_screen_geometry()
         self.initialize_drawing_state()
         self.setup_ui()
+        if os.environ.get("SCREEN_PENCIL_PROFILE"):
+            self.toggle_profiler()
+        if os.environ.get("SCREEN_PENCIL_STREAM"):
+            self.start_stream(os.environ["SCREEN_PENCIL_STREAM"])
+        QTimer.singleShot(0, self.offer_recovery)
 
     def setup_screen_geometry(self):
-        """Sets up screen dimensions"""
+        """Covers the whole virtual desktop, across all screens"""
         self.screen = QApplication.primaryScreen()
-        screen_size = self.screen.size()
-        self.setGeometry(0, 0, screen_size.width(), screen_size.height())
+        self.setGeometry(self.screen.virtualGeometry())
 
     def initialize_drawing_state(self):
         """Initializes drawing state"""
@@ -179,24 +2983,63 @@ class ScreenDrawApp(QMainWindow):
         self.current_color = QColor("#e74c3c")
         self.pen_size = 5
         self.mode = "free"
-        self.lines = []
-        self.shapes = []
-        self.history = []
+        self.history_depth = 100  # Commands kept for undo
+        # Vector points kept before the oldest items are baked into a raster
+        self.point_budget = int(os.environ.get("SCREEN_PENCIL_POINT_BUDGET", 100000)) or None
+        self.scene = Scene(self.history_depth, self.point_budget)
+        self.renderer = SceneRenderer(self.scene)
+        self.erase_command = None  # Collects the items removed and pieces added by one eraser drag
+        self.active_layer = 0  # Id of the layer drawing and erasing go to
         self.background = None
         self.start_point = None
-        self.zoom_factor = 1.0
         self.panel_visible = True
+        self.current_line = None  # Stroke being drawn, not yet committed
+        self.current_point = None  # Rubber-band end point for shape previews
+        self.min_sample_distance = 2  # Screen pixels between kept samples
+        self.fit_ratio = 0.15  # How far input may stray from a fitted stroke, as a fraction of the pen size
+        self.export_compression = 6  # PNG zlib level, 0 (fastest) to 9 (smallest)
+        self.exports = []  # Export tasks still encoding
+        self.session_dir = os.path.join(os.path.expanduser("~"), ".screen_pencil", "sessions")
+        self.journal = None  # SessionJournal of the current drawing session
+        self.journal_background = None  # Sidecar PNG of the captured screens
+        self.session_limit = int(os.environ.get("SCREEN_PENCIL_SESSIONS", 50)) or None  # Sessions kept on disk
+        self.publisher = None  # StreamPublisher mirroring the drawing to viewers
+        self.pending_input = None  # Mouse events held back while a screen is being grabbed
+        self.capture_requested = None  # perf_counter() when the pending grab was requested
+        self.recapture_delay = 100  # ms for the window system to take the hidden overlay off screen before a regrab
+        self.captures = []  # Capture tasks still converting
+        self.capture_latencies = deque(maxlen=100)  # Request-to-ready time of each grab, seconds
+        self.pressure = None  # Pen pressure of the tablet event being handled, None for the mouse
+        self.event_time = None  # Scene-clock arrival of a replayed buffered event, None for a live one
+        self.pending_motion = []  # (point, pressure, time) samples applied at the next frame
+        self.last_frame = 0.0  # perf_counter() of the last motion frame
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.setTimerType(Qt.PreciseTimer)
+        self.frame_timer.timeout.connect(self.apply_motion)
+        self.profiler = Profiler()
+        self.hud_timer = QTimer(self)
+        self.hud_timer.setInterval(500)  # HUD refresh while the profiler is on
+        self.hud_timer.timeout.connect(lambda: self.update(self.hud_rect()))
+        self.journal_timer = QTimer(self)
+        self.journal_timer.setInterval(1000)  # Buffered records reach disk at least once a second
+        self.journal_timer.timeout.connect(self.flush_journal)
+        self.zoom_timer = QTimer(self)
+        self.zoom_timer.setSingleShot(True)
+        self.zoom_timer.setInterval(150)  # Re-render once the zoom slider settles
+        self.zoom_timer.timeout.connect(self.settle_zoom)
 
     def setup_ui(self):
         """Sets up user interface"""
         # Left panel
         self.control_panel = CompactPanel(self)
-        panel_height = min(650, self.height() - 100)  # Increased panel height
+        primary = self.screen.geometry().translated(-self.x(), -self.y())
+        panel_height = min(650, primary.height() - 100)  # Increased panel height
         self.control_panel.setFixedHeight(panel_height)
         
-        # Position panel at left center
-        panel_x = 20
-        panel_y = (self.height() - panel_height) // 2
+        # Position panel at left center of the primary screen
+        panel_x = primary.x() + 20
+        panel_y = primary.y() + (primary.height() - panel_height) // 2
         self.control_panel.move(panel_x, panel_y)
 
         # Main layout
@@ -233,18 +3076,16 @@ class ScreenDrawApp(QMainWindow):
         
         self.control_panel.setLayout(main_layout)
         self.setMouseTracking(True)
+        
+        # One stylesheet for the whole panel, applied before it is first polished
+        apply_stylesheet()
 
     def create_separator(self):
         """Creates separator line"""
         separator = QFrame()
         separator.setFrameShape(QFrame.HLine)
         separator.setFixedHeight(8)  # Increased separator height
-        separator.setStyleSheet("""
-            QFrame {
-                color: rgba(255, 255, 255, 0.3);
-                margin: 8px 12px;  /* Increased margin */
-            }
-        """)
+        separator.setObjectName("separator")
         return separator
 
     def setup_main_controls(self, layout):
@@ -255,6 +3096,12 @@ class ScreenDrawApp(QMainWindow):
         self.draw_button.setShortcut("Ctrl+D")
         layout.addWidget(self.draw_button)
         
+        # Grab the screen again under the annotations
+        self.recapture_button = CompactButton("🔄", "Refresh Background (F5)", "#2980b9")
+        self.recapture_button.clicked.connect(self.recapture_background)
+        self.recapture_button.setShortcut("F5")
+        layout.addWidget(self.recapture_button)
+        
         # Hide/Show panel
         hide_button = CompactButton("👁️", "Hide/Show Panel (H)", "#95a5a6")
         hide_button.clicked.connect(self.toggle_panel)
@@ -273,11 +3120,22 @@ class ScreenDrawApp(QMainWindow):
         undo_button.setShortcut("Ctrl+Z")
         layout.addWidget(undo_button)
         
+        # Redo
+        redo_button = CompactButton("↪️", "Redo (Ctrl+Y)", "#8e44ad")
+        redo_button.clicked.connect(self.redo)
+        redo_button.setShortcut("Ctrl+Y")
+        layout.addWidget(redo_button)
+        
+        # Layers
+        self.layer_button = CompactButton("🗂️", "Layers", "#16a085")
+        self.layer_button.clicked.connect(self.show_layer_menu)
+        layout.addWidget(self.layer_button)
+        
         # Save
-        save_button = CompactButton("💾", "Save as PNG (Ctrl+S)", "#3498db")
-        save_button.clicked.connect(self.save_png)
-        save_button.setShortcut("Ctrl+S")
-        layout.addWidget(save_button)
+        self.save_button = CompactButton("💾", "Save as PNG (Ctrl+S)", "#3498db")
+        self.save_button.clicked.connect(self.save_png)
+        self.save_button.setShortcut("Ctrl+S")
+        layout.addWidget(self.save_button)
         
         # Exit
         exit_button = CompactButton("❌", "Exit Application (Esc)", "#e74c3c")
@@ -347,7 +3205,7 @@ class ScreenDrawApp(QMainWindow):
         thickness_layout.setContentsMargins(0, 5, 0, 10)  # Added bottom margin
         
         thickness_label = QLabel("📏")
-        thickness_label.setStyleSheet("color: white; font: 16px 'Segoe UI Emoji'; text-align: center;")
+        thickness_label.setObjectName("settingLabel")
         thickness_label.setAlignment(Qt.AlignCenter)
         thickness_label.setToolTip("Pen Thickness")
         
@@ -370,7 +3228,7 @@ class ScreenDrawApp(QMainWindow):
         zoom_layout.setContentsMargins(0, 5, 0, 5)  # Added margins
         
         zoom_label = QLabel("🔍")
-        zoom_label.setStyleSheet("color: white; font: 16px 'Segoe UI Emoji'; text-align: center;")
+        zoom_label.setObjectName("settingLabel")
         zoom_label.setAlignment(Qt.AlignCenter)
         zoom_label.setToolTip("Zoom")
         
@@ -389,25 +3247,182 @@ class ScreenDrawApp(QMainWindow):
 
     def toggle_draw_mode(self):
         """Toggles drawing mode"""
+        if self.edit_in_progress():
+            return
         try:
-            self.draw_mode = not self.draw_mode
-            if self.draw_mode:
-                screen_size = self.screen.size()
-                self.background = self.screen.grabWindow(0, 0, 0, screen_size.width(), screen_size.height())
-                self.draw_button.setText("⏸️")
-                self.draw_button.setToolTip("Stop Drawing (Ctrl+D)")
-                self.draw_button.base_color = "#e74c3c"
-                self.draw_button.setup_style()
+            if not self.draw_mode:
+                self.set_draw_mode(True, ScreenCapture(QApplication.screens(), self.geometry().topLeft()))
+                self.capture_screens()
+                self.start_journal()
             else:
-                self.reset_drawing_state()
-                self.draw_button.setText("🎨")
-                self.draw_button.setToolTip("Start Drawing (Ctrl+D)")
-                self.draw_button.base_color = "#27ae60"
-                self.draw_button.setup_style()
+                self.set_draw_mode(False)
             self.update()
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Error changing drawing mode: {str(e)}")
 
+    def capture_screens(self):
+        """Starts capturing the desktop lazily with the screen under the cursor"""
+        self.ensure_captured(QRect(self.mapFromGlobal(QCursor.pos()), QSize(1, 1)))
+
+    def ensure_captured(self, rect):
+        """Requests the screens a screen rect reaches the first time they are drawn on
+
+        Grabs run on the next event loop pass rather than in the caller,
+        so entering draw mode returns at once; input arriving before the
+        grab is ready is buffered and replayed afterwards.
+        """
+        capture = self.background
+        if not isinstance(capture, ScreenCapture):
+            return
+        indexes = capture.missing(rect)
+        if indexes:
+            capture.pending.update(indexes)
+            if self.pending_input is None:
+                self.pending_input = []
+                self.capture_requested = time.perf_counter()
+            QTimer.singleShot(0, lambda: self.grab_screens(capture, indexes))
+
+    def recapture_background(self):
+        """Grabs the captured screens again without leaving draw mode
+
+        The annotations stay. The fresh grab is compared with the old one
+        in tiles, and only tiles whose pixels changed are copied in and
+        repainted, so a terminal or chart updating costs a small repaint.
+        A reopened session's saved screen is replaced by a full new capture.
+        """
+        if not self.draw_mode or self.background is None:
+            return
+        if isinstance(self.background, ScreenCapture):
+            capture = self.background
+            indexes = [index for index in capture.captures if index not in capture.pending]
+        else:
+            capture = ScreenCapture(QApplication.screens(), self.geometry().topLeft())
+            indexes = list(range(len(capture.screens)))
+            self.background = capture
+        if not indexes:
+            return
+        capture.pending.update(indexes)
+        if self.pending_input is None:
+            self.pending_input = []
+            self.capture_requested = time.perf_counter()
+        # The overlay would be in its own grab; opacity is not honoured without a compositor, so hide it
+        self.hide()
+        QTimer.singleShot(self.recapture_delay, lambda: self.regrab_screens(capture, indexes))
+
+    @profiled("capture.grab")
+    def grab_screens(self, capture, indexes):
+        """Grabs screens on the GUI thread and converts them on the thread pool"""
+        for index in indexes:
+            # The overlay shows nothing there yet, so the grab sees the bare desktop
+            self.start_capture(capture, CaptureTask(index, capture.grab_pixmap(index).toImage()))
+
+    @profiled("capture.grab")
+    def regrab_screens(self, capture, indexes):
+        """Grabs screens again, diffing those captured before against the old grab on the thread pool"""
+        try:
+            for index in indexes:
+                grab = capture.grab_pixmap(index).toImage()
+                previous = capture.captures.get(index)
+                if previous is None:
+                    self.start_capture(capture, CaptureTask(index, grab))
+                    continue
+                if not isinstance(previous, QImage):
+                    previous = previous.toImage()
+                self.start_capture(capture, RecaptureTask(index, grab, previous, self.renderer.tile_size))
+        finally:
+            self.show()
+            self.activateWindow()
+
+    def start_capture(self, capture, task):
+        """Runs a capture task on the thread pool, reporting to on_capture_finished"""
+        task.setAutoDelete(False)
+        task.signals.finished.connect(
+            lambda index, image, c=capture, t=task: self.on_capture_finished(c, t, index, image))
+        self.captures.append(task)
+        QThreadPool.globalInstance().start(task)
+
+    def on_capture_finished(self, capture, task, index, image):
+        """Shows a grabbed screen and replays the input buffered meanwhile"""
+        self.captures.remove(task)
+        if capture is not self.background:
+            capture.pending.discard(index)  # Draw mode ended or the background was replaced
+        elif isinstance(task, RecaptureTask):
+            self.refresh_background(capture, index, image, task.changed)
+        else:
+            capture.store(index, image)
+            self.update()
+            if self.journal is not None and self.journal_background:
+                self.save_session_background()
+        
+        if not (isinstance(self.background, ScreenCapture) and self.background.pending):
+            if self.capture_requested is not None:
+                now = time.perf_counter()
+                latency = now - self.capture_requested
+                self.capture_latencies.append(latency)
+                if self.profiler.enabled:
+                    self.profiler.record("capture", self.capture_requested, now)
+                self.draw_button.setToolTip(f"Stop Drawing (Ctrl+D) - screen captured in {latency * 1000:.0f} ms")
+                self.capture_requested = None
+            self.flush_input()
+
+    def refresh_background(self, capture, index, image, changed):
+        """Copies the changed tiles of a screen's fresh grab in and repaints just those"""
+        rects = capture.patch(index, image, changed)
+        region = QRegion()
+        for rect in rects:
+            screen_rect = self.renderer.screen_rect(rect, 0)
+            self.renderer.invalidate_background(screen_rect)
+            region += screen_rect
+        self.update(region)  # One paint, so tiles shared by neighbouring rects are scaled once
+        if rects and self.journal is not None and self.journal_background:
+            self.save_session_background()
+        if changed is None:
+            self.recapture_button.setToolTip("Refresh Background (F5) - screen size changed, replaced it whole")
+        else:
+            self.recapture_button.setToolTip(f"Refresh Background (F5) - {len(rects)} tiles changed")
+
+    def buffer_input(self, event):
+        """Holds a mouse event back while a grab is pending; True if it was held"""
+        if self.pending_input is None:
+            return False
+        self.pending_input.append((event.type(), QPointF(event.localPos()), event.button(),
+                                   event.buttons(), event.modifiers(), self.pressure, self.sample_time()))
+        return True
+
+    def flush_input(self):
+        """Replays buffered mouse events in order"""
+        events, self.pending_input = self.pending_input or [], None
+        handlers = {
+            QEvent.MouseButtonPress: self.mousePressEvent,
+            QEvent.MouseMove: self.mouseMoveEvent,
+            QEvent.MouseButtonRelease: self.mouseReleaseEvent
+        }
+        for kind, pos, button, buttons, modifiers, pressure, event_time in events:
+            # A replayed event may request another screen; later ones are then buffered again
+            self.pressure = pressure
+            self.event_time = event_time
+            handlers[kind](QMouseEvent(kind, pos, button, buttons, modifiers))
+        self.pressure = self.event_time = None
+
+    def sample_time(self):
+        """Scene-clock time of the input event being handled"""
+        return self.scene.clock() if self.event_time is None else self.event_time
+
+    def set_draw_mode(self, enabled, background=None):
+        """Turns drawing mode on over the given background, or off"""
+        self.draw_mode = enabled
+        if enabled:
+            self.background = background
+            self.rebuild_layer()
+            self.draw_button.setText("⏸️")
+            self.draw_button.setToolTip("Stop Drawing (Ctrl+D)")
+            self.draw_button.set_tint("#e74c3c")
+        else:
+            self.reset_drawing_state()
+            self.draw_button.setText("🎨")
+            self.draw_button.setToolTip("Start Drawing (Ctrl+D)")
+            self.draw_button.set_tint("#27ae60")
+
     def toggle_panel(self):
         """Hides/shows the panel"""
         self.panel_visible = not self.panel_visible
@@ -437,67 +3452,330 @@ class ScreenDrawApp(QMainWindow):
 
     def update_zoom(self, value):
         """Updates zoom level"""
-        self.zoom_factor = value / 10.0
-        self.zoom_slider.setToolTip(f"Zoom: {self.zoom_factor:.1f}x")
+        self.scene.zoom = value / 10.0
+        self.zoom_slider.setToolTip(f"Zoom: {self.scene.zoom:.1f}x")
+        if self.draw_mode and self.scene.zoom != 1.0:
+            # Zoomed content covers every screen, so grab them before it is shown
+            self.ensure_captured(self.rect())
+        # While the slider moves the old layer is stretched, which costs one blit
+        self.zoom_timer.start()
         self.update()
 
+    def settle_zoom(self):
+        """Re-renders the layer at the current zoom"""
+        if self.renderer.is_stale():
+            self.rebuild_layer()
+            self.update()
+
     def clear_canvas(self):
-        """Clears the drawing canvas"""
-        self.lines.clear()
-        self.shapes.clear()
-        self.history.clear()
-        self.update()
+        """Clears every layer that is not locked"""
+        if self.edit_in_progress():
+            return  # The drag would be recorded on top of the clear
+        unlocked = {layer.id for layer in self.scene.layers if not layer.locked}
+        items = [item for item in self.scene.items() if item.layer in unlocked]
+        tiles = {(layer.id, key): (tile, None) for layer in self.scene.layers if layer.id in unlocked
+                 for key, tile in layer.baked.tiles.items()}
+        if items or tiles:
+            self.scene.commit(EditCommand(removed=items, tiles=tiles))
+            self.rebuild_layer(layers=unlocked)
+            self.update()
 
     def reset_drawing_state(self):
         """Resets drawing state"""
+        self.stop_journal()
+        self.pending_input = None
+        self.capture_requested = None
         self.background = None
-        self.lines.clear()
-        self.shapes.clear()
-        self.history.clear()
-        self.zoom_factor = 1.0
+        self.scene.reset()
+        self.renderer.release()
+        self.current_line = None
+        self.erase_command = None
+        self.drawing = False
+        self.start_point = None
+        self.select_layer(0)
+        self.restart_stream()
+
+    def edit_in_progress(self):
+        """Whether a stroke or eraser drag has changes that are not recorded yet"""
+        return self.current_line is not None or self.erase_command is not None
 
     def undo(self):
         """Undoes the last action"""
+        if self.edit_in_progress():
+            return
         try:
-            if self.history:
-                action, index = self.history.pop()
-                if action == "line" and index < len(self.lines):
-                    self.lines.pop(index)
-                elif action == "shape" and index < len(self.shapes):
-                    self.shapes.pop(index)
-                self.update()
+            self.refresh_region(*self.renderer.changed_region(self.scene.undo()))
         except Exception as e:
             QMessageBox.warning(self, "Warning", f"Undo error: {str(e)}")
 
+    def redo(self):
+        """Re-applies the last undone action"""
+        if self.edit_in_progress():
+            return
+        try:
+            self.refresh_region(*self.renderer.changed_region(self.scene.redo()))
+        except Exception as e:
+            QMessageBox.warning(self, "Warning", f"Redo error: {str(e)}")
+
+    def show_layer_menu(self):
+        """Pops up the layer stack, top first, with actions on the active layer"""
+        menu = QMenu(self)
+        for layer in reversed(self.scene.layers):
+            state = ("" if layer.visible else "  (hidden)") + ("  (locked)" if layer.locked else "")
+            action = menu.addAction(layer.name + state)
+            action.setCheckable(True)
+            action.setChecked(layer.id == self.active_layer)
+            action.triggered.connect(lambda checked, layer_id=layer.id: self.select_layer(layer_id))
+        menu.addSeparator()
+        active = self.scene.layer(self.active_layer)
+        menu.addAction("New Layer\tCtrl+N", self.new_layer)
+        menu.addAction(("Hide" if active.visible else "Show") + " Layer\tCtrl+H", self.toggle_layer_visible)
+        menu.addAction(("Unlock" if active.locked else "Lock") + " Layer\tCtrl+L", self.toggle_layer_locked)
+        menu.addAction("Move Layer Up\tCtrl+PgUp", lambda: self.move_layer(1))
+        menu.addAction("Move Layer Down\tCtrl+PgDown", lambda: self.move_layer(-1))
+        menu.exec_(self.layer_button.mapToGlobal(QPoint(self.layer_button.width(), 0)))
+
+    def select_layer(self, layer_id):
+        """Makes a layer the one drawing and erasing go to"""
+        self.active_layer = layer_id
+        self.layer_button.setToolTip(f"Layers: drawing on {self.scene.layer(layer_id).name}")
+
+    def select_adjacent_layer(self, offset):
+        """Selects the layer above (positive offset) or below the active one"""
+        layers = self.scene.layers
+        index = layers.index(self.scene.layer(self.active_layer)) + offset
+        if 0 <= index < len(layers):
+            self.select_layer(layers[index].id)
+
+    def new_layer(self):
+        """Adds a layer on top of the stack and draws on it"""
+        self.select_layer(self.scene.add_layer().id)
+
+    def move_layer(self, offset):
+        """Moves the active layer up or down; the cached layers are only recomposited"""
+        if self.scene.move_layer(self.active_layer, offset):
+            self.update()
+
+    def toggle_layer_visible(self):
+        """Shows or hides the active layer; the cached layers are only recomposited"""
+        layer = self.scene.layer(self.active_layer)
+        self.scene.set_layer_state(layer.id, visible=not layer.visible)
+        self.update()
+
+    def toggle_layer_locked(self):
+        """Locks or unlocks the active layer against drawing, erasing and clearing"""
+        layer = self.scene.layer(self.active_layer)
+        self.scene.set_layer_state(layer.id, locked=not layer.locked)
+
+    def refresh_region(self, dirty, layers=None):
+        """Re-renders and repaints one screen region of some layers after a model change"""
+        if not dirty.isEmpty():
+            self.rebuild_layer(dirty, layers)
+            self.update(dirty)
+
     def save_png(self):
         """Saves as PNG"""
         try:
             if not self.draw_mode or not self.background:
                 QMessageBox.warning(self, "Warning", "Start drawing mode first!")
                 return
-                
-            file_name, _ = QFileDialog.getSaveFileName(
-                self, "Save Drawing", "", "PNG Files (*.png);;All Files (*)"
+            
+            annotations_filter = "PNG, annotations only (*.png)"
+            file_name, selected_filter = QFileDialog.getSaveFileName(
+                self, "Save Drawing", "",
+                f"PNG Files (*.png);;{annotations_filter};;All Files (*)"
             )
             if file_name:
-                # Temporarily hide panel
-                panel_was_visible = self.panel_visible
-                if panel_was_visible:
-                    self.control_panel.hide()
-                
-                pixmap = QPixmap(self.size())
-                pixmap.fill(Qt.transparent)
-                self.render(pixmap)
-                pixmap.save(file_name, "PNG")
-                
-                # Show panel again
-                if panel_was_visible:
-                    self.control_panel.show()
-                    
-                QMessageBox.information(self, "Success", "Drawing saved!")
+                self.export_png(file_name, annotations_only=selected_filter == annotations_filter)
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Save error: {str(e)}")
 
+    @profiled("save.render")
+    def export_png(self, file_name, annotations_only=False):
+        """Renders the scene at native resolution and encodes it in the background"""
+        if annotations_only:
+            # Same native size, but strokes over a transparent background
+            size = None if self.background.isNull() else self.background.size()
+            image = self.renderer.render_image(None, size)
+        else:
+            image = self.renderer.render_image(self.background)
+        
+        task = ExportTask(image, file_name, self.export_compression)
+        task.setAutoDelete(False)
+        task.signals.progress.connect(self.on_export_progress)
+        task.signals.finished.connect(lambda name, t=task: self.on_export_finished(t, name))
+        task.signals.failed.connect(lambda name, error, t=task: self.on_export_failed(t, name, error))
+        self.exports.append(task)
+        QThreadPool.globalInstance().start(task)
+        return task
+
+    def on_export_progress(self, file_name, percent):
+        """Shows export progress on the save button"""
+        busy = percent < 100
+        self.save_button.setText("⏳" if busy else "💾")
+        self.save_button.setToolTip(f"Saving {file_name} ({percent}%)" if busy else "Save as PNG (Ctrl+S)")
+
+    def on_export_finished(self, task, file_name):
+        """Export completion notification"""
+        self.exports.remove(task)
+        if self.profiler.enabled:
+            self.profiler.record("save", task.started, time.perf_counter())
+        QMessageBox.information(self, "Success", "Drawing saved!")
+
+    def on_export_failed(self, task, file_name, error):
+        """Export failure notification"""
+        self.exports.remove(task)
+        self.on_export_progress(file_name, 100)
+        QMessageBox.critical(self, "Error", f"Save error: {error}")
+
+    def start_journal(self):
+        """Starts journaling the session, with the background saved next to it"""
+        try:
+            os.makedirs(self.session_dir, exist_ok=True)
+            # Numbered within the second, so sessions started in the same second neither collide nor reorder
+            stamp = time.strftime("session-%Y%m%d-%H%M%S")
+            taken = [name[len(stamp) + 1:-4] for name in os.listdir(self.session_dir)
+                     if name.startswith(stamp) and name.endswith(".spj")]
+            number = max((int(suffix) + 1 for suffix in taken if suffix.isdigit()), default=0)
+            path = os.path.join(self.session_dir, f"{stamp}-{number:03d}.spj")
+            self.journal_background = path[:-4] + ".png"
+            self.save_session_background()
+            self.attach_journal(SessionJournal.create(path, self.size(), self.journal_background))
+            # Pruned once the new session exists, so it counts towards the limit
+            SessionJournal.prune(self.session_dir, self.session_limit)
+        except OSError as e:
+            QMessageBox.warning(self, "Warning", f"Session will not be saved: {str(e)}")
+
+    def save_session_background(self):
+        """Writes the captured screens next to the journal"""
+        if self.background.isNull():
+            return
+        # The screenshot is encoded off the GUI thread like a normal export, but quietly
+        task = ExportTask(self.background.toImage(), self.journal_background, 1)
+        task.setAutoDelete(False)
+        task.signals.finished.connect(lambda name, t=task: self.exports.remove(t))
+        task.signals.failed.connect(lambda name, error, t=task: self.exports.remove(t))
+        self.exports.append(task)
+        QThreadPool.globalInstance().start(task)
+
+    def attach_journal(self, journal):
+        """Makes the journal record every change to the scene"""
+        self.journal = journal
+        self.journal.clock = self.scene.clock
+        self.journal.on_layers(self.scene.layers)
+        self.scene.listeners.append(journal)
+        self.journal_timer.start()
+
+    def stop_journal(self):
+        """Closes the journal of the current session"""
+        if self.journal is not None:
+            self.journal_timer.stop()
+            if self.journal in self.scene.listeners:
+                self.scene.listeners.remove(self.journal)
+            self.journal.close()
+            journal_path = self.journal.path
+            if not self.journal.edits and not SessionJournal.has_edits(journal_path):
+                # Nothing was drawn; the screenshot is not worth keeping
+                for path in (journal_path, journal_path[:-4] + ".png"):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            self.journal = None
+
+    def flush_journal(self):
+        """Writes buffered journal records to disk"""
+        if self.journal is not None:
+            self.journal.flush()
+
+    def open_session(self, path=None):
+        """Restores a journaled session, continuing to append to its journal"""
+        if self.edit_in_progress():
+            return
+        try:
+            if path is None:
+                path, _ = QFileDialog.getOpenFileName(
+                    self, "Open Session", self.session_dir, "Sessions (*.spj);;All Files (*)"
+                )
+                if not path:
+                    return
+            session = SessionJournal.load(path, self.history_depth)
+            if session.background is not None and not session.background.isNull():
+                background = QPixmap.fromImage(session.background)
+                background.setDevicePixelRatio(background.width() / session.size.width())
+            else:
+                background = ScreenCapture(QApplication.screens(), self.geometry().topLeft())
+            if self.draw_mode:
+                self.set_draw_mode(False)
+            self.scene = session.scene
+            self.scene.point_budget = self.point_budget
+            self.renderer.scene = self.scene
+            self.set_draw_mode(True, background)
+            self.select_layer(self.scene.layers[-1].id)
+            self.restart_stream((path, session.start, session.end))
+            self.renderer.bake_over_budget()
+            # Grabs taken for this session go to its own background file, if it has one
+            self.journal_background = session.background_path
+            self.attach_journal(SessionJournal.resume(path, session))
+            self.capture_screens()
+            self.update()
+        except (OSError, ValueError, struct.error) as e:
+            QMessageBox.critical(self, "Error", f"Could not open session: {str(e)}")
+
+    def start_stream(self, address):
+        """Streams the drawing to viewers connecting to a TCP (host:port) or local socket address"""
+        try:
+            self.publisher = StreamPublisher(address, self.frame_interval())
+            self.publisher.restart(self.size(), self.scene)
+        except OSError as e:
+            QMessageBox.warning(self, "Warning", f"Drawing will not be streamed: {str(e)}")
+
+    def restart_stream(self, source=None):
+        """Starts the viewers over on the current scene"""
+        if self.publisher is not None:
+            self.publisher.restart(self.size(), self.scene, source)
+
+    def offer_recovery(self):
+        """Offers to restore the newest session that was not closed cleanly"""
+        try:
+            sessions = sorted(name for name in os.listdir(self.session_dir) if name.endswith(".spj"))
+        except OSError:
+            return
+        if sessions:
+            path = os.path.join(self.session_dir, sessions[-1])
+            if not SessionJournal.is_closed(path):
+                answer = QMessageBox.question(
+                    self, "Restore Session", "The last drawing session was not closed. Restore it?"
+                )
+                if answer == QMessageBox.Yes:
+                    self.open_session(path)
+
+    def closeEvent(self, event):
+        """Closes the session journal and the stream on exit"""
+        self.stop_journal()
+        if self.publisher is not None:
+            self.publisher.close()
+        QThreadPool.globalInstance().waitForDone()
+        super().closeEvent(event)
+
+    def rebuild_layer(self, rect=None, layers=None):
+        """Re-renders the layer caches while drawing mode is on, optionally only some layers"""
+        if not self.draw_mode:
+            self.renderer.release()
+            return
+        ratio = self.devicePixelRatioF()
+        if self.renderer.size != self.size() or self.renderer.device_pixel_ratio != ratio:
+            self.renderer.resize(self.size(), ratio)
+        else:
+            self.renderer.rebuild(rect, layers)
+
+    def resizeEvent(self, event):
+        """Keeps the committed layer in step with the window size"""
+        super().resizeEvent(event)
+        if self.draw_mode:
+            self.rebuild_layer()
+
+    @profiled("paint")
     def paintEvent(self, event):
         """Drawing event"""
         try:
@@ -505,114 +3783,277 @@ class ScreenDrawApp(QMainWindow):
             painter.setRenderHint(QPainter.Antialiasing)
             
             if self.draw_mode and self.background:
-                painter.scale(self.zoom_factor, self.zoom_factor)
-                painter.drawPixmap(0, 0, self.background)
+                live_items = []
+                if self.current_line is not None:
+                    live_items.append(self.current_line)
+                if self.drawing and self.mode in ["line", "rect", "circle"] and self.current_point is not None:
+                    live_items.append(Shape(self.mode, self.start_point, self.current_point,
+                                            self.current_color, self.pen_size, layer=self.active_layer))
                 
-                # Draw lines
-                for points, color, size in self.lines:
-                    pen = QPen(color, size / self.zoom_factor, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-                    painter.setPen(pen)
-                    painter.setOpacity(color.alpha() / 255.0)
-                    
-                    for i in range(len(points) - 1):
-                        painter.drawLine(points[i], points[i + 1])
-                
-                # Draw shapes
-                for shape_type, start, end, color, size in self.shapes:
-                    pen = QPen(color, size / self.zoom_factor, Qt.SolidLine, Qt.RoundCap)
-                    painter.setPen(pen)
-                    painter.setOpacity(1.0)
-                    
-                    if shape_type == "line":
-                        painter.drawLine(start, end)
-                    elif shape_type == "rect":
-                        painter.drawRect(QRect(start, end))
-                    elif shape_type == "circle":
-                        rect = QRect(start, end).normalized()
-                        painter.drawEllipse(rect)
-                
-                painter.setOpacity(1.0)
+                # Only the invalidated region is repainted
+                self.renderer.paint(painter, event.rect(), self.background, live_items)
+            
+            if self.profiler.enabled and event.rect().intersects(self.hud_rect()):
+                self.draw_hud(painter)
         except Exception as e:
-            pass  # Silently handle drawing errors
+            self.profiler.error("paint", e)  # Keep painting, but count and report the error
+
+    def hud_rect(self):
+        """Where the performance HUD sits: the top right of the primary screen"""
+        primary = self.screen.geometry().translated(-self.x(), -self.y())
+        return QRect(primary.right() - 320, primary.top() + 20, 300, 170)
 
+    def draw_hud(self, painter):
+        """Draws rolling timings and scene counters over the canvas"""
+        profiler = self.profiler
+        lines = []
+        for name in ["paint", "input", "motion", "erase", "capture", "save"]:
+            stats = profiler.percentiles(name)
+            if stats is not None:
+                lines.append(f"{name:<8} p50 {stats[0]:6.2f}  p95 {stats[1]:6.2f}  p99 {stats[2]:6.2f} ms")
+        lines.append(f"rate     {profiler.rate('input'):5.0f} input events/s")
+        lines.append(f"strokes {len(self.scene.lines)}  points {self.scene.points}  shapes {len(self.scene.shapes)}")
+        if self.scene.baked_items:
+            lines.append(f"baked   {len(self.scene.baked_items)} items  {self.scene.baked_memory() / 1e6:.1f} MB raster")
+        if profiler.errors:
+            lines.append("errors  " + "  ".join(f"{name} {count}" for name, count in profiler.errors.items()))
+        
+        rect = self.hud_rect()
+        painter.save()
+        painter.setClipRect(rect)
+        painter.setOpacity(1.0)
+        painter.fillRect(rect, QColor(0, 0, 0, 180))
+        painter.setPen(QColor("#2ecc71"))
+        painter.setFont(QFont("Monospace", 8))
+        painter.drawText(rect.adjusted(8, 6, -8, -6), Qt.AlignLeft | Qt.AlignTop, "\n".join(lines))
+        painter.restore()
+
+    def toggle_profiler(self):
+        """Turns timing and the HUD on or off"""
+        self.profiler.enabled = not self.profiler.enabled
+        if self.profiler.enabled:
+            self.hud_timer.start()
+        else:
+            self.hud_timer.stop()
+        self.update(self.hud_rect())
+
+    def dump_trace(self):
+        """Saves the profiler's trace as JSON for offline analysis"""
+        try:
+            trace_dir = os.path.join(os.path.dirname(self.session_dir), "traces")
+            os.makedirs(trace_dir, exist_ok=True)
+            path = os.path.join(trace_dir, time.strftime("trace-%Y%m%d-%H%M%S.json"))
+            self.profiler.dump(path, {
+                "strokes": len(self.scene.lines),
+                "points": self.scene.points,
+                "shapes": len(self.scene.shapes),
+                "baked": len(self.scene.baked_items),
+                "capture_latencies_ms": [latency * 1000 for latency in self.capture_latencies]
+            })
+            QMessageBox.information(self, "Trace Saved", f"Trace written to {path}")
+        except OSError as e:
+            QMessageBox.critical(self, "Error", f"Could not write trace: {str(e)}")
+
+    @profiled("input")
     def mousePressEvent(self, event):
         """Mouse press event"""
-        if self.draw_mode and event.button() == Qt.LeftButton:
-            adjusted_pos = QPoint(
-                int(event.pos().x() / self.zoom_factor), 
-                int(event.pos().y() / self.zoom_factor)
-            )
+        # Hidden and locked layers cannot be drawn on or erased
+        if self.draw_mode and event.button() == Qt.LeftButton and self.scene.layer(self.active_layer).editable():
+            self.ensure_captured(QRect(event.pos(), QSize(1, 1)))
+            if self.buffer_input(event):
+                return
+            # Strokes keep sub-pixel positions; shapes and the eraser work in whole pixels
+            adjusted_pos = event.localPos() / self.scene.zoom
+            point = QPoint(int(adjusted_pos.x()), int(adjusted_pos.y()))
+            self.apply_motion()
             self.drawing = True
-            self.last_point = adjusted_pos
-            self.start_point = adjusted_pos
+            self.last_point = point
+            self.start_point = point
+            self.current_point = None
+            dirty = QRect()
             
             if self.mode in ["free", "highlighter"]:
-                self.lines.append(([self.last_point], self.current_color, self.pen_size))
-                self.history.append(("line", len(self.lines) - 1))
+                self.current_line = Stroke(QColor(self.current_color), self.pen_size, self.scene.next_id(),
+                                           self.active_layer)
+                changed = self.current_line.extend(adjusted_pos, 0, self.fit_tolerance(self.current_line),
+                                                   self.pressure, self.sample_time())
+                dirty = self.renderer.screen_rect(changed, self.pen_size)
+                if self.publisher is not None:
+                    self.publisher.on_stroke(self.current_line)
             elif self.mode == "eraser":
-                self.erase_at(adjusted_pos)
+                self.erase_command = None
+                dirty = self.erase_at(point)
             
-            self.update()
+            if not dirty.isEmpty():
+                self.update(dirty)
 
+    @profiled("input")
     def mouseMoveEvent(self, event):
         """Mouse move event"""
+        if self.draw_mode and event.buttons() & Qt.LeftButton:
+            if self.drawing:
+                # A stroke crossing onto another screen grabs it before painting there
+                self.ensure_captured(QRect(event.pos(), QSize(1, 1)))
+            if self.buffer_input(event):
+                return
+        
         if self.draw_mode and self.drawing and event.buttons() & Qt.LeftButton:
-            adjusted_pos = QPoint(
-                int(event.pos().x() / self.zoom_factor), 
-                int(event.pos().y() / self.zoom_factor)
-            )
-            
-            if self.mode in ["free", "highlighter"]:
-                self.lines[-1][0].append(adjusted_pos)
-                self.last_point = adjusted_pos
-                self.update()
+            adjusted_pos = event.localPos() / self.scene.zoom
+            # Samples are queued and applied once per display frame, so a
+            # 1000 Hz device does not cost 1000 stroke updates and repaints a second
+            self.pending_motion.append((adjusted_pos, self.pressure, self.sample_time()))
+            if not self.frame_timer.isActive():
+                elapsed = time.perf_counter() - self.last_frame
+                self.frame_timer.start(max(0, int((self.frame_interval() - elapsed) * 1000)))
+
+    def frame_interval(self):
+        """Seconds per display frame of the primary screen"""
+        rate = self.screen.refreshRate()
+        return 1.0 / (rate if rate > 0 else 60.0)
+
+    @profiled("motion")
+    def apply_motion(self):
+        """Applies the queued motion samples and repaints their union once"""
+        self.frame_timer.stop()
+        self.last_frame = time.perf_counter()
+        samples, self.pending_motion = self.pending_motion, []
+        dirty = QRect()
+        for adjusted_pos, pressure, timestamp in samples:
+            point = QPoint(int(adjusted_pos.x()), int(adjusted_pos.y()))
+            if self.mode in ["free", "highlighter"] and self.current_line is not None:
+                # Jitter and duplicate samples are dropped while drawing, the rest fitted to the stroke's tail
+                changed = self.current_line.extend(adjusted_pos, self.min_sample_distance / self.scene.zoom,
+                                                   self.fit_tolerance(self.current_line), pressure, timestamp)
+                if changed is not None:
+                    dirty = dirty.united(self.renderer.screen_rect(changed, self.pen_size))
+            elif self.mode in ["line", "rect", "circle"] and self.start_point is not None:
+                # Union of the old and new rubber band
+                dirty = dirty.united(self.renderer.segment_rect(self.start_point, point, self.pen_size))
+                if self.current_point is not None:
+                    dirty = dirty.united(self.renderer.segment_rect(self.start_point, self.current_point, self.pen_size))
+                self.current_point = point
             elif self.mode == "eraser":
-                self.erase_at(adjusted_pos)
-                self.update()
+                dirty = dirty.united(self.erase_to(point))
+        if self.publisher is not None and self.current_line is not None:
+            self.publisher.on_stroke(self.current_line)
+        
+        if not dirty.isEmpty():
+            self.update(dirty)
 
+    @profiled("input")
     def mouseReleaseEvent(self, event):
         """Mouse release event"""
         if self.draw_mode and event.button() == Qt.LeftButton:
-            adjusted_pos = QPoint(
-                int(event.pos().x() / self.zoom_factor), 
-                int(event.pos().y() / self.zoom_factor)
-            )
+            if self.buffer_input(event):
+                return
+            self.apply_motion()
+            adjusted_pos = event.localPos() / self.scene.zoom
+            point = QPoint(int(adjusted_pos.x()), int(adjusted_pos.y()))
             
-            if self.mode in ["line", "rect", "circle"]:
-                self.shapes.append((self.mode, self.start_point, adjusted_pos, self.current_color, self.pen_size))
-                self.history.append(("shape", len(self.shapes) - 1))
+            dirty = QRect()
+            if self.current_line is not None:
+                changed = self.current_line.extend(adjusted_pos, 1, self.fit_tolerance(self.current_line),
+                                                   self.pressure, self.sample_time())
+                if changed is not None:
+                    dirty = self.renderer.screen_rect(changed, self.pen_size)
+                self.current_line.finish()
+                self.scene.commit(EditCommand(added=[self.current_line]))
+                self.renderer.commit(self.current_line)
+                dirty = dirty.united(self.renderer.items_rect([self.current_line]))
+                self.current_line = None
+            elif self.mode in ["line", "rect", "circle"] and self.start_point is not None:
+                shape = Shape(self.mode, self.start_point, point, QColor(self.current_color),
+                              self.pen_size, self.scene.next_id(), self.active_layer)
+                self.scene.commit(EditCommand(added=[shape]))
+                self.renderer.commit(shape)
+                dirty = self.renderer.items_rect([shape])
+                if self.current_point is not None:
+                    dirty = dirty.united(self.renderer.segment_rect(self.start_point, self.current_point, self.pen_size))
+            
+            if self.erase_command is not None:
+                self.scene.record(self.erase_command)
             
             self.drawing = False
             self.start_point = None
-            self.update()
+            self.current_point = None
+            self.erase_command = None
+            self.renderer.bake_over_budget()
+            if not dirty.isEmpty():
+                self.update(dirty)
+
+    def tabletEvent(self, event):
+        """Pen input: handled like the mouse, with the pen pressure recorded per sample"""
+        kinds = {
+            QEvent.TabletPress: (QEvent.MouseButtonPress, self.mousePressEvent),
+            QEvent.TabletMove: (QEvent.MouseMove, self.mouseMoveEvent),
+            QEvent.TabletRelease: (QEvent.MouseButtonRelease, self.mouseReleaseEvent)
+        }
+        if event.type() not in kinds:
+            event.ignore()
+            return
+        kind, handler = kinds[event.type()]
+        self.pressure = event.pressure()
+        try:
+            handler(QMouseEvent(kind, event.posF(), event.button(), event.buttons(), event.modifiers()))
+        finally:
+            self.pressure = None
+        event.accept()  # Stops Qt from synthesizing the matching mouse event
+
+    def fit_tolerance(self, line):
+        """How far input may stray from a stroke's fitted samples, tied to its pen size"""
+        return max(0.5, self.fit_ratio * line.size / self.scene.zoom)
 
+    @profiled("erase")
     def erase_at(self, point):
-        """Erases at the specified point"""
-        erase_radius = self.pen_size * 2
-        
-        # Check lines
-        self.lines = [
-            (points, color, size) for points, color, size in self.lines
-            if not any((p.x() - point.x()) ** 2 + (p.y() - point.y()) ** 2 < erase_radius ** 2 for p in points)
-        ]
+        """Erases at the specified point and returns the screen rect that changed"""
+        command = self.scene.erase(point, self.pen_size * 2, self.active_layer)
+        if not command.removed and not command.tiles:
+            return QRect()
         
-        # Check shapes
-        new_shapes = []
-        for shape_type, start, end, color, size in self.shapes:
-            keep = True
-            if shape_type == "line":
-                if ((start.x() - point.x()) ** 2 + (start.y() - point.y()) ** 2 < erase_radius ** 2 or
-                    (end.x() - point.x()) ** 2 + (end.y() - point.y()) ** 2 < erase_radius ** 2):
-                    keep = False
-            elif shape_type in ["rect", "circle"]:
-                rect = QRect(start, end).normalized()
-                if rect.contains(point):
-                    keep = False
-            
-            if keep:
-                new_shapes.append((shape_type, start, end, color, size))
+        # A whole eraser drag is recorded as one command when the button is released
+        if self.erase_command is None:
+            self.erase_command = EditCommand()
+        for item in command.removed:
+            # Pieces cut earlier in the same drag never existed outside it
+            if item in self.erase_command.added:
+                self.erase_command.added.remove(item)
+            else:
+                self.erase_command.removed.append(item)
+        self.erase_command.added.extend(command.added)
+        for key, (before, after) in command.tiles.items():
+            # The drag keeps each raster tile's state from before its first step
+            self.erase_command.tiles[key] = (self.erase_command.tiles.get(key, (before,))[0], after)
+        self.erase_command.holes.extend(command.holes)
         
-        self.shapes = new_shapes
+        # Only re-render the part of the layer that was actually erased: strokes
+        # only change inside the eraser circle, shapes go whole
+        radius = self.pen_size * 2
+        area = QRect(point.x() - radius, point.y() - radius, 2 * radius + 1, 2 * radius + 1)
+        dirty = QRect()
+        for item in command.removed:
+            if isinstance(item, Stroke):
+                dirty = dirty.united(self.renderer.screen_rect(area, item.size))
+            else:
+                dirty = dirty.united(self.renderer.items_rect([item]))
+        dirty = dirty.united(self.renderer.baked_rect())
+        self.rebuild_layer(dirty, {self.active_layer})
+        return dirty
+
+    def erase_to(self, point):
+        """Sweeps the eraser from the last point in radius-sized steps
+
+        Fast drags report sparse samples; stepping keeps strokes between
+        them from slipping through the gaps.
+        """
+        start, radius = self.last_point, self.pen_size * 2
+        dx, dy = point.x() - start.x(), point.y() - start.y()
+        steps = max(1, int(math.hypot(dx, dy) / radius))
+        dirty = QRect()
+        for step in range(1, steps + 1):
+            dirty = dirty.united(self.erase_at(QPoint(start.x() + dx * step // steps,
+                                                      start.y() + dy * step // steps)))
+        self.last_point = point
+        return dirty
 
     def keyPressEvent(self, event):
         """Keyboard events"""
@@ -624,22 +4065,225 @@ class ScreenDrawApp(QMainWindow):
             Qt.Key_R: lambda: self.set_mode("rect"),
             Qt.Key_C: lambda: self.set_mode("circle"),
             Qt.Key_E: lambda: self.set_mode("eraser"),
+            Qt.Key_F5: self.recapture_background,
+            Qt.Key_F12: self.toggle_profiler,
+            Qt.Key_PageUp: lambda: self.select_adjacent_layer(1),
+            Qt.Key_PageDown: lambda: self.select_adjacent_layer(-1),
             Qt.Key_Escape: self.close
         }
         
-        if event.key() in shortcuts:
-            shortcuts[event.key()]()
-        elif event.modifiers() & Qt.ControlModifier:
+        # Ctrl combinations first, so Ctrl+C clears instead of picking the circle tool
+        if event.modifiers() & Qt.ControlModifier:
             ctrl_shortcuts = {
                 Qt.Key_D: self.toggle_draw_mode,
                 Qt.Key_C: self.clear_canvas,
-                Qt.Key_Z: self.undo,
-                Qt.Key_S: self.save_png
+                Qt.Key_Z: self.redo if event.modifiers() & Qt.ShiftModifier else self.undo,
+                Qt.Key_Y: self.redo,
+                Qt.Key_S: self.save_png,
+                Qt.Key_O: self.open_session,
+                Qt.Key_N: self.new_layer,
+                Qt.Key_H: self.toggle_layer_visible,
+                Qt.Key_L: self.toggle_layer_locked,
+                Qt.Key_PageUp: lambda: self.move_layer(1),
+                Qt.Key_PageDown: lambda: self.move_layer(-1),
+                Qt.Key_F12: self.dump_trace
             }
             if event.key() in ctrl_shortcuts:
                 ctrl_shortcuts[event.key()]()
+        elif event.key() in shortcuts:
+            shortcuts[event.key()]()
+
+def replay_session(argv):
+    """Command line: renders a session journal's timeline to PNG frames or a raw pipe"""
+    parser = argparse.ArgumentParser(prog="pencil.py replay", description="Replay how a session was drawn")
+    parser.add_argument("session", help="session journal (.spj)")
+    parser.add_argument("output", help="directory for numbered PNG frames, or - for raw BGRA frames on stdout")
+    parser.add_argument("--fps", type=float, default=30.0, help="frames per second of output")
+    parser.add_argument("--speed", type=float, default=1.0, help="recording seconds per second of output")
+    parser.add_argument("--max-idle", type=float, default=1.0, help="longest pause kept, in recording seconds")
+    parser.add_argument("--compression", type=int, default=1, help="PNG zlib level, 0-9")
+    parser.add_argument("--point-budget", type=int, default=100000, help="vector points kept before baking")
+    args = parser.parse_args(argv)
+    
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QGuiApplication.instance() or QGuiApplication(sys.argv[:1])  # Painting needs one, headless is fine
+    if args.output == "-":
+        writer = FramePipeWriter(sys.stdout.buffer)
+    else:
+        writer = FrameSequenceWriter(args.output, args.compression)
+    player = TimelinePlayer(args.session, args.fps, args.speed, args.max_idle, args.point_budget or None)
+    start = time.perf_counter()
+    try:
+        for frame in player.frames():
+            writer.write(frame)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Could not replay session: {e}", file=sys.stderr)
+        return 1
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    size = player.canvas.size() if player.canvas is not None else QSize()
+    print(f"{writer.count} frames of {size.width()}x{size.height()} in {elapsed:.1f} s "
+          f"({writer.count / max(elapsed, 1e-9):.1f} frames/s)", file=sys.stderr)
+    for error in writer.errors:
+        print(error, file=sys.stderr)
+    return 1 if writer.errors else 0
+
+def view_stream(argv):
+    """Command line: mirrors a streamed session to PNG frames or a raw pipe as it is drawn"""
+    parser = argparse.ArgumentParser(prog="pencil.py view", description="Mirror a session streamed with SCREEN_PENCIL_STREAM")
+    parser.add_argument("address", help="host:port, or the local socket name or path the session streams to")
+    parser.add_argument("output", help="directory for numbered PNG frames, or - for raw BGRA frames on stdout")
+    parser.add_argument("--fps", type=float, default=30.0, help="frames per second of output")
+    parser.add_argument("--duration", type=float, default=0.0, help="seconds to mirror, 0 until the stream ends")
+    parser.add_argument("--compression", type=int, default=1, help="PNG zlib level, 0-9")
+    parser.add_argument("--history-depth", type=int, default=100, help="undo depth of the drawing session")
+    parser.add_argument("--point-budget", type=int, default=100000, help="vector points kept before baking")
+    args = parser.parse_args(argv)
+    
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QGuiApplication.instance() or QGuiApplication(sys.argv[:1])
+    receiver = StreamReceiver(args.history_depth, args.point_budget or None)
+    try:
+        socket = StreamReceiver.connect(args.address)
+    except OSError as e:
+        print(f"Could not view stream: {e}", file=sys.stderr)
+        return 1
+    if args.output == "-":
+        writer = FramePipeWriter(sys.stdout.buffer)
+    else:
+        writer = FrameSequenceWriter(args.output, args.compression)
+    start = time.perf_counter()
+    received = 0
+    try:
+        frame = start
+        while socket.state() != socket.UnconnectedState or socket.bytesAvailable():
+            frame += 1.0 / args.fps
+            while True:
+                data = bytes(socket.readAll())
+                if data:
+                    received += len(data)
+                    receiver.feed(data)
+                wait = int((frame - time.perf_counter()) * 1000)
+                if wait <= 0 or not socket.waitForReadyRead(wait):
+                    break
+            if receiver.canvas is not None:
+                writer.write(receiver.canvas)
+            if args.duration and time.perf_counter() - start >= args.duration:
+                break
+    except (ValueError, struct.error, KeyError) as e:
+        print(f"Could not view stream: {e}", file=sys.stderr)
+        return 1
+    finally:
+        writer.close()
+        socket.close()
+    elapsed = time.perf_counter() - start
+    print(f"{writer.count} frames from {received / 1024:.1f} KB in {elapsed:.1f} s", file=sys.stderr)
+    for error in writer.errors:
+        print(error, file=sys.stderr)
+    return 1 if writer.errors else 0
+
+worker_app = None  # QGuiApplication of a render worker process
+
+def start_render_worker():
+    """Pool initializer: each worker paints offscreen with an application of its own"""
+    global worker_app
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    worker_app = QGuiApplication.instance() or QGuiApplication(sys.argv[:1])
+
+def render_session_file(job):
+    """Renders one session journal to a PNG file; returns (path, output pixels, error or None)"""
+    path, target, scale, crop, annotations_only, compression = job
+    try:
+        session = SessionJournal.load(path)
+        renderer = SceneRenderer(session.scene)
+        renderer.size = QSize(session.size)  # Only render_image is used, so no tiles are cached
+        background = session.background
+        if background is not None and background.isNull():
+            background = None
+        native = background.size() if background is not None else session.size
+        if background is not None:
+            background.setDevicePixelRatio(background.width() / session.size.width())
+        size = QSize(max(1, round(native.width() * scale)), max(1, round(native.height() * scale)))
+        image = renderer.render_image(None if annotations_only else background, size,
+                                      QRect(*crop) if crop is not None else None)
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+        save_png(image, target, compression)
+        return path, image.width() * image.height(), None
+    except Exception as e:  # Any failure is this file's alone; it must not abort the batch
+        return path, 0, str(e) or type(e).__name__
+
+def render_sessions(argv):
+    """Command line: renders saved sessions to PNG files on a pool of worker processes"""
+    parser = argparse.ArgumentParser(prog="pencil.py render", description="Render saved sessions to PNG files")
+    parser.add_argument("sessions", nargs="+", help="session journals (.spj), or directories searched for them")
+    parser.add_argument("-o", "--output", default=".", help="directory for the PNG files")
+    parser.add_argument("--scale", type=float, default=1.0, help="output pixels per captured screen pixel")
+    parser.add_argument("--crop", help="screen area to render, as x,y,width,height in screen coordinates")
+    parser.add_argument("--annotations-only", action="store_true", help="transparent instead of the captured screen")
+    parser.add_argument("--compression", type=int, default=6, help="PNG zlib level, 0-9")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="worker processes")
+    args = parser.parse_args(argv)
+    crop = None
+    if args.crop:
+        try:
+            crop = tuple(int(value) for value in args.crop.split(","))
+        except ValueError:
+            crop = ()
+        if len(crop) != 4 or crop[2] <= 0 or crop[3] <= 0:
+            parser.error("--crop takes x,y,width,height")
+    if args.scale <= 0:
+        parser.error("--scale must be positive")
+    
+    # Files are rendered next to each other; directories keep their layout under the output
+    jobs = []
+    for source in args.sessions:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith(".spj"):
+                        relative = os.path.relpath(os.path.join(root, name[:-4] + ".png"), source)
+                        jobs.append((os.path.join(root, name), os.path.join(args.output, relative)))
+        else:
+            name = os.path.splitext(os.path.basename(source))[0] + ".png"
+            jobs.append((source, os.path.join(args.output, name)))
+    jobs = [(path, target, args.scale, crop, args.annotations_only, args.compression) for path, target in jobs]
+    
+    workers = max(1, min(args.jobs, len(jobs)))
+    start = time.perf_counter()
+    if workers == 1:
+        start_render_worker()
+        results = map(render_session_file, jobs)
+        pool = None
+    else:
+        # Qt is not fork-safe, so workers start as fresh interpreters
+        pool = ProcessPoolExecutor(workers, multiprocessing.get_context("spawn"), start_render_worker)
+        results = pool.map(render_session_file, jobs, chunksize=max(1, min(16, len(jobs) // (workers * 4))))
+    failed = 0
+    pixels = 0
+    try:
+        for path, count, error in results:
+            pixels += count
+            if error is not None:
+                failed += 1
+                print(f"{path}: {error}", file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    elapsed = time.perf_counter() - start
+    print(f"{len(jobs) - failed} of {len(jobs)} sessions rendered in {elapsed:.1f} s by {workers} processes "
+          f"({len(jobs) / max(elapsed, 1e-9):.1f} sessions/s, {pixels / 1e6 / max(elapsed, 1e-9):.1f} Mpx/s)",
+          file=sys.stderr)
+    return 1 if failed else 0
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ["render"]:
+        sys.exit(render_sessions(sys.argv[2:]))
+    if sys.argv[1:2] == ["replay"]:
+        sys.exit(replay_session(sys.argv[2:]))
+    if sys.argv[1:2] == ["view"]:
+        sys.exit(view_stream(sys.argv[2:]))
     app = QApplication(sys.argv)
     app.setStyle('Fusion')  # For modern appearance
     window = ScreenDrawApp()